@@ -0,0 +1,317 @@
+"""
+Micro-benchmarks for the model layer.
+
+Run with `python bench_models.py`. Most benchmarks run against an
+in-memory database, so their numbers only reflect the python side of
+each call. The exceptions hit disk: bench_writes and bench_history use a
+database file in a temporary directory, since they measure commits and
+file size, and bench_startup times imports in fresh python processes.
+"""
+
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from sqlalchemy import text
+from pypika import Parameter
+
+from database import create_sqlite_engine
+from ferdinand_admin import create_schema
+from notes import clean_and_render_markup, render_cache, render_markup
+from phrase_models import (
+    Graph,
+    Phrase,
+    Queries,
+    Sentence,
+    Statements,
+    Tables,
+    unit_of_work,
+)
+
+
+ROUNDS = 5_000
+
+
+def in_memory_project():
+    engine = create_sqlite_engine("sqlite://")
+    db = engine.connect()
+    create_schema(db)
+
+    return db
+
+
+def report(label, seconds, rounds=ROUNDS):
+    print(f"{label:<48} {seconds / rounds * 1_000_000:>9.1f} us/call")
+
+
+def bench_statements():
+    """Per-call cost of building a statement vs. using the compiled one."""
+    db = in_memory_project()
+    stack_id = Sentence().new("A sentence worth defining.", db)
+    phrase_id = Phrase().new(stack_id, "worth defining", db)
+
+    def rebuilt_phrase_get():
+        stmt = Queries.phrase_base.where(
+            Tables.phrases.id == Parameter(":phrase_id")
+        )
+        return db.execute(text(str(stmt)), {"phrase_id": phrase_id})
+
+    def compiled_phrase_get():
+        return db.execute(Statements.get_phrase, {"phrase_id": phrase_id})
+
+    report(
+        "render only: phrase get (rebuilt per call)",
+        timeit.timeit(
+            lambda: text(
+                str(
+                    Queries.phrase_base.where(
+                        Tables.phrases.id == Parameter(":phrase_id")
+                    )
+                )
+            ),
+            number=ROUNDS,
+        ),
+    )
+    report(
+        "execute: phrase get (rebuilt per call)",
+        timeit.timeit(rebuilt_phrase_get, number=ROUNDS),
+    )
+    report(
+        "execute: phrase get (compiled once)",
+        timeit.timeit(compiled_phrase_get, number=ROUNDS),
+    )
+    report(
+        "model: Phrase().get",
+        timeit.timeit(lambda: Phrase().get(phrase_id, db), number=ROUNDS),
+    )
+    report(
+        "model: Sentence().get",
+        timeit.timeit(lambda: Sentence().get(stack_id, db), number=ROUNDS),
+    )
+
+    db.close()
+
+
+def define_phrase_steps(db, n):
+    """The model calls behind sentence analysis and one phrase edit."""
+    state = {}
+    return [
+        lambda: state.update(stack_id=Sentence().new(f"Sentence {n}.", db)),
+        lambda: state.update(
+            phrase_id=Phrase().new(state["stack_id"], f"sentence {n}", db)
+        ),
+        lambda: Phrase().revise_definition(
+            state["phrase_id"], f"The definition of {n}.", db
+        ),
+        lambda: Phrase().revise_notes(state["phrase_id"], "Some notes.", db),
+        lambda: Phrase().set_status(state["phrase_id"], "EXPLORING", db),
+    ]
+
+
+def bench_writes(actions=200):
+    """
+    User actions per second against a file database, where every commit
+    is an fsync. 'commit per call' is how the models behaved before
+    unit_of_work; 'unit of work' is one commit per action.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_sqlite_engine(
+            f"sqlite:///{Path(tmp) / 'bench.sqlite3'}"
+        )
+        with engine.connect() as db:
+            create_schema(db)
+
+        with engine.connect() as db:
+            start = time.perf_counter()
+            for n in range(actions):
+                for step in define_phrase_steps(db, n):
+                    step()
+                    db.commit()
+            elapsed = time.perf_counter() - start
+        print(f"{'writes: commit per call':<48} {actions / elapsed:>9.1f} actions/s")
+
+        start = time.perf_counter()
+        for n in range(actions):
+            with unit_of_work(engine, write=True) as db:
+                for step in define_phrase_steps(db, n):
+                    step()
+        elapsed = time.perf_counter() - start
+        print(f"{'writes: unit of work':<48} {actions / elapsed:>9.1f} actions/s")
+
+        engine.dispose()
+
+
+def research_notes(sections=200):
+    """A long markdown document like the notes phrases collect over time."""
+    section = """
+## Section {n}
+
+Some *prose* about the phrase with a [link](https://example.com/{n}) and
+`inline code`, then a list:
+
+- a first point
+- a second point with **emphasis**
+
+```python
+def example_{n}():
+    return {n}
+```
+"""
+    return "".join(section.format(n=n) for n in range(sections))
+
+
+def bench_markdown(rounds=200):
+    markup = research_notes()
+    render_cache.clear()
+
+    report(
+        f"notes: render {len(markup) // 1024} KiB uncached",
+        timeit.timeit(lambda: render_markup(markup), number=rounds),
+        rounds,
+    )
+    report(
+        f"notes: render {len(markup) // 1024} KiB cached",
+        timeit.timeit(lambda: clean_and_render_markup(markup), number=rounds),
+        rounds,
+    )
+    print(f"{'notes: render cache':<48} {render_cache.info()}")
+
+
+def edited_definition(n: int, edits: int) -> list[str]:
+    """Revisions of a long definition, each changing a couple of words."""
+    words = research_notes(2).split()[:80]
+    revisions = []
+    for edit in range(edits):
+        words[(edit * 7) % len(words)] = f"edit{n}_{edit}"
+        words[(edit * 13) % len(words)] = f"word{edit}"
+        revisions.append(" ".join(words))
+    return revisions
+
+
+def bench_history(stacks=300, edits=30):
+    """
+    Database size and history reads for a heavily revised project, before
+    and after its older revisions are compacted into deltas.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "history.sqlite3"
+        engine = create_sqlite_engine(f"sqlite:///{path}")
+        with engine.connect() as db:
+            create_schema(db)
+
+        stack_ids = []
+        with unit_of_work(engine, write=True) as db:
+            for n in range(stacks):
+                first, *rest = edited_definition(n, edits)
+                stack_ids.append(Sentence().new(first, db))
+                for words in rest:
+                    Sentence().update(stack_ids[-1], words, db)
+
+        def size():
+            with engine.connect() as db:
+                db.exec_driver_sql("vacuum;")
+                db.exec_driver_sql("pragma wal_checkpoint(truncate);")
+            return path.stat().st_size // 1024
+
+        def read(limit=None):
+            with engine.connect() as db:
+                for stack_id in stack_ids:
+                    Sentence().history(stack_id, db, limit=limit)
+
+        for label in ("full text", "compacted"):
+            if label == "compacted":
+                with unit_of_work(engine, write=True) as db:
+                    for stack_id in stack_ids:
+                        Sentence().compact(stack_id, db)
+            print(f"{f'history: {label} size':<48} {size():>9} KiB")
+            report(
+                f"history: {label}, all {edits} revisions",
+                timeit.timeit(read, number=3),
+                3 * stacks,
+            )
+            report(
+                f"history: {label}, newest 5 revisions",
+                timeit.timeit(lambda: read(limit=5), number=3),
+                3 * stacks,
+            )
+
+        engine.dispose()
+
+
+def bench_layout(sentences=5_000):
+    """
+    Loading the graph as dicts vs. as arrays, and laying it out cold and
+    again from the last version's positions after one more sentence.
+    """
+    import graph_layout
+
+    db = in_memory_project()
+    for n in range(sentences):
+        stack_id = Sentence().new(f"Sentence {n} about media.", db)
+        if n % 2:
+            phrase_id = Phrase().new(stack_id, f"media {n}", db)
+            Phrase().revise_definition(phrase_id, f"Definition {n}.", db)
+
+    report(
+        "graph: assemble_graph dicts",
+        timeit.timeit(lambda: Graph.assemble_graph(db), number=3),
+        3,
+    )
+    report(
+        "graph: load_arrays",
+        timeit.timeit(lambda: graph_layout.load_arrays(db), number=3),
+        3,
+    )
+
+    cache = graph_layout.LayoutCache()
+    start = time.perf_counter()
+    cache.store("bench", 1, graph_layout.load_arrays(db))
+    report("graph: layout, cold", time.perf_counter() - start, 1)
+
+    Sentence().new("One more sentence.", db)
+    start = time.perf_counter()
+    cache.store("bench", 2, graph_layout.load_arrays(db))
+    report("graph: layout, from the last version", time.perf_counter() - start, 1)
+
+    start = time.perf_counter()
+    cache.get("bench", 2)
+    report("graph: layout, cached", time.perf_counter() - start, 1)
+
+
+def import_times(module: str) -> dict[str, int]:
+    """
+    Cumulative microseconds spent importing each module that a fresh
+    interpreter loads for `import <module>`, from python -X importtime.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def bench_startup():
+    for module in ("ferdinand_admin", "ferdinand"):
+        seconds = import_times(module)[module] / 1_000_000
+        report(f"startup: import {module}", seconds, 1)
+
+
+if __name__ == "__main__":
+    bench_startup()
+    bench_statements()
+    bench_writes()
+    bench_markdown()
+    bench_history()
+    bench_layout()
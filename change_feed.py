@@ -0,0 +1,158 @@
+"""
+The /events feed: every project change as a server-sent event, read
+forward from the events table the model methods write to.
+
+The table is the only channel, so a change made by any worker (or by
+the admin tool) reaches every open page. A stream only looks at the
+events when the project version has moved, which is one row read per
+poll, and it holds no connection between polls.
+
+A stream holds a server thread while it's open, so streams are short:
+each one ends as soon as it has sent something, or after STREAM_SECONDS
+of quiet, and the browser reconnects with the last id it saw, which is
+a long poll in server-sent events' clothing. On top of that a process
+only serves `slots.limit` streams at once; past that a stream just tells
+the browser to come back later, so open pages can never take every
+thread from the requests behind them.
+
+Events are sent two ways. Pages using htmx's sse extension get one
+message per thing the change touched, named like 'sentence-12' or
+'phrase-3', so a row can swap itself with hx-trigger="sse:phrase-3".
+The graph view asks for ?format=graph and gets every event unnamed.
+"""
+
+from threading import Lock
+from typing import Iterator
+import json
+import time
+
+from sqlalchemy import Engine
+
+from phrase_models import Event, Version
+
+
+POLL_SECONDS = 1.0
+STREAM_SECONDS = 20.0
+RETRY_MILLISECONDS = 1_000
+# How long a browser turned away for want of a slot waits to try again.
+BUSY_RETRY_MILLISECONDS = 10_000
+# Streams one process serves at once. serve.py sets this from its threads.
+MAX_STREAMS = 8
+
+
+class StreamSlots:
+    """A count of open streams that refuses new ones past `limit`."""
+
+    def __init__(self, limit: int = MAX_STREAMS):
+        self.limit = limit
+        self._open = 0
+        self._lock = Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self._open >= self.limit:
+                return False
+            self._open += 1
+            return True
+
+    def give_back(self):
+        with self._lock:
+            self._open -= 1
+
+    def __len__(self):
+        return self._open
+
+
+slots = StreamSlots()
+
+
+def event_names(event: dict) -> list[str]:
+    """The names a page can listen for an event under."""
+    kind = event["kind"]
+    if kind.startswith("sentence_"):
+        return [f"sentence-{event['stack_id']}"]
+    if kind == "phrase_added" and event["stack_id"]:
+        return [
+            f"phrase-{event['phrase_id']}",
+            f"sentence-{event['stack_id']}-phrases",
+        ]
+    if kind.startswith(("phrase_", "definition_")):
+        return [f"phrase-{event['phrase_id']}"]
+
+    return [kind]
+
+
+def message(event: dict, name: str | None = None) -> str:
+    lines = [f"id: {event['id']}"]
+    if name:
+        lines.append(f"event: {name}")
+    lines.append(f"data: {json.dumps(event)}")
+
+    return "\n".join(lines) + "\n\n"
+
+
+def messages(event: dict, named: bool) -> Iterator[str]:
+    if not named:
+        yield message(event)
+        return
+
+    for name in event_names(event):
+        yield message(event, name)
+
+
+def stream(
+    engine: Engine,
+    after: int | None = None,
+    named: bool = True,
+    seconds: float = STREAM_SECONDS,
+    poll: float = POLL_SECONDS,
+) -> Iterator[str]:
+    """
+    The events after the id `after`, waiting up to `seconds` for some.
+    Without `after` the stream starts from now. A reader whose `after` was
+    pruned gets a 'reload' event, since it can't catch up.
+    """
+    if not slots.take():
+        yield f"retry: {BUSY_RETRY_MILLISECONDS}\n\n"
+        return
+
+    try:
+        yield from follow(engine, after, named, seconds, poll)
+    finally:
+        slots.give_back()
+
+
+def follow(
+    engine: Engine, after: int | None, named: bool, seconds: float, poll: float
+) -> Iterator[str]:
+    with engine.connect() as db:
+        oldest, latest = Event.bounds(db)
+
+    if after is None or after > latest:
+        after = latest
+    elif after < oldest - 1:
+        reload = {"id": latest, "kind": "reload"}
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        yield message(reload, "reload" if named else None)
+        return
+
+    # A message with only an id sets where the browser resumes from, so
+    # nothing between this stream and the next is missed.
+    yield f"retry: {RETRY_MILLISECONDS}\nid: {after}\n\n"
+
+    version = None
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        with engine.connect() as db:
+            # The version is read first, so an event committed after
+            # this read leaves the version changed for the next poll.
+            current = Version.current(db)
+            events = Event.since(after, db) if current != version else []
+
+        for event in events:
+            yield from messages(event, named)
+        if events:
+            return
+
+        version = current
+        time.sleep(poll)
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING
+import json
+import re
+import time
+
+# SQLAlchemy is imported when an engine is made, so the admin commands
+# that only need the paths below don't pay for it.
+if TYPE_CHECKING:
+    from sqlalchemy import Engine
+
+
+PROJECTS_PATH = Path.cwd() / "projects"
+CONF_PATH = Path.cwd() / "project_conf.json"
+# The projects table every project is registered in, see user_models.
+REGISTRY_PATH = Path.cwd() / "ferdinand.sqlite3"
+
+PROJECT_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+# How many project engines one process keeps, the most connections each
+# may hold open, and how long an unused one is kept before it's closed.
+POOL_PROJECTS = 8
+POOL_CONNECTIONS = 4
+POOL_IDLE_SECONDS = 600
+
+# Applied to every new connection. Any of these can be overridden from the
+# "sqlite" section of project_conf.json.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "foreign_keys": "on",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+    "mmap_size": 134217728,
+}
+
+
+def load_pragmas(conf: dict | None = None) -> dict:
+    if conf is None:
+        try:
+            with open(CONF_PATH, "r") as f:
+                conf = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            conf = {}
+
+    pragmas = {**DEFAULT_PRAGMAS, **conf.get("sqlite", {})}
+
+    for name, value in pragmas.items():
+        if name not in DEFAULT_PRAGMAS:
+            raise ValueError(f"Unsupported sqlite pragma '{name}'.")
+        if not str(value).lstrip("-").isalnum():
+            raise ValueError(f"Invalid value for sqlite pragma '{name}'.")
+
+    return pragmas
+
+
+def create_sqlite_engine(
+    url: str, pragmas: dict | None = None, **options
+) -> Engine:
+    from sqlalchemy import create_engine, event
+
+    engine = create_engine(url, **options)
+    pragmas = load_pragmas() if pragmas is None else pragmas
+
+    @event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value};")
+        cursor.close()
+
+    return engine
+
+
+def create_project_engine(
+    project_name: str, pragmas: dict | None = None, **options
+):
+    """The one place project databases get opened from."""
+    return create_sqlite_engine(
+        f"sqlite:///{PROJECTS_PATH / f'{project_name}.sqlite3'}",
+        pragmas,
+        **options,
+    )
+
+
+def create_registry_engine(pragmas: dict | None = None):
+    return create_sqlite_engine(f"sqlite:///{REGISTRY_PATH}", pragmas)
+
+
+def project_path(project_name: str) -> Path:
+    """
+    Where a project's database lives. Names come from urls, so anything
+    that could reach outside the projects folder is refused.
+    """
+    if not PROJECT_NAME.fullmatch(project_name):
+        raise ValueError(f"'{project_name}' isn't a valid project name.")
+
+    return PROJECTS_PATH / f"{project_name}.sqlite3"
+
+
+class EnginePool:
+    """
+    An engine per project for serving several projects from one process.
+    Engines are made on first use and kept in least recently used order;
+    past `maxsize` projects, or once unused for `idle_seconds`, one is
+    disposed, which closes its idle connections. Each engine opens at
+    most `connections` connections, and further requests wait for one.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = POOL_PROJECTS,
+        connections: int = POOL_CONNECTIONS,
+        idle_seconds: float = POOL_IDLE_SECONDS,
+    ):
+        self.maxsize = maxsize
+        self.connections = connections
+        self.idle_seconds = idle_seconds
+        self._engines: OrderedDict[str, tuple[Engine, float]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, project_name: str) -> Engine:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            if project_name in self._engines:
+                engine, _ = self._engines.pop(project_name)
+            elif project_path(project_name).exists():
+                engine = create_project_engine(
+                    project_name,
+                    pool_size=self.connections,
+                    max_overflow=0,
+                )
+            else:
+                raise FileNotFoundError(
+                    f"There's no database for project '{project_name}'."
+                )
+
+            self._engines[project_name] = (engine, now)
+            while len(self._engines) > self.maxsize:
+                _, (evicted, _) = self._engines.popitem(last=False)
+                evicted.dispose()
+
+            return engine
+
+    def _evict_idle(self, now: float):
+        # Oldest first, so the first engine still in use ends the scan.
+        while self._engines:
+            name, (engine, used) = next(iter(self._engines.items()))
+            if now - used < self.idle_seconds:
+                return
+            del self._engines[name]
+            engine.dispose()
+
+    def dispose(self, close: bool = True):
+        """
+        Forget every engine. Pass `close=False` in a forked child so the
+        connections it inherited stay open for the parent.
+        """
+        with self._lock:
+            for engine, _ in self._engines.values():
+                engine.dispose(close=close)
+            self._engines.clear()
+
+    def __contains__(self, project_name: str) -> bool:
+        return project_name in self._engines
+
+    def __len__(self) -> int:
+        return len(self._engines)
@@ -1,70 +1,283 @@
-from string import punctuation
+from collections import OrderedDict
+from functools import cache, wraps
+from threading import Lock
 import json
 from typing import Iterator
 
 from flask import (
+    Blueprint,
     Flask, 
     abort, 
+    g,
     render_template, 
     request, 
     redirect, 
-    jsonify
+    jsonify,
+    make_response,
+    url_for,
 )
-from sqlalchemy import create_engine
-
+from database import CONF_PATH, EnginePool, project_path
 from notes import clean_and_render_markup
-from phrase_models import Phrase, Sentence, Graph
+import change_feed
+import metrics
+import nlp
+from phrase_models import (
+    Analysis,
+    Statements,
+    Phrase,
+    Sentence,
+    Graph,
+    Search,
+    Version,
+    as_of_timestamp,
+    normalize,
+    unit_of_work,
+    PAGE_SIZE,
+    page_size,
+    MAX_NODES,
+    MAX_EDGES,
+)
+from user_models import Project, open_registry
+import user_models
 
 app = Flask(__name__)
 
-with open("project_conf.json", "r") as f:
-    conf = json.load(f)
+# Every project is served under /p/<project_name>/, from one engine pool.
+project = Blueprint("project", __name__, url_prefix="/p/<project_name>")
+engines = EnginePool()
 
-engine = create_engine(f"sqlite:///projects/{conf['current_project']}.sqlite3")
-project_name = conf["current_project"].replace("_", " ")
 
+# The config and the registry are read on the first request rather than
+# at import, so importing the app stays cheap.
+@cache
+def project_conf() -> dict:
+    with open(CONF_PATH, "r") as f:
+        return json.load(f)
 
-@app.route("/")
+
+@cache
+def project_registry():
+    return open_registry()
+
+
+def project_engine():
+    return engines.get(g.project_name)
+
+
+def project_work():
+    """
+    A unit of work on the request's project. Anything but a GET may write,
+    so it queues as a writer.
+    """
+    return unit_of_work(project_engine(), write=request.method != "GET")
+
+
+def after_fork():
+    """
+    Drop any engine made before a server forked this worker. The parent's
+    connections are left open for the parent, never closed from here.
+    """
+    engines.dispose(close=False)
+    if project_registry.cache_info().currsize:
+        project_registry().dispose(close=False)
+        project_registry.cache_clear()
+
+
+def project_title() -> str:
+    return g.project_name.replace("_", " ")
+
+
+@project.url_value_preprocessor
+def pull_project(endpoint, values):
+    g.project_name = values.pop("project_name")
+    with project_registry().connect() as db:
+        project = Project.get_by_name(g.project_name, db)
+    if project is None or not project_path(g.project_name).exists():
+        abort(404)
+
+
+@project.url_defaults
+def add_project(endpoint, values):
+    if "project_name" not in values and "project_name" in g:
+        values["project_name"] = g.project_name
+
+
+@project.context_processor
+def project_root():
+    """Templates build their links off this, e.g. {{ root }}/sentences."""
+    return {"root": url_for("project.index").rstrip("/")}
+
+
+RESPONSE_CACHE_SIZE = 256
+
+
+class ResponseCache:
+    """
+    Rendered GET responses by url, along with the project version they
+    were rendered at. An entry is only served while that version is
+    current. Least recently used entries are dropped past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._responses: OrderedDict[str, tuple[int, bytes, str]] = (
+            OrderedDict()
+        )
+        self._lock = Lock()
+
+    def get(self, url: str, version: int) -> tuple[bytes, str] | None:
+        """The body and mimetype cached for `url` at `version`, if any."""
+        with self._lock:
+            hit = self._responses.get(url)
+            if hit is None or hit[0] != version:
+                return None
+            self._responses.move_to_end(url)
+            return hit[1], hit[2]
+
+    def put(self, url: str, version: int, body: bytes, mimetype: str):
+        with self._lock:
+            self._responses[url] = (version, body, mimetype)
+            self._responses.move_to_end(url)
+            if len(self._responses) > self.maxsize:
+                self._responses.popitem(last=False)
+
+    def __len__(self):
+        return len(self._responses)
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+
+response_cache = ResponseCache()
+
+
+def conditional(view):
+    """
+    Answers GETs with an ETag for the current project version: a 304 when
+    the browser already has it, otherwise the cached rendering if one was
+    made at this version, and only then the view itself.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != "GET":
+            return view(*args, **kwargs)
+
+        with project_engine().connect() as db:
+            version = Version.current(db)
+
+        etag = f"{g.project_name}-{version}"
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        elif hit := response_cache.get(request.full_path, version):
+            response = make_response(hit[0])
+            response.mimetype = hit[1]
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.put(
+                    request.full_path,
+                    version,
+                    response.get_data(),
+                    response.mimetype,
+                )
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    return wrapper
+
+
+def page_args():
+    """Keyset pagination and filters shared by the listing routes."""
+    stale = request.args.get("stale")
+    return {
+        "after": request.args.get("after", 0, type=int),
+        "limit": page_size(request.args.get("limit", PAGE_SIZE, type=int)),
+        "stale": None if stale is None else stale == "yes",
+    }
+
+
+def next_page(endpoint, rows, page):
+    """The url for the page after `rows`, if there might be one."""
+    if not rows or len(rows) < page["limit"]:
+        return None
+
+    return url_for(endpoint, **{**request.args, "after": rows[-1].id})
+
+
+@project.route("/")
 def index():
-    return render_template("index.html", current_project=project_name)
+    return render_template("index.html", current_project=project_title())
 
 
-@app.route("/sentences", methods=["GET", "POST"])
+@project.route("/sentences", methods=["GET", "POST"])
+@conditional
 def sentences():
     if (phrase_id := request.args.get("inline_add_for")):
         return render_template("sentence_inline_add.html", phrase_id=phrase_id)
 
-    with engine.connect() as db:
+    analyzed = request.method == "POST" and request.args.get("analyze")
+    with project_work() as db:
         if request.method == "POST":
             words = request.form.get("words")
             sentence_id = Sentence().new(words, db)
-            sentence = Sentence().get(sentence_id, db)
 
-            if request.args.get("analyze"):
-                return render_template(
-                    "sentence.html",
-                    sentence=sentence,
-                    phrases=[],
-                    current_project=project_name,
-                )
+        page = page_args()
+        more = None
+        if analyzed:
+            sentence = Sentence().get(sentence_id, db)
+            analysis = Analysis.get(sentence_id, db)
+        elif request.method == "POST":
+            # The new sentence is the newest, so it's on the last page.
+            sentences = Sentence().last_page(db, page["limit"])
+        else:
+            sentences = Sentence().page(db, **page)
+            more = next_page("project.sentences", sentences, page)
+
+    if analyzed:
+        return render_template(
+            "sentence.html",
+            sentence=sentence,
+            phrases=[],
+            suggestions=nlp.suggestions(sentence, [], analysis),
+            current_project=project_title(),
+        )
 
-        sentences = Sentence().all(db)
+    if "after" in request.args:
+        return render_template(
+            "sentence_rows.html", sentences=sentences, next_page=more
+        )
 
     return render_template(
-        "sentences.html", sentences=sentences, current_project=project_name
+        "sentences.html",
+        sentences=sentences,
+        next_page=more,
+        current_project=project_title(),
     )
 
 
-@app.route("/sentences/<sentence_id>", methods=["GET", "PUT", "DELETE"])
+@project.route("/sentences/<sentence_id>", methods=["GET", "PUT", "DELETE"])
+@conditional
 def sentence(sentence_id):
-    with engine.connect() as db:
+    with project_work() as db:
+        if request.args.get("inline") == "yes":
+            # Rows refetch themselves through here when the change feed
+            # says they changed, and a deleted one swaps in as nothing.
+            sentence = Sentence().get(sentence_id, db)
+            if sentence is None:
+                return ""
+            return render_template("sentence_inline.html", sentence=sentence)
+
         if request.args.get("edit"):
             sentence = Sentence().get(sentence_id, db)
             return render_template(
                 "sentence_edit.html",
                 sentence=sentence,
                 phrases=[],
-                current_project=project_name,
+                current_project=project_title(),
             )
 
         if request.method == "DELETE":
@@ -85,14 +298,63 @@ def sentence(sentence_id):
 
         sentence = Sentence().get(sentence_id, db)
         phrases = Phrase().get_for_sentence(sentence_id, db)
+        analysis = Analysis.get(sentence_id, db)
 
-        return render_template(
-            "sentence.html",
-            sentence=sentence,
-            phrases=phrases,
-            current_project=project_name,
+    return render_template(
+        "sentence.html",
+        sentence=sentence,
+        phrases=phrases,
+        suggestions=nlp.suggestions(sentence, phrases, analysis),
+        current_project=project_title(),
+    )
+
+
+@project.route("/sentences/<int:sentence_id>/diff")
+@conditional
+def sentence_diff(sentence_id):
+    """
+    ?old=<revision id>&new=<revision id> as JSON runs of words, so the page
+    needn't fetch the whole history to show what changed. Both default to
+    the newest edit.
+    """
+    with project_work() as db:
+        diff = Sentence().diff(
+            sentence_id,
+            db,
+            old=request.args.get("old", type=int),
+            new=request.args.get("new", type=int),
         )
 
+    if diff is None:
+        abort(404)
+
+    return jsonify(diff)
+
+
+@project.route("/sentences/<int:sentence_id>/as_of")
+@conditional
+def sentence_as_of(sentence_id):
+    """The stack as it read at ?when=<ISO 8601 time>, as JSON."""
+    try:
+        when = as_of_timestamp(request.args.get("when", ""))
+    except ValueError:
+        abort(400)
+
+    with project_work() as db:
+        sentence = Sentence().get(sentence_id, db, as_of=when)
+
+    if sentence is None:
+        abort(404)
+
+    return jsonify(
+        {
+            "id": sentence.id,
+            "revision": sentence.sentence_id,
+            "words": sentence.words,
+            "as_of": when,
+        }
+    )
+
 
 def extract_phrase(parts: Iterator[tuple[str, str]]) -> tuple[int, str]:
     phrase_parts = []
@@ -107,41 +369,58 @@ def extract_phrase(parts: Iterator[tuple[str, str]]) -> tuple[int, str]:
             sentence_id = switch
 
     return sentence_id, " ".join(
-        [word.lower().strip(punctuation) for _, word in sorted(phrase_parts)]
+        [normalize(word) for _, word in sorted(phrase_parts)]
     )
 
 
-@app.route("/phrases/analysis", methods=["POST"])
+@project.route("/phrases/analysis", methods=["POST"])
 def analysis():
-    with engine.connect() as db:
+    with project_work() as db:
         sentence_id, phrase = extract_phrase(request.form.items())
 
         Phrase().new(sentence_id, phrase, db)
         phrases = Phrase().get_for_sentence(sentence_id, db)
 
         return render_template(
-            "phrases.html", phrases=phrases, current_project=project_name
+            "phrases.html", phrases=phrases, current_project=project_title()
         )
 
 
-@app.route("/phrases", methods=["GET", "POST"])
+@project.route("/phrases", methods=["GET", "POST"])
+@conditional
 def phrases():
     # This should have a query to provide an init and the
     # the plain function will just take a word, definition.
-    with engine.connect() as db:
+    with project_work() as db:
+        page = page_args()
         if request.method == "POST":
             words = request.form.get("words")
             Phrase().new(None, words, db)
+            # The new phrase is the newest, so it's on the last page.
+            phrases = Phrase().last_page(db, page["limit"])
+            more = None
+        else:
+            status = request.args.get("status")
+            phrases = Phrase().page(db, status=status, **page)
+            more = next_page("project.phrases", phrases, page)
+
+        if "after" in request.args:
+            return render_template(
+                "phrase_rows.html", phrases=phrases, next_page=more
+            )
 
-        phrases = Phrase().all(db)
         return render_template(
-            "phrases.html", phrases=phrases, current_project=project_name
+            "phrases.html",
+            phrases=phrases,
+            next_page=more,
+            current_project=project_title(),
         )
 
 
-@app.route("/phrases/<phrase_id>", methods=["GET", "DELETE", "PUT"])
+@project.route("/phrases/<phrase_id>", methods=["GET", "DELETE", "PUT"])
+@conditional
 def phrase(phrase_id):
-    with engine.connect() as db:
+    with project_work() as db:
         if request.method == "DELETE":
             Phrase().delete(phrase_id, db)
             return ""
@@ -160,7 +439,7 @@ def phrase(phrase_id):
                     "sentence.html",
                     sentence=sentence,
                     phrases=phrases,
-                    current_project=project_name,
+                    current_project=project_title(),
                 )
 
             notes = request.form.get("notes", "")
@@ -173,23 +452,26 @@ def phrase(phrase_id):
             return render_template(
                 "phrase.html",
                 phrase=phrase,
-                current_project=project_name,
+                occurrences=Phrase().occurrences(phrase_id, db),
+                current_project=project_title(),
                 notes=clean_and_render_markup(phrase.notes),
             )
 
         phrase = Phrase().get(phrase_id, db)
         if request.args.get("inline") == "yes":
+            if phrase is None:
+                return ""
             return render_template(
                 "phrase_inline.html",
                 phrase=phrase,
-                current_project=project_name,
+                current_project=project_title(),
             )
 
         if request.args.get("inline_edit") == "yes":
             return render_template(
                 "phrase_inline_edit.html",
                 phrase=phrase,
-                current_project=project_name,
+                current_project=project_title(),
             )
 
         if request.args.get("rephrase") == "yes":
@@ -198,25 +480,26 @@ def phrase(phrase_id):
                 "sentence_rephrase_edit_controls.html",
                 phrase=phrase,
                 sentence=sentence,
-                current_project=project_name,
+                current_project=project_title(),
             )
         if request.args.get("edit") == "yes":
             return render_template(
-                "phrase_edit.html", phrase=phrase, current_project=project_name
+                "phrase_edit.html", phrase=phrase, current_project=project_title()
             )
 
         return render_template(
             "phrase.html",
             phrase=phrase,
-            current_project=project_name,
+            occurrences=Phrase().occurrences(phrase_id, db),
+            current_project=project_title(),
             notes=clean_and_render_markup(phrase.notes),
         )
 
 
-@app.route("/definitions", methods=["POST"])
+@project.route("/definitions", methods=["POST"])
 def definitions():
     acceptable_statuses = {"NEW", "EXPLORING", "ACCEPTED", "STUCK"}
-    with engine.connect() as db:
+    with project_work() as db:
         if request.method == "POST":
             phrase_id = request.form.get("phrase_id")
             words = request.form.get("definition")
@@ -226,7 +509,7 @@ def definitions():
                 return render_template(
                     "error_row.html",  # This doesn't exist.
                     phrase_id=phrase_id,
-                    current_project=project_name,
+                    current_project=project_title(),
                 )
 
             if words:  # If the string is None or blank, don't save it.
@@ -241,24 +524,221 @@ def definitions():
                     phrase=phrase,
                 )
 
-            return redirect(f"/phrases/{phrase_id}?inline=yes")
+            return redirect(
+                url_for("project.phrase", phrase_id=phrase_id, inline="yes")
+            )
 
     return abort(404)
 
 
-@app.route("/help")
+@project.route("/search")
+@conditional
+def search():
+    terms = request.args.get("q", "")
+    with project_work() as db:
+        results = Search.query(terms, db)
+
+    if request.args.get("results") == "yes":
+        return render_template(
+            "search_results.html", results=results, terms=terms
+        )
+
+    return render_template(
+        "search.html",
+        results=results,
+        terms=terms,
+        current_project=project_title(),
+    )
+
+
+@project.route("/help")
 def help():
-    return render_template("help.html", current_project=project_name)
+    return render_template("help.html", current_project=project_title())
+
+
+def graph_args():
+    """
+    Read ?center=s12&depth=2 for a neighborhood of the graph, or nothing
+    for the whole thing.
+    """
+    if (center := request.args.get("center")) is None:
+        return None
+
+    try:
+        center = Graph.parse_node_id(center)
+    except ValueError:
+        abort(400)
+
+    return {
+        "center": center,
+        "depth": request.args.get("depth", 2, type=int),
+        "max_nodes": request.args.get("max_nodes", MAX_NODES, type=int),
+        "max_edges": request.args.get("max_edges", MAX_EDGES, type=int),
+    }
+
+
+def graph_items(db, args):
+    if args is None:
+        return Graph.stream_graph(db)
 
+    return Graph.stream_neighborhood(db=db, **args)
 
-@app.route("/graph/data")
+
+@project.route("/graph/data")
+@conditional
 def graph_data():
-    with engine.connect() as db:
-        graph = Graph.assemble_graph(db)
+    with project_work() as db:
+        graph = Graph.collect(graph_items(db, graph_args()))
 
         return jsonify(graph)
 
 
+@project.route("/graph/layout")
+@conditional
+def graph_positions():
+    """
+    Positions for every node of the whole graph, laid out here once per
+    project version, so the graph view can skip its own simulation.
+    """
+    # Imported here so the app starts without loading NumPy.
+    import graph_layout
+
+    with project_work() as db:
+        version = Version.current(db)
+        hit = graph_layout.layouts.get(g.project_name, version)
+        if hit is None:
+            graph = graph_layout.load_arrays(db)
+
+    # Laid out with the connection back in the pool, since it takes a
+    # while on a big project.
+    if hit is None:
+        hit = graph_layout.layouts.store(g.project_name, version, graph)
+    graph, positions = hit
+
+    return jsonify(graph_layout.layout_json(graph, positions, version))
+
+
+@project.route("/graph/analytics/<report>")
+@conditional
+def graph_report(report):
+    """
+    One of graph_analytics.REPORTS as JSON: summary, components, depth,
+    cycles, leaves or degrees. ?limit= caps the longer listings.
+    """
+    # Imported here so the app starts without loading NumPy.
+    import graph_analytics
+    import graph_layout
+
+    if report not in graph_analytics.REPORTS:
+        abort(404)
+    limit = max(
+        request.args.get("limit", graph_analytics.REPORT_LIMIT, type=int), 0
+    )
+
+    with project_work() as db:
+        version = Version.current(db)
+        analytics = graph_analytics.analytics_cache.get(g.project_name, version)
+        # The layout keeps the same arrays, so they're only loaded when
+        # neither has seen this version.
+        if analytics is None:
+            graph = graph_layout.layouts.arrays(g.project_name, version)
+            if graph is None:
+                graph = graph_layout.load_arrays(db)
+
+    if analytics is None:
+        analytics = graph_analytics.analytics_cache.store(
+            g.project_name, version, graph
+        )
+
+    return jsonify(
+        {"version": version, **graph_analytics.REPORTS[report](analytics, limit)}
+    )
+
+
+@project.route("/graph/stream")
+def graph_stream():
+    """
+    The same graph as /graph/data, streamed as newline delimited JSON so
+    the browser can start drawing before the whole project is read.
+    """
+    args = graph_args()
+    engine = project_engine()
+
+    def generate(lines_per_chunk=500):
+        with unit_of_work(engine) as db:
+            chunk = []
+            for item in graph_items(db, args):
+                chunk.append(json.dumps(item))
+                if len(chunk) == lines_per_chunk:
+                    yield "\n".join(chunk) + "\n"
+                    chunk = []
+            if chunk:
+                yield "\n".join(chunk) + "\n"
+
+    return app.response_class(generate(), mimetype="application/x-ndjson")
+
+
+@project.route("/events")
+def events():
+    """
+    Changes to the project as server-sent events, see change_feed. The
+    browser resends the last id it saw as Last-Event-ID on reconnecting.
+    """
+    after = request.headers.get("Last-Event-ID", type=int)
+    named = request.args.get("format") != "graph"
+
+    return app.response_class(
+        change_feed.stream(project_engine(), after=after, named=named),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/metrics")
+def metrics_text():
+    return app.response_class(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+@app.route("/")
+def home():
+    """The default project from project_conf.json, if there is one."""
+    default = project_conf().get("current_project")
+    with project_registry().connect() as db:
+        if default and Project.get_by_name(default, db) is not None:
+            return redirect(url_for("project.index", project_name=default))
+
+    return redirect(url_for("projects"))
+
+
+@app.route("/projects")
+def projects():
+    with project_registry().connect() as db:
+        projects = Project.all(db)
+
+    return render_template("projects.html", projects=projects)
+
+
+@app.route("/<path:path>", methods=["GET", "POST", "PUT", "DELETE"])
+def default_project(path):
+    """Links from before projects had their own urls go to the default."""
+    default = project_conf().get("current_project")
+    if not default:
+        abort(404)
+
+    url = f"{url_for('project.index', project_name=default)}{path}"
+    if request.query_string:
+        url = f"{url}?{request.query_string.decode()}"
+
+    return redirect(url, 308)
+
+
+app.register_blueprint(project)
+metrics.install(app)
+metrics.name_statements(Statements, user_models.Statements)
+
+
 if __name__ == "__main__":
     import sys
     from ferdinand_admin import banner_name
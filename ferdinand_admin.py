@@ -1,9 +1,12 @@
 from pathlib import Path
+from datetime import datetime
 import json
 import sys
-import os
 import argparse
-from sqlalchemy import create_engine, text
+
+# SQLAlchemy, transfer and nlp are imported inside the commands that use
+# them, so --version and switching projects don't wait on them.
+from database import PROJECT_NAME, PROJECTS_PATH, create_project_engine
 
 
 __version__ = "0.0.0"
@@ -21,8 +24,31 @@ d88P"                      888 Y8P                                 888
 """
 
 
-PROJECTS_PATH = Path.cwd() / "projects"
 SQL_INIT = Path.cwd() / "sql"
+MIGRATIONS_PATH = SQL_INIT / "migrations"
+
+# The tables every project starts with, before any migrations run.
+SCHEMA = [
+    "definitions.sql",
+    "notes.sql",
+    "phrases.sql",
+    "sentences.sql",
+    "stacks.sql",
+]
+
+# Applied in order, each one bumping the database's 'PRAGMA user_version'
+# so a project only ever runs the migrations it hasn't seen yet.
+MIGRATIONS = [
+    "0001_stack_heads.sql",
+    "0002_foreign_key_indexes.sql",
+    "0003_project_version.sql",
+    "0004_search.sql",
+    "0005_token_index.sql",
+    "0006_analyses.sql",
+    "0007_revision_deltas.sql",
+    "0008_revision_time.sql",
+    "0009_events.sql",
+]
 
 
 def update_config(project_name):
@@ -45,28 +71,96 @@ def create_new_project(project_name):
         )
         sys.exit(0)
 
-    if len(project_name.split()) > 1:
-        print("""ERROR: Project name cannot include spaces, use '_' instead.""")
+    if not PROJECT_NAME.fullmatch(project_name):
+        print(
+            """ERROR: Project names can only use letters, numbers, '_' and '-'."""
+        )
         sys.exit(0)
 
     # set the configuration up
     update_config(project_name)
 
     # set up the sqlite db
-    db = create_engine(f"sqlite:///projects/{project_name}.sqlite3")
-    
+    db = create_project_engine(project_name)
+
     # create all database tables
     with db.connect() as conn:
-        for file in [
-            "definitions.sql",
-            "notes.sql",
-            "phrases.sql",
-            "sentences.sql",
-            "stacks.sql",
-        ]:
-            with open(SQL_INIT / file) as f:
-                conn.execute(text(f.read()))
-                conn.commit()
+        create_schema(conn)
+
+    register_project(project_name)
+
+
+def register_project(project_name):
+    """Adds the project to the registry the web app serves projects from."""
+    from phrase_models import unit_of_work
+    from user_models import Project, open_registry
+
+    with unit_of_work(open_registry(), write=True) as registry:
+        Project.register(project_name, registry)
+
+
+def create_schema(conn):
+    from sqlalchemy import text
+
+    for file in SCHEMA:
+        with open(SQL_INIT / file) as f:
+            conn.execute(text(f.read()))
+            conn.commit()
+
+    migrate(conn)
+
+
+def backfill_token_index(raw):
+    """Tokens are normalized in python, so the index can't be filled in sql."""
+    from phrase_models import postings
+
+    heads = raw.execute(
+        "select stacks.id, sentences.words from stacks "
+        "join sentences on sentences.id = stacks.head_sentence_id;"
+    )
+    raw.executemany(
+        "insert into tokens (token, stack_id, position) "
+        "values (:token, :stack_id, :position);",
+        (
+            row
+            for stack_id, words in heads
+            for row in postings(stack_id, words or "")
+        ),
+    )
+
+
+# Python steps that run after a migration's sql, in the same transaction.
+BACKFILLS = {
+    "0005_token_index.sql": backfill_token_index,
+}
+
+
+def migrate(conn):
+    """
+    Bring a project database up to the latest schema version. Each
+    migration runs in its own transaction along with the version bump, so
+    a failure leaves the database at the last good version.
+    """
+    from sqlalchemy import text
+
+    version = conn.execute(text("PRAGMA user_version;")).scalar()
+    conn.commit()
+
+    raw = conn.connection.driver_connection
+    for number, file in enumerate(MIGRATIONS[version:], version + 1):
+        with open(MIGRATIONS_PATH / file) as f:
+            script = f.read()
+        try:
+            raw.executescript(f"begin;\n{script}")
+            if backfill := BACKFILLS.get(file):
+                backfill(raw)
+            raw.execute(f"pragma user_version = {number};")
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+
+    return len(MIGRATIONS)
 
 
 def switch_to_project(project_name):
@@ -76,11 +170,11 @@ def switch_to_project(project_name):
         print(
             """ERROR: Project name doesn't match a project in your projects folder."""
         )
-        projects = os.listdir(PROJECTS_PATH)
+        projects = sorted(PROJECTS_PATH.glob("*.sqlite3"))
         if projects:
             print("Projects available:")
             for db in projects:
-                print(f"    - {Path(db).stem}")
+                print(f"    - {db.stem}")
 
         print(
             """If you're trying to start a new project, provide the -n or --new flag."""
@@ -91,6 +185,113 @@ def switch_to_project(project_name):
     update_config(project_name)
 
 
+def open_project(project_name):
+    db_path = PROJECTS_PATH / f"{project_name}.sqlite3"
+
+    if not db_path.exists():
+        print(
+            """ERROR: Project name doesn't match a project in your projects folder."""
+        )
+        sys.exit(0)
+
+    return create_project_engine(project_name)
+
+
+def migrate_project(project_name):
+    from sqlalchemy import text
+
+    db = open_project(project_name)
+
+    with db.connect() as conn:
+        before = conn.execute(text("PRAGMA user_version;")).scalar()
+        conn.commit()
+        after = migrate(conn)
+
+    if before == after:
+        print(f"{project_name} is up to date (schema version {after}).")
+    else:
+        print(f"Migrated {project_name} from schema version {before} to {after}.")
+
+
+def import_file(project_name, file, batch_size):
+    from transfer import import_corpus
+
+    if not file.exists():
+        print(f"""ERROR: There's no file at {file}.""")
+        sys.exit(0)
+
+    db = open_project(project_name)
+    try:
+        imported = import_corpus(file, db, batch_size=batch_size)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(0)
+
+    print(f"Imported {imported} sentences into {project_name}.")
+
+
+def export_project(project_name, output, as_snapshot):
+    from transfer import export_jsonl, snapshot
+
+    db = open_project(project_name)
+
+    if as_snapshot:
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        output = output or Path.cwd() / f"{project_name}_{stamp}.sqlite3"
+        snapshot(db, output)
+        print(f"Saved a snapshot of {project_name} to {output}.")
+    elif output is None:
+        export_jsonl(db, sys.stdout)
+    else:
+        with open(output, "w", encoding="utf-8") as f:
+            written = export_jsonl(db, f)
+        print(f"Exported {written} records from {project_name} to {output}.")
+
+
+def compact_project(project_name, vacuum):
+    from phrase_models import Sentence, Statements, unit_of_work
+
+    db = open_project(project_name)
+    path = PROJECTS_PATH / f"{project_name}.sqlite3"
+    before = path.stat().st_size
+
+    compacted, after = 0, 0
+    while True:
+        with unit_of_work(db, write=True) as conn:
+            stacks = conn.execute(
+                Statements.stacks_to_compact, {"after": after, "limit": 500}
+            ).scalars().all()
+            for stack_id in stacks:
+                compacted += Sentence().compact(stack_id, conn)
+        if not stacks:
+            break
+        after = stacks[-1]
+
+    # The freed pages only come back to the file system with a vacuum.
+    if vacuum:
+        with db.connect() as conn:
+            conn.exec_driver_sql("vacuum;")
+            conn.exec_driver_sql("pragma wal_checkpoint(truncate);")
+
+    print(
+        f"Compacted {compacted} revisions in {project_name}: "
+        f"{before // 1024} KiB -> {path.stat().st_size // 1024} KiB."
+    )
+
+
+def analyze_sentences(project_name, batch_size, processes):
+    from nlp import analyze_project
+
+    db = open_project(project_name)
+    try:
+        analyzed = analyze_project(db, batch_size=batch_size, n_process=processes)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        sys.exit(0)
+
+    print(f"Analyzed {analyzed} sentences in {project_name}.")
+
+
 parser = argparse.ArgumentParser(
     prog="Ferdinand analysis tool",
     description=banner_name,
@@ -115,11 +316,107 @@ parser.add_argument(
     help="Create a new project with the project name provided.",
 )
 
+parser.add_argument(
+    "-m",
+    "--migrate",
+    action="store_true",
+    help="Apply any missing schema migrations to the project provided.",
+)
+
+
+# Subcommands that work on a project without switching to it, e.g.
+# 'ferdinand_admin import <project> <file>'.
+command_parser = argparse.ArgumentParser(
+    prog="Ferdinand analysis tool",
+    description=banner_name,
+)
+commands = command_parser.add_subparsers(dest="command", required=True)
+
+import_parser = commands.add_parser(
+    "import",
+    help="Bulk load sentences and phrases from a .txt, .md, .csv or .jsonl file.",
+)
+import_parser.add_argument("project_name", help="The project to import into.")
+import_parser.add_argument("file", type=Path, help="The file to import.")
+import_parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=5_000,
+    help="Sentences written per transaction.",
+)
+import_parser.set_defaults(
+    run=lambda ns: import_file(ns.project_name, ns.file, ns.batch_size)
+)
+
+export_parser = commands.add_parser(
+    "export",
+    help="Export a project as JSON lines, or as a SQLite snapshot with --snapshot.",
+)
+export_parser.add_argument("project_name", help="The project to export.")
+export_parser.add_argument(
+    "-o",
+    "--output",
+    type=Path,
+    help="Where to write the export. JSON lines go to stdout by default.",
+)
+export_parser.add_argument(
+    "--snapshot",
+    action="store_true",
+    help="Copy the whole database with SQLite's online backup instead.",
+)
+export_parser.set_defaults(
+    run=lambda ns: export_project(ns.project_name, ns.output, ns.snapshot)
+)
+
+compact_parser = commands.add_parser(
+    "compact",
+    help="Store older sentence revisions as compressed deltas.",
+)
+compact_parser.add_argument("project_name", help="The project to compact.")
+compact_parser.add_argument(
+    "--no-vacuum",
+    dest="vacuum",
+    action="store_false",
+    help="Skip the vacuum that returns the freed space to the disk.",
+)
+compact_parser.set_defaults(
+    run=lambda ns: compact_project(ns.project_name, ns.vacuum)
+)
+
+analyze_parser = commands.add_parser(
+    "analyze",
+    help="Tokenize, lemmatize and find phrase suggestions for every sentence not yet analyzed.",
+)
+analyze_parser.add_argument("project_name", help="The project to analyze.")
+analyze_parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=256,
+    help="Sentences spaCy parses, and the project commits, at a time.",
+)
+analyze_parser.add_argument(
+    "--processes",
+    type=int,
+    default=1,
+    help="Worker processes for spaCy, -1 for one per CPU.",
+)
+analyze_parser.set_defaults(
+    run=lambda ns: analyze_sentences(ns.project_name, ns.batch_size, ns.processes)
+)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in commands.choices:
+        namespace = command_parser.parse_args(argv)
+        namespace.run(namespace)
+        return
 
-def main():
-    namespace = parser.parse_args()
+    namespace = parser.parse_args(argv)
     if namespace.new:
         create_new_project(namespace.project_name)
+    elif namespace.migrate:
+        migrate_project(namespace.project_name)
     else:
         switch_to_project(namespace.project_name)
 
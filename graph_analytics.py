@@ -0,0 +1,340 @@
+"""
+The graph read as a dependency graph of definitions: a phrase depends on
+the sentence defining it, and a sentence on the phrases found in it,
+which are the directions of graph_layout's edges.
+
+Everything here is computed in one linear pass per kind over CSR
+adjacency built from those arrays, and kept per project with the version
+it was computed at. Phrases are reported by their stamped ids ('p12'),
+like the rest of the graph routes.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple
+
+import numpy as np
+
+from graph_layout import GraphArrays
+
+
+ANALYTICS_CACHE_SIZE = 8
+# How many components and nodes the listings return unless asked.
+REPORT_LIMIT = 20
+
+
+class Analytics(NamedTuple):
+    graph: GraphArrays
+    components: np.ndarray
+    depths: np.ndarray
+    cycles: list[list[int]]
+    fan_in: np.ndarray
+    fan_out: np.ndarray
+
+
+def adjacency(n: int, sources: np.ndarray, targets: np.ndarray):
+    """
+    CSR adjacency: the neighbors of node i are
+    neighbors[offsets[i]:offsets[i + 1]].
+    """
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=offsets[1:])
+
+    return offsets.tolist(), targets[order].tolist()
+
+
+def components(graph: GraphArrays) -> np.ndarray:
+    """A component label per node, ignoring the direction of edges."""
+    n = graph.size
+    offsets, neighbors = adjacency(
+        n,
+        np.concatenate([graph.sources, graph.targets]),
+        np.concatenate([graph.targets, graph.sources]),
+    )
+    labels = [-1] * n
+    label = 0
+    for root in range(n):
+        if labels[root] != -1:
+            continue
+        labels[root] = label
+        frontier = [root]
+        while frontier:
+            node = frontier.pop()
+            for other in neighbors[offsets[node] : offsets[node + 1]]:
+                if labels[other] == -1:
+                    labels[other] = label
+                    frontier.append(other)
+        label += 1
+
+    return np.array(labels, dtype=np.int64)
+
+
+def depths(graph: GraphArrays) -> np.ndarray:
+    """
+    The longest chain of dependencies below each node, in edges, by
+    Kahn's algorithm from the nodes that depend on nothing. Nodes on a
+    cycle, or depending on one, have no depth and get -1.
+    """
+    n = graph.size
+    offsets, dependents = adjacency(n, graph.targets, graph.sources)
+    waiting = np.bincount(graph.sources, minlength=n).tolist()
+    depth = [0] * n
+    ready = [node for node in range(n) if not waiting[node]]
+    done = [False] * n
+    while ready:
+        node = ready.pop()
+        done[node] = True
+        for other in dependents[offsets[node] : offsets[node + 1]]:
+            depth[other] = max(depth[other], depth[node] + 1)
+            waiting[other] -= 1
+            if not waiting[other]:
+                ready.append(other)
+
+    return np.where(done, depth, -1)
+
+
+def cycles(graph: GraphArrays, candidates: np.ndarray) -> list[list[int]]:
+    """
+    The strongly connected components with more than one node, by an
+    iterative Tarjan's algorithm. Only `candidates` can be on a cycle,
+    which depths has already narrowed down to the nodes it couldn't
+    reach.
+    """
+    n = graph.size
+    offsets, neighbors = adjacency(n, graph.sources, graph.targets)
+    allowed = np.zeros(n, dtype=bool)
+    allowed[candidates] = True
+    allowed = allowed.tolist()
+
+    index, low = [-1] * n, [0] * n
+    on_stack = [False] * n
+    stack, found = [], []
+    counter = 0
+    for root in candidates.tolist():
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [[root, offsets[root]]]
+        while work:
+            node, at = work[-1]
+            if at < offsets[node + 1]:
+                work[-1][1] += 1
+                other = neighbors[at]
+                if not allowed[other]:
+                    continue
+                if index[other] == -1:
+                    index[other] = low[other] = counter
+                    counter += 1
+                    stack.append(other)
+                    on_stack[other] = True
+                    work.append([other, offsets[other]])
+                elif on_stack[other]:
+                    low[node] = min(low[node], index[other])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                component = []
+                while True:
+                    other = stack.pop()
+                    on_stack[other] = False
+                    component.append(other)
+                    if other == node:
+                        break
+                if len(component) > 1:
+                    found.append(sorted(component))
+
+    return found
+
+
+def analyze(graph: GraphArrays) -> Analytics:
+    node_depths = depths(graph)
+    return Analytics(
+        graph=graph,
+        components=components(graph),
+        depths=node_depths,
+        cycles=cycles(graph, np.flatnonzero(node_depths < 0)),
+        fan_in=np.bincount(graph.targets, minlength=graph.size),
+        fan_out=np.bincount(graph.sources, minlength=graph.size),
+    )
+
+
+def node_id(graph: GraphArrays, node: int) -> str:
+    if node < len(graph.sentences):
+        return f"s{graph.sentences[node]}"
+    return f"p{graph.phrases[node - len(graph.sentences)]}"
+
+
+def definition_depth(depth: int) -> int | None:
+    """
+    A phrase's depth in definitions rather than edges: 0 when it isn't
+    defined, 1 when its definition only uses undefined phrases or none.
+    """
+    return None if depth < 0 else (depth + 1) // 2
+
+
+class AnalyticsCache:
+    """
+    Each project's analytics and the version they were computed at,
+    dropping the least recently used project past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = ANALYTICS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._analytics: OrderedDict[str, tuple[int, Analytics]] = (
+            OrderedDict()
+        )
+        self._lock = Lock()
+
+    def get(self, project_name: str, version: int) -> Analytics | None:
+        with self._lock:
+            hit = self._analytics.get(project_name)
+            if hit is None or hit[0] != version:
+                return None
+            self._analytics.move_to_end(project_name)
+            return hit[1]
+
+    def store(
+        self, project_name: str, version: int, graph: GraphArrays
+    ) -> Analytics:
+        """Analyzes `graph`, which is slow, so hold no connection for it."""
+        analytics = analyze(graph)
+
+        with self._lock:
+            self._analytics[project_name] = (version, analytics)
+            self._analytics.move_to_end(project_name)
+            if len(self._analytics) > self.maxsize:
+                self._analytics.popitem(last=False)
+
+        return analytics
+
+    def clear(self):
+        with self._lock:
+            self._analytics.clear()
+
+
+analytics_cache = AnalyticsCache()
+
+
+def summary(analytics: Analytics, limit: int) -> dict:
+    graph = analytics.graph
+    phrases = slice(len(graph.sentences), None)
+    sizes = np.bincount(analytics.components)
+
+    return {
+        "nodes": graph.size,
+        "edges": len(graph.sources),
+        "components": len(sizes),
+        "largest_component": int(sizes.max(initial=0)),
+        "max_depth": definition_depth(
+            int(analytics.depths[phrases].max(initial=0))
+        ),
+        "cycles": len(analytics.cycles),
+        "undefined": int((analytics.fan_out[phrases] == 0).sum()),
+    }
+
+
+def component_report(analytics: Analytics, limit: int) -> dict:
+    """The largest components first, with their nodes."""
+    graph = analytics.graph
+    sizes = np.bincount(analytics.components)
+    largest = np.argsort(-sizes, kind="stable")[:limit]
+    order = np.argsort(analytics.components, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+    return {
+        "count": len(sizes),
+        "components": [
+            {
+                "size": int(sizes[label]),
+                "nodes": [
+                    node_id(graph, node)
+                    for node in order[starts[label] : starts[label + 1]]
+                ],
+            }
+            for label in largest
+        ],
+    }
+
+
+def depth_report(analytics: Analytics, limit: int) -> dict:
+    """
+    The `limit` deepest phrases, in definitions. Phrases on or above a
+    circular definition have no depth and come last.
+    """
+    graph = analytics.graph
+    offset = len(graph.sentences)
+    depths = analytics.depths[offset:]
+    order = np.argsort(-depths, kind="stable")[:limit]
+
+    return {
+        "max_depth": definition_depth(int(depths.max(initial=0))),
+        "phrases": [
+            {
+                "id": node_id(graph, offset + node),
+                "depth": definition_depth(int(depths[node])),
+            }
+            for node in order
+        ],
+    }
+
+
+def cycle_report(analytics: Analytics, limit: int) -> dict:
+    """
+    Circular definitions, the largest first, each as the nodes that go
+    round it.
+    """
+    graph = analytics.graph
+    largest = sorted(analytics.cycles, key=len, reverse=True)[:limit]
+
+    return {
+        "count": len(analytics.cycles),
+        "cycles": [[node_id(graph, node) for node in cycle] for cycle in largest],
+    }
+
+
+def leaf_report(analytics: Analytics, limit: int) -> dict:
+    """Phrases with no definition, which everything else bottoms out in."""
+    graph = analytics.graph
+    offset = len(graph.sentences)
+    leaves = np.flatnonzero(analytics.fan_out[offset:] == 0) + offset
+
+    return {
+        "count": len(leaves),
+        "undefined": [node_id(graph, node) for node in leaves[:limit]],
+    }
+
+
+def degree_report(analytics: Analytics, limit: int) -> dict:
+    """
+    The nodes most depended on (fan in) and depending on the most (fan
+    out). For a phrase, fan in counts the sentences it's found in.
+    """
+    graph = analytics.graph
+
+    def top(degrees):
+        order = np.argsort(-degrees, kind="stable")[:limit]
+        return [
+            {"id": node_id(graph, node), "count": int(degrees[node])}
+            for node in order
+            if degrees[node]
+        ]
+
+    return {"fan_in": top(analytics.fan_in), "fan_out": top(analytics.fan_out)}
+
+
+REPORTS = {
+    "summary": summary,
+    "components": component_report,
+    "depth": depth_report,
+    "cycles": cycle_report,
+    "leaves": leaf_report,
+    "degrees": degree_report,
+}
@@ -0,0 +1,312 @@
+"""
+Positions for the graph view, worked out on the server so the browser can
+draw a big project without running a force simulation of its own.
+
+The graph is loaded as integer arrays rather than a dict per node:
+sentences are nodes 0..S-1 in stack id order, phrases follow them in
+phrase id order, and edges are pairs of node indices. The layout is
+Fruchterman-Reingold done a block of nodes at a time in NumPy. Layouts
+are kept per project with the version they were made at, and a new
+version starts from the last one's positions, so it settles quickly and
+nodes stay where the reader last saw them.
+"""
+
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+from typing import NamedTuple
+
+import numpy as np
+from sqlalchemy import Connection
+
+from phrase_models import Statements
+
+
+# The viewBox of the graph view.
+WIDTH, HEIGHT = 1200, 525
+MARGIN = 20
+
+ITERATIONS = 80
+# Iterations for a layout that starts from the previous version's.
+WARM_ITERATIONS = 20
+# Up to this many nodes every pair repels; past it, nodes are repelled
+# by the centers of mass of the cells of a GRID x GRID grid instead.
+EXACT_NODES = 2_000
+GRID = 32
+# Rows per block, bounding the (block, bodies) arrays repulsion makes.
+BLOCK = 1024
+# Pull toward the middle, in proportion to the distance from it, which
+# keeps separate components from drifting apart.
+GRAVITY = 1.0
+
+LAYOUT_CACHE_SIZE = 8
+
+
+class GraphArrays(NamedTuple):
+    sentences: np.ndarray
+    phrases: np.ndarray
+    sources: np.ndarray
+    targets: np.ndarray
+
+    @property
+    def size(self) -> int:
+        return len(self.sentences) + len(self.phrases)
+
+
+def lookup(ids: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+    """The index of each of `wanted` in the sorted `ids`, or -1."""
+    if not len(ids):
+        return np.full(len(wanted), -1)
+
+    at = np.minimum(np.searchsorted(ids, wanted), len(ids) - 1)
+    return np.where(ids[at] == wanted, at, -1)
+
+
+def id_array(rows, columns: int) -> np.ndarray:
+    """Integer rows straight off a cursor, as a (rows, columns) array."""
+    values = np.fromiter(chain.from_iterable(rows), dtype=np.int64)
+    return values.reshape(-1, columns) if columns > 1 else values
+
+
+def load_arrays(db: Connection) -> GraphArrays:
+    """The same nodes and edges as Graph.stream_graph, as arrays."""
+    sentences = id_array(db.execute(Statements.graph_stack_ids), 1)
+    phrase_rows = id_array(db.execute(Statements.graph_phrase_ids), 2)
+    definitions = id_array(db.execute(Statements.graph_edges), 2)
+
+    phrases = phrase_rows[:, 0]
+    offset = len(sentences)
+
+    # Sentence to each phrase found in it, then phrase to the sentence
+    # defining it.
+    found_in = lookup(sentences, phrase_rows[:, 1])
+    defines = lookup(phrases, definitions[:, 0])
+    defined_by = lookup(sentences, definitions[:, 1])
+    sources = np.concatenate(
+        [found_in, np.where(defines < 0, -1, defines + offset)]
+    )
+    targets = np.concatenate([np.arange(len(phrases)) + offset, defined_by])
+    keep = (sources >= 0) & (targets >= 0)
+
+    return GraphArrays(
+        sentences,
+        phrases,
+        sources[keep].astype(np.int32),
+        targets[keep].astype(np.int32),
+    )
+
+
+def repulsion(positions: np.ndarray, k: float) -> np.ndarray:
+    """Every node's push away from the others, of k^2 / distance each."""
+    n = len(positions)
+    if n <= EXACT_NODES:
+        return pushes(positions, positions, np.ones(n), k, soften=0.01)
+
+    # Past EXACT_NODES the nodes are binned into a GRID x GRID grid, the
+    # push is worked out once at the center of mass of each filled cell
+    # from all of them, and every node takes its cell's push.
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    cell = np.maximum((high - low) / GRID, 1e-6)
+    cells = np.minimum((positions - low) // cell, GRID - 1).astype(int)
+    index = cells[:, 0] * GRID + cells[:, 1]
+    filled, index = np.unique(index, return_inverse=True)
+    masses = np.bincount(index).astype(float)
+    centers = np.stack(
+        [np.bincount(index, positions[:, axis]) for axis in (0, 1)], axis=1
+    ) / masses[:, None]
+
+    # A node sitting on its own cell's center would feel an infinite
+    # push, so near pushes are softened to the scale of a cell. Instead,
+    # each node is pushed off its cell's center by the rest of the cell,
+    # which keeps nodes that share a cell from moving as one.
+    soften = float((cell**2).sum()) / 4
+    far = pushes(centers, centers, masses, k, soften)[index]
+    delta = positions - centers[index]
+    distance2 = (delta**2).sum(axis=1) + 0.01
+    near = delta * ((masses[index] - 1) * k * k / distance2)[:, None]
+
+    return far + near
+
+
+def pushes(at, bodies, masses, k: float, soften: float) -> np.ndarray:
+    """
+    The push at each of `at` from `bodies`, BLOCK rows at a time. Writing
+    the sum over bodies of w * (a - b) as a * sum(w) - w @ b, with the
+    squared distances from a matrix product too, keeps it all in BLAS.
+    """
+    push = np.empty_like(at)
+    squares = (bodies**2).sum(axis=1)
+    for start in range(0, len(at), BLOCK):
+        block = at[start : start + BLOCK]
+        distance2 = (block**2).sum(axis=1)[:, None] + squares - 2 * block @ bodies.T
+        weights = masses * k * k / (np.maximum(distance2, 0) + soften)
+        push[start : start + BLOCK] = (
+            block * weights.sum(axis=1)[:, None] - weights @ bodies
+        )
+
+    return push
+
+
+def attraction(graph: GraphArrays, positions: np.ndarray, k: float):
+    """Each edge's pull on its two ends, of distance^2 / k."""
+    n = len(positions)
+    delta = positions[graph.targets] - positions[graph.sources]
+    distance = np.sqrt((delta**2).sum(axis=1)) + 1e-9
+    pull = delta * (distance / k)[:, None]
+
+    return np.stack(
+        [
+            np.bincount(graph.sources, pull[:, axis], n)
+            - np.bincount(graph.targets, pull[:, axis], n)
+            for axis in (0, 1)
+        ],
+        axis=1,
+    )
+
+
+def fit(positions: np.ndarray) -> np.ndarray:
+    """Scale and center positions into the view, keeping their aspect."""
+    if not len(positions):
+        return positions
+
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    span = np.maximum(high - low, 1e-9)
+    room = np.array([WIDTH, HEIGHT]) - 2 * MARGIN
+    scale = (room / span).min()
+    middle = (low + high) / 2
+
+    return (positions - middle) * scale + np.array([WIDTH, HEIGHT]) / 2
+
+
+def layout(
+    graph: GraphArrays,
+    start: np.ndarray | None = None,
+    iterations: int = ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    (x, y) for every node, in node order and within the view. Nodes with
+    a position in `start` begin there, and the rest at random.
+    """
+    n = graph.size
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(0, 1, (n, 2)) * np.array([WIDTH, HEIGHT])
+    if start is not None:
+        placed = ~np.isnan(start).any(axis=1)
+        positions[placed] = start[placed]
+    if n < 2:
+        return fit(positions)
+
+    k = np.sqrt(WIDTH * HEIGHT / n)
+    middle = np.array([WIDTH, HEIGHT]) / 2
+    temperature = WIDTH / 10
+    for step in range(iterations):
+        move = repulsion(positions, k) + attraction(graph, positions, k)
+        move -= GRAVITY * (positions - middle)
+        length = np.sqrt((move**2).sum(axis=1))[:, None] + 1e-9
+        cooled = temperature * (1 - step / iterations)
+        positions += move / length * np.minimum(length, cooled)
+
+    return fit(positions)
+
+
+def carry_over(
+    old: GraphArrays, positions: np.ndarray, new: GraphArrays
+) -> np.ndarray:
+    """
+    Starting positions for `new` from the layout of `old`. Nodes that are
+    new take the place of a node they share an edge with, when one had a
+    place, and NaN otherwise.
+    """
+    start = np.full((new.size, 2), np.nan)
+    for old_ids, new_ids, old_offset, new_offset in (
+        (old.sentences, new.sentences, 0, 0),
+        (old.phrases, new.phrases, len(old.sentences), len(new.sentences)),
+    ):
+        at = lookup(old_ids, new_ids)
+        kept = at >= 0
+        start[new_offset + np.flatnonzero(kept)] = positions[
+            at[kept] + old_offset
+        ]
+
+    for ends, others in ((new.sources, new.targets), (new.targets, new.sources)):
+        placed = ~np.isnan(start[others, 0]) & np.isnan(start[ends, 0])
+        start[ends[placed]] = start[others[placed]]
+
+    return start
+
+
+class LayoutCache:
+    """
+    The latest layout of each project and the version it was made at,
+    dropping the least recently used project past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = LAYOUT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._layouts: OrderedDict[str, tuple] = OrderedDict()
+        self._lock = Lock()
+
+    def get(
+        self, project_name: str, version: int
+    ) -> tuple[GraphArrays, np.ndarray] | None:
+        """The layout made at `version`, if it's the latest one kept."""
+        with self._lock:
+            last = self._layouts.get(project_name)
+            if last is None or last[0] != version:
+                return None
+            self._layouts.move_to_end(project_name)
+            return last[1], last[2]
+
+    def arrays(self, project_name: str, version: int) -> GraphArrays | None:
+        """The arrays the layout at `version` was made from, if kept."""
+        hit = self.get(project_name, version)
+        return None if hit is None else hit[0]
+
+    def store(
+        self, project_name: str, version: int, graph: GraphArrays
+    ) -> tuple[GraphArrays, np.ndarray]:
+        """
+        Lays `graph` out, starting from the project's last layout if there
+        is one, and keeps it as the layout at `version`. This is the slow
+        part, so it's meant to run with no connection held.
+        """
+        with self._lock:
+            last = self._layouts.get(project_name)
+
+        if last is None:
+            positions = layout(graph)
+        else:
+            start = carry_over(last[1], last[2], graph)
+            positions = layout(graph, start=start, iterations=WARM_ITERATIONS)
+
+        with self._lock:
+            self._layouts[project_name] = (version, graph, positions)
+            self._layouts.move_to_end(project_name)
+            if len(self._layouts) > self.maxsize:
+                self._layouts.popitem(last=False)
+
+        return graph, positions
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+
+
+layouts = LayoutCache()
+
+
+def layout_json(graph: GraphArrays, positions: np.ndarray, version: int):
+    """
+    The layout as flat lists: node i is sentences[i], or past those,
+    phrases[i - len(sentences)], and sits at (x[i], y[i]).
+    """
+    return {
+        "version": version,
+        "width": WIDTH,
+        "height": HEIGHT,
+        "sentences": graph.sentences.tolist(),
+        "phrases": graph.phrases.tolist(),
+        "x": positions[:, 0].round(1).tolist(),
+        "y": positions[:, 1].round(1).tolist(),
+    }
@@ -0,0 +1,226 @@
+"""
+Where the time goes: request latency and query counts per route, and
+timings per SQL statement, served at /metrics in Prometheus' text format.
+
+Counts live in the process, so under serve.py each worker reports its own.
+Statements that run slower than `slow_query_ms` are logged along with
+SQLite's EXPLAIN QUERY PLAN for them.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+import logging
+import time
+
+from flask import (
+    Flask,
+    current_app,
+    g,
+    has_app_context,
+    has_request_context,
+    request,
+)
+from sqlalchemy import Engine, event
+
+log = logging.getLogger("ferdinand.metrics")
+
+SLOW_QUERY_MS = 100
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """A Prometheus style histogram with one series per label set."""
+
+    def __init__(self, name: str, help: str, buckets: tuple, labels: tuple):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self._series: dict[tuple, list] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *labels: str):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(
+                labels, [[0] * (len(self.buckets) + 1), 0.0]
+            )
+            series[0][slot] += 1
+            series[1] += value
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for labels, (counts, total) in series:
+            pairs = [
+                f'{name}="{escape(value)}"'
+                for name, value in zip(self.labels, labels)
+            ]
+            running = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                running += count
+                le = ",".join([*pairs, f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {running}")
+            lines.append(f"{self.name}_sum{{{','.join(pairs)}}} {total}")
+            lines.append(f"{self.name}_count{{{','.join(pairs)}}} {running}")
+
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_seconds = Histogram(
+    "ferdinand_request_seconds",
+    "Time to answer a request, by route.",
+    REQUEST_BUCKETS,
+    ("route", "method", "status"),
+)
+request_queries = Histogram(
+    "ferdinand_request_queries",
+    "SQL statements run to answer a request, by route.",
+    COUNT_BUCKETS,
+    ("route", "method"),
+)
+query_seconds = Histogram(
+    "ferdinand_query_seconds",
+    "Time SQLite spent on a statement, by statement.",
+    QUERY_BUCKETS,
+    ("statement",),
+)
+HISTOGRAMS = (request_seconds, request_queries, query_seconds)
+
+# Statement names by the id of their compiled TextClause, so timings are
+# labeled 'get_phrase' rather than with the whole query.
+statement_names: dict[int, str] = {}
+
+
+def name_statements(*namespaces):
+    for namespace in namespaces:
+        for name, value in vars(namespace).items():
+            if not name.startswith("_"):
+                statement_names[id(value)] = name
+
+
+def statement_label(statement: str, context) -> str:
+    compiled = getattr(context, "compiled", None)
+    if compiled is not None and id(compiled.statement) in statement_names:
+        return statement_names[id(compiled.statement)]
+
+    words = statement.split()
+    return " ".join(words[:2]).lower().rstrip(";") if words else "unknown"
+
+
+def explain(cursor, statement: str, parameters) -> str:
+    """The query plan, read on a cursor of its own off the same connection."""
+    plan = cursor.connection.execute(
+        f"explain query plan {statement}", parameters
+    )
+    return "\n".join(f"  {row[-1]}" for row in plan.fetchall())
+
+
+def slow_query_threshold() -> float:
+    """
+    The threshold of the app handling the statement, if any. Statements
+    run outside an app, like the admin tool's, use the default.
+    """
+    if has_app_context():
+        return current_app.config.get("SLOW_QUERY_MS", SLOW_QUERY_MS)
+    return SLOW_QUERY_MS
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info["query_started"] = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - conn.info.pop("query_started")
+    label = statement_label(statement, context)
+    query_seconds.observe(elapsed, label)
+
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+
+    if elapsed * 1000 >= slow_query_threshold():
+        plan = ""
+        reads = statement.lstrip().lower().startswith(("select", "with"))
+        if reads and not many:
+            try:
+                plan = explain(cursor, statement, parameters)
+            except Exception as e:
+                plan = f"  (no plan: {e})"
+        log.warning(
+            "slow query %s took %.1fms\n%s\n%s",
+            label,
+            elapsed * 1000,
+            statement.strip(),
+            plan,
+        )
+
+
+def start_timer(endpoint=None, values=None):
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+
+
+def record_request(response):
+    if "request_started" not in g:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_seconds.observe(
+        time.perf_counter() - g.request_started,
+        route,
+        request.method,
+        str(response.status_code),
+    )
+    request_queries.observe(g.query_count, route, request.method)
+    return response
+
+
+def install(app: Flask, slow_query_ms: float | None = None):
+    """
+    Times every request to `app` and every statement on any engine. The
+    slow query threshold is kept in the app's config, so each app
+    installed on has its own.
+    """
+    if slow_query_ms is not None:
+        app.config["SLOW_QUERY_MS"] = slow_query_ms
+
+    if not event.contains(
+        Engine, "before_cursor_execute", before_cursor_execute
+    ):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    # As the app's url value preprocessor this runs before any blueprint's,
+    # so the project lookups in ferdinand's are timed and counted too.
+    app.url_value_preprocessor(start_timer)
+    app.after_request(record_request)
+
+
+def render() -> str:
+    return "\n".join(line for h in HISTOGRAMS for line in h.render()) + "\n"
+
+
+def clear():
+    for histogram in HISTOGRAMS:
+        histogram.clear()
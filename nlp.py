@@ -0,0 +1,190 @@
+"""
+Tokens, lemmas and phrase suggestions from spaCy.
+
+Nothing here imports spaCy until an analysis is actually asked for, so
+the web server starts as fast as it did without it, and the server
+never asks: pages only show analyses that `ferdinand_admin analyze` has
+stored. When spaCy or its model isn't installed, sentences just go
+without suggestions.
+"""
+
+from bisect import bisect_right
+from itertools import islice
+from threading import Lock
+from typing import Iterable, Iterator
+import re
+
+from sqlalchemy import Engine
+
+from phrase_models import Analysis, tokenize, unit_of_work
+
+
+MODEL = "en_core_web_sm"
+# The analyses only need tags, lemmas and the parse behind noun chunks.
+DISABLED = ["ner"]
+BATCH_SIZE = 256
+
+# Leading words dropped from a noun chunk before it's suggested, so
+# 'the global village' is suggested as 'global village'.
+CHUNK_PREFIXES = {"DET", "PRON", "PUNCT"}
+
+WORD = re.compile(r"\S+")
+
+
+class Pipeline:
+    """Loads the model the first time it's needed, at most once."""
+
+    def __init__(self, model: str = MODEL):
+        self.model = model
+        self._nlp = None
+        self._loaded = False
+        self._lock = Lock()
+
+    def load(self):
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                try:
+                    import spacy
+
+                    self._nlp = spacy.load(self.model, disable=DISABLED)
+                except (ImportError, OSError):
+                    self._nlp = None
+
+        return self._nlp
+
+    @property
+    def available(self) -> bool:
+        return self.load() is not None
+
+    @property
+    def name(self) -> str:
+        meta = self.load().meta
+        return f"{meta['lang']}_{meta['name']}-{meta['version']}"
+
+
+pipeline = Pipeline()
+
+
+def doc_analysis(doc) -> dict:
+    """
+    The tokens of a parsed sentence as [text, lemma, pos, word], where
+    `word` is the index of the whitespace separated word the token sits
+    in, which is how the sentence page numbers them. Noun chunks are kept
+    as [first word, last word] spans.
+    """
+    starts = [match.start() for match in WORD.finditer(doc.text)]
+
+    def word(token) -> int:
+        return bisect_right(starts, token.idx) - 1
+
+    tokens = [
+        [token.text, token.lemma_, token.pos_, word(token)] for token in doc
+    ]
+
+    chunks = []
+    for chunk in doc.noun_chunks:
+        span = list(chunk)
+        while span and span[0].pos_ in CHUNK_PREFIXES:
+            span = span[1:]
+        if span and (bounds := [word(span[0]), word(span[-1])]) not in chunks:
+            chunks.append(bounds)
+
+    return {"tokens": tokens, "chunks": chunks}
+
+
+def analyze(
+    sentences: Iterable[tuple[str, int]],
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+) -> Iterator[dict]:
+    """Analyses for (words, sentence_id) pairs, parsed in batches."""
+    nlp = pipeline.load()
+    name = pipeline.name
+    for doc, sentence_id in nlp.pipe(
+        sentences, as_tuples=True, batch_size=batch_size, n_process=n_process
+    ):
+        yield {"sentence_id": sentence_id, "model": name, **doc_analysis(doc)}
+
+
+def unanalyzed(engine: Engine, page_size: int) -> Iterator[tuple[str, int]]:
+    """
+    Every sentence revision without an analysis, read a page at a time in
+    short transactions so the writes in between aren't held up.
+    """
+    after = 0
+    while True:
+        with engine.connect() as db:
+            rows = Analysis.pending(db, after=after, limit=page_size)
+        if not rows:
+            return
+        yield from ((row.words or "", row.id) for row in rows)
+        after = rows[-1].id
+
+
+def analyze_project(
+    engine: Engine,
+    batch_size: int = BATCH_SIZE,
+    n_process: int = 1,
+    progress: bool = True,
+) -> int:
+    """
+    Analyzes every sentence revision that hasn't been yet, committing one
+    batch at a time. Returns how many were analyzed.
+    """
+    from tqdm import tqdm
+
+    if not pipeline.available:
+        raise RuntimeError(
+            f"Analyzing sentences needs spaCy and its '{MODEL}' model: "
+            f"python -m spacy download {MODEL}"
+        )
+
+    analyses = analyze(
+        unanalyzed(engine, page_size=batch_size * 4),
+        batch_size=batch_size,
+        n_process=n_process,
+    )
+    analyzed = 0
+
+    with tqdm(unit=" sentences", disable=not progress) as bar:
+        while batch := list(islice(analyses, batch_size)):
+            with unit_of_work(engine, write=True) as db:
+                Analysis.save(batch, db)
+            analyzed += len(batch)
+            bar.update(len(batch))
+
+    return analyzed
+
+
+def suggestions(sentence, phrases, analysis: dict | None) -> list[dict]:
+    """
+    Noun chunks from the sentence that aren't phrases yet, each with the
+    form fields that save it the way ticking its words would. `analysis`
+    is the stored one from Analysis.get. Pages never parse: a sentence
+    that analyze_project hasn't reached yet has no suggestions.
+    """
+    if analysis is None or "chunks" not in analysis:
+        return []
+
+    words = sentence.words.split()
+    saved = {" ".join(tokenize(phrase.words or "")) for phrase in phrases}
+    found = []
+    for first, last in analysis["chunks"]:
+        candidate = " ".join(tokenize(" ".join(words[first : last + 1])))
+        if candidate and candidate not in saved:
+            saved.add(candidate)
+            found.append(
+                {
+                    "words": candidate,
+                    "form": {
+                        "sentence": sentence.id,
+                        **{
+                            f"{index + 1}@@{words[index]}": "on"
+                            for index in range(first, last + 1)
+                        },
+                    },
+                }
+            )
+
+    return found
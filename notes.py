@@ -1,12 +1,68 @@
-import mistune
-import nh3
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
 
 
-def clean_and_render_markup(markup: str):
+RENDER_CACHE_SIZE = 256
+
+
+class RenderCache:
+    """
+    Rendered notes, keyed by a hash of the markdown they came from, so an
+    unchanged set of notes is only rendered and cleaned once. Least
+    recently used entries are dropped past `maxsize`.
+    """
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._rendered: OrderedDict[bytes, str] = OrderedDict()
+        self._lock = Lock()
+
+    def get_or_render(self, markup: str, render) -> str:
+        key = blake2b(markup.encode(), digest_size=16).digest()
+
+        with self._lock:
+            if (html := self._rendered.get(key)) is not None:
+                self._rendered.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        html = render(markup)
+
+        with self._lock:
+            self._rendered[key] = html
+            if len(self._rendered) > self.maxsize:
+                self._rendered.popitem(last=False)
+
+        return html
+
+    def info(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._rendered),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._rendered.clear()
+            self.hits = self.misses = 0
+
+
+render_cache = RenderCache()
+
+
+def render_markup(markup: str):
     """
     Avoiding issues with malicious html being injected into the
     file.
     """
+    import mistune
+    import nh3
 
     return nh3.clean(
         mistune.html(markup),
@@ -25,3 +81,7 @@ def clean_and_render_markup(markup: str):
             }
         },
     )
+
+
+def clean_and_render_markup(markup: str):
+    return render_cache.get_or_render(markup, render_markup)
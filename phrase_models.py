@@ -1,10 +1,23 @@
-from sqlalchemy import text, Connection
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import count, islice, tee
+import json
+from string import punctuation
+from threading import Lock
+from typing import Iterator, NamedTuple
+import zlib
+
+from markupsafe import Markup, escape
+from sqlalchemy import text, bindparam, Connection, Engine, TextClause
 from pypika import (
     Table,
     SQLLiteQuery as Query,
+    Order,
     Parameter,
     functions as fn,
-    AliasedQuery,
 )
 
 
@@ -16,228 +29,1103 @@ class Tables:
     notes = Table("notes")
     comments = Table("comments")
     users = Table("users")
+    project_version = Table("project_version")
+    tokens = Table("tokens")
+    analyses = Table("analyses")
+    events = Table("events")
 
 
-class Sentence:
-    def __init__(self):
-        """
-        Kinda weird, but leaving some parts of queries here for later use.
-        """
-        sub_q = (
-            Query.from_(Tables.sentences)
-            .select("*")
-            .groupby("stack_id")
-            .having(fn.Max(Tables.sentences.id))
-        )
-        self.q_for_latest = (
-            Query.with_(sub_q, "top_sentence")
-            .from_(Tables.stacks)
-            .select(
-                Tables.stacks.id,
-                Tables.stacks.stale,
-                AliasedQuery("top_sentence").words,
+# Caps for neighborhood queries. The walk itself is bounded only by the
+# depth; the node and edge caps apply to what is returned from it.
+MAX_DEPTH = 6
+MAX_NODES = 2_000
+MAX_EDGES = 10_000
+
+# Results per search.
+SEARCH_LIMIT = 25
+
+# Rows per page for the paginated listings.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def page_size(limit: int) -> int:
+    """`limit` kept to 1..MAX_PAGE_SIZE, since SQLite reads LIMIT -1 as none."""
+    return min(max(limit, 1), MAX_PAGE_SIZE)
+
+
+def compiled(stmt) -> TextClause:
+    """Render a PyPika query to SQL once and wrap it for reuse."""
+    return text(str(stmt))
+
+
+# One lock per database, so writers in this process queue up for SQLite's
+# single write lock instead of racing each other for it.
+_writer_locks: dict[str, Lock] = {}
+_writer_locks_guard = Lock()
+
+
+def writer_lock(engine: Engine) -> Lock:
+    with _writer_locks_guard:
+        return _writer_locks.setdefault(str(engine.url), Lock())
+
+
+@contextmanager
+def unit_of_work(engine: Engine, write: bool = False) -> Iterator[Connection]:
+    """
+    The models never commit on their own. Everything run on the connection
+    this yields is committed once when the block exits, or rolled back
+    together if it raises, so one user action costs one commit.
+
+    Pass `write=True` for work that writes. It waits its turn behind the
+    other writers in this process, then takes SQLite's write lock up
+    front with BEGIN IMMEDIATE, where busy_timeout applies. A transaction
+    that only upgrades to a writer partway through can fail with 'database
+    is locked' straight away instead.
+    """
+    if not write:
+        with engine.begin() as db:
+            yield db
+        return
+
+    with writer_lock(engine), engine.begin() as db:
+        db.exec_driver_sql("begin immediate;")
+        yield db
+
+
+def normalize(word: str) -> str:
+    """Lower-case a word and strip its punctuation, as phrases are saved."""
+    return word.lower().strip(punctuation)
+
+
+def tokenize(words: str) -> list[str]:
+    return [token for token in map(normalize, words.split()) if token]
+
+
+def compress_revision(words: str, newer: str) -> bytes:
+    """
+    A revision as raw deflate primed with the revision after it, so the
+    bulk of the text that didn't change costs a back-reference.
+    """
+    packer = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=newer.encode())
+    return packer.compress(words.encode()) + packer.flush()
+
+
+def expand_revision(delta: bytes, newer: str) -> str:
+    unpacker = zlib.decompressobj(-15, zdict=newer.encode())
+    return (unpacker.decompress(delta) + unpacker.flush()).decode()
+
+
+def restore_words(revisions) -> Iterator[str]:
+    """
+    The words of each of a stack's revisions, newest first, given rows
+    newest first. Compacted ones are rebuilt from the one after them.
+    """
+    newer = None
+    for revision in revisions:
+        if revision.words is None:
+            newer = expand_revision(revision.delta, newer)
+        else:
+            newer = revision.words
+        yield newer
+
+
+class Revision(NamedTuple):
+    id: int
+    stack_id: int
+    words: str
+    timestamp: str
+
+
+def as_of_timestamp(when: datetime | str) -> str:
+    """
+    A point in time the way SQLite's current_timestamp writes it, in UTC,
+    so it compares with sentences.timestamp as text. Naive times are taken
+    to be in UTC already. Raises ValueError for strings that aren't ISO
+    8601.
+    """
+    if isinstance(when, str):
+        when = datetime.fromisoformat(when)
+    if when.tzinfo is not None:
+        when = when.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return when.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def diff_words(old: str, new: str) -> list[dict]:
+    """
+    The runs of words that stayed, went and came between two texts, as
+    {"op": "equal" | "delete" | "insert", "words": ...}, in reading order.
+    """
+    old_words, new_words = old.split(), new.split()
+    matcher = SequenceMatcher(None, old_words, new_words, autojunk=False)
+    changes = []
+    for op, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if op in ("equal", "delete", "replace"):
+            words = old_words[old_start:old_end]
+            changes.append(
+                {"op": "delete" if op != "equal" else op, "words": words}
+            )
+        if op in ("insert", "replace"):
+            changes.append(
+                {"op": "insert", "words": new_words[new_start:new_end]}
             )
-            .join(AliasedQuery("top_sentence"))
-            .on(AliasedQuery("top_sentence").stack_id == Tables.stacks.id)
+
+    return [
+        {"op": change["op"], "words": " ".join(change["words"])}
+        for change in changes
+    ]
+
+
+@lru_cache(maxsize=None)
+def _row_type(fields: tuple[str, ...]):
+    return namedtuple("Row", fields)
+
+
+def with_words(row, words: str, column: str = "words"):
+    """A copy of a result row with the text of one column filled in."""
+    values = row._asdict()
+    values[column] = words
+    return _row_type(tuple(values))(**values)
+
+
+def postings(stack_id: int, words: str) -> list[dict]:
+    """The rows a sentence puts in the token index."""
+    return [
+        {"token": token, "stack_id": stack_id, "position": position}
+        for position, token in enumerate(tokenize(words))
+    ]
+
+
+def revision_as_of(stack):
+    """
+    The id of the revision of `stack` that was newest at :as_of. This
+    walks the (stack_id, timestamp) index backwards from that time, and
+    revisions made in the same second go to the later id.
+    """
+    revision = Tables.sentences.as_("revision")
+    return (
+        Query.from_(revision)
+        .select(revision.id)
+        .where(revision.stack_id == stack.id)
+        .where(revision.timestamp <= Parameter(":as_of"))
+        .orderby(revision.timestamp, order=Order.desc)
+        .orderby(revision.id, order=Order.desc)
+        .limit(1)
+    )
+
+
+class Queries:
+    """
+    The PyPika trees the statements below are built from. These only get
+    rendered when Statements is compiled at import, never per call.
+
+    The top of each stack is found through 'stacks.head_sentence_id',
+    which a trigger keeps pointed at the stack's newest sentence.
+    """
+
+    sentence_latest = (
+        Query.from_(Tables.stacks)
+        .select(
+            Tables.stacks.id,
+            Tables.stacks.stale,
+            Tables.sentences.words,
+        )
+        .join(Tables.sentences)
+        .on(Tables.sentences.id == Tables.stacks.head_sentence_id)
+    )
+
+    # Sort of worse, but we want the top sentence from the stack defining
+    # a given phrase, so the stacks and sentences tables join in twice.
+    def_stacks = Tables.stacks.as_("def_stacks")
+    def_sentences = Tables.sentences.as_("def_sentences")
+
+    phrase_base = (
+        Query.from_(Tables.phrases)
+        .select(
+            Tables.phrases.id,
+            Tables.phrases.words,
+            Tables.phrases.stack_id,
+            Tables.phrases.stale,
+            Tables.notes.words.as_("notes"),
+            def_stacks.id.as_("def_stack_id"),
+            def_sentences.words.as_("definition"),
+            Tables.notes.definition_status,
+        )
+        .join(Tables.notes)
+        .on(Tables.notes.phrase_id == Tables.phrases.id)
+        .left_join(Tables.definitions)
+        .on(Tables.definitions.phrase_id == Tables.phrases.id)
+        .left_join(def_stacks)
+        .on(def_stacks.id == Tables.definitions.stack_id)
+        .left_join(def_sentences)
+        .on(def_sentences.id == def_stacks.head_sentence_id)
+    )
+
+    sentence_as_of = (
+        Query.from_(Tables.stacks)
+        .select(
+            Tables.stacks.id,
+            Tables.stacks.stale,
+            Tables.sentences.words,
+            Tables.sentences.id.as_("sentence_id"),
+        )
+        .join(Tables.sentences)
+        .on(Tables.sentences.id == revision_as_of(Tables.stacks))
+    )
+
+    phrase_as_of = (
+        Query.from_(Tables.phrases)
+        .select(
+            Tables.phrases.id,
+            Tables.phrases.words,
+            Tables.phrases.stack_id,
+            Tables.phrases.stale,
+            Tables.notes.words.as_("notes"),
+            def_stacks.id.as_("def_stack_id"),
+            def_sentences.words.as_("definition"),
+            Tables.notes.definition_status,
+            def_sentences.id.as_("definition_id"),
+        )
+        .join(Tables.notes)
+        .on(Tables.notes.phrase_id == Tables.phrases.id)
+        .left_join(Tables.definitions)
+        .on(Tables.definitions.phrase_id == Tables.phrases.id)
+        .left_join(def_stacks)
+        .on(def_stacks.id == Tables.definitions.stack_id)
+        .left_join(def_sentences)
+        .on(def_sentences.id == revision_as_of(def_stacks))
+    )
+
+
+class Statements:
+    """
+    Every statement the models run, compiled once at import so a request
+    only pays for binding parameters and executing.
+    """
+
+    # Project version
+    current_version = compiled(
+        Query.from_(Tables.project_version)
+        .select(Tables.project_version.version)
+        .where(Tables.project_version.id == 1)
+    )
+    bump_version = compiled(
+        Query.update(Tables.project_version)
+        .set(
+            Tables.project_version.version,
+            Tables.project_version.version + 1,
+        )
+        .where(Tables.project_version.id == 1)
+    )
+
+    # Sentences
+    new_stack = text("insert into stacks default values;")
+    new_sentence = compiled(
+        Query.into(Tables.sentences)
+        .columns("stack_id", "words")
+        .insert(Parameter(":stack_id"), Parameter(":words"))
+    )
+    get_sentence = compiled(
+        Queries.sentence_latest.where(
+            Tables.stacks.id == Parameter(":stack_id")
+        )
+    )
+    all_sentences = compiled(Queries.sentence_latest)
+    get_sentence_as_of = compiled(
+        Queries.sentence_as_of.where(
+            Tables.stacks.id == Parameter(":stack_id")
+        )
+    )
+    all_sentences_as_of = compiled(
+        Queries.sentence_as_of.orderby(Tables.stacks.id)
+    )
+    sentence_page = compiled(
+        Queries.sentence_latest.where(Tables.stacks.id > Parameter(":after"))
+        .where(
+            Parameter(":stale").isnull()
+            | (Tables.stacks.stale == Parameter(":stale"))
+        )
+        .orderby(Tables.stacks.id)
+        .limit(Parameter(":limit"))
+    )
+    sentence_last_page = compiled(
+        Queries.sentence_latest.orderby(Tables.stacks.id, order=Order.desc)
+        .limit(Parameter(":limit"))
+    )
+    sentence_history = compiled(
+        Query.from_(Tables.sentences)
+        .select(
+            Tables.sentences.id,
+            Tables.sentences.stack_id,
+            Tables.sentences.words,
+            Tables.sentences.delta,
+            Tables.sentences.timestamp,
+        )
+        .where(Tables.sentences.stack_id == Parameter(":stack_id"))
+        .orderby(Tables.sentences.id, order=Order.desc)
+    )
+    stacks_to_compact = compiled(
+        Query.from_(Tables.sentences)
+        .join(Tables.stacks)
+        .on(Tables.stacks.id == Tables.sentences.stack_id)
+        .select(Tables.sentences.stack_id)
+        .distinct()
+        .where(Tables.sentences.id != Tables.stacks.head_sentence_id)
+        .where(Tables.sentences.words.notnull())
+        .where(Tables.sentences.stack_id > Parameter(":after"))
+        .orderby(Tables.sentences.stack_id)
+        .limit(Parameter(":limit"))
+    )
+    compact_revision = compiled(
+        Query.update(Tables.sentences)
+        .set(Tables.sentences.words, None)
+        .set(Tables.sentences.delta, Parameter(":delta"))
+        .where(Tables.sentences.id == Parameter(":sentence_id"))
+    )
+    set_stack_stale = compiled(
+        Query.update(Tables.stacks)
+        .set(Tables.stacks.stale, Parameter(":stale"))
+        .where(Tables.stacks.id == Parameter(":stack_id"))
+    )
+    phrases_in_stack = compiled(
+        Query.from_(Tables.phrases)
+        .select(Tables.phrases.id, Tables.phrases.words, Tables.phrases.stale)
+        .where(Tables.phrases.stack_id == Parameter(":stack_id"))
+    )
+    set_phrase_stale = compiled(
+        Query.update(Tables.phrases)
+        .set(Tables.phrases.stale, Parameter(":stale"))
+        .where(Tables.phrases.id == Parameter(":phrase_id"))
+    )
+    delete_stack = compiled(
+        Query.from_(Tables.stacks)
+        .delete()
+        .where(Tables.stacks.id == Parameter(":stack_id"))
+    )
+    new_postings = compiled(
+        Query.into(Tables.tokens)
+        .columns("token", "stack_id", "position")
+        .insert(
+            Parameter(":token"), Parameter(":stack_id"), Parameter(":position")
+        )
+    )
+    clear_postings = compiled(
+        Query.from_(Tables.tokens)
+        .delete()
+        .where(Tables.tokens.stack_id == Parameter(":stack_id"))
+    )
+
+    export_sentences = compiled(
+        Query.from_(Tables.sentences)
+        .join(Tables.stacks)
+        .on(Tables.stacks.id == Tables.sentences.stack_id)
+        .select(
+            Tables.sentences.id,
+            Tables.sentences.stack_id,
+            Tables.sentences.words,
+            Tables.sentences.delta,
+            Tables.sentences.timestamp,
+            Tables.stacks.stale,
+        )
+        .orderby(Tables.sentences.stack_id)
+        .orderby(Tables.sentences.id, order=Order.desc)
+    )
+
+    # Phrases
+    new_phrase = compiled(
+        Query.into(Tables.phrases)
+        .columns(Tables.phrases.stack_id, Tables.phrases.words)
+        .insert(Parameter(":stack_id"), Parameter(":words"))
+    )
+    new_notes = compiled(
+        Query.into(Tables.notes)
+        .columns(Tables.notes.phrase_id)
+        .insert(Parameter(":phrase_id"))
+    )
+    get_phrase = compiled(
+        Queries.phrase_base.where(Tables.phrases.id == Parameter(":phrase_id"))
+    )
+    all_phrases = compiled(Queries.phrase_base)
+    all_phrases_as_of = compiled(Queries.phrase_as_of)
+    export_phrases = compiled(Queries.phrase_base.orderby(Tables.phrases.id))
+    phrase_page = compiled(
+        Queries.phrase_base.where(Tables.phrases.id > Parameter(":after"))
+        .where(
+            Parameter(":stale").isnull()
+            | (Tables.phrases.stale == Parameter(":stale"))
+        )
+        .where(
+            Parameter(":status").isnull()
+            | (Tables.notes.definition_status == Parameter(":status"))
+        )
+        .orderby(Tables.phrases.id)
+        .limit(Parameter(":limit"))
+    )
+    phrase_last_page = compiled(
+        Queries.phrase_base.orderby(Tables.phrases.id, order=Order.desc)
+        .limit(Parameter(":limit"))
+    )
+    phrases_for_sentence = compiled(
+        Queries.phrase_base.where(
+            Tables.phrases.stack_id == Parameter(":stack_id")
+        )
+    )
+    new_definition = compiled(
+        Query.into(Tables.definitions)
+        .columns(Tables.definitions.phrase_id, Tables.definitions.stack_id)
+        .insert(Parameter(":phrase_id"), Parameter(":stack_id"))
+    )
+    set_status = compiled(
+        Query.update(Tables.notes)
+        .set(Tables.notes.definition_status, Parameter(":status"))
+        .where(Tables.notes.phrase_id == Parameter(":phrase_id"))
+    )
+    revise_notes = compiled(
+        Query.update(Tables.notes)
+        .set(Tables.notes.words, Parameter(":note_text"))
+        .where(Tables.notes.phrase_id == Parameter(":phrase_id"))
+    )
+    delete_phrase = compiled(
+        Query.from_(Tables.phrases)
+        .delete()
+        .where(Tables.phrases.id == Parameter(":phrase_id"))
+    )
+    rephrase = compiled(
+        Query.update(Tables.phrases)
+        .set(Tables.phrases.words, Parameter(":words"))
+        .set(Tables.phrases.stale, False)
+        .where(Tables.phrases.id == Parameter(":phrase_id"))
+    )
+
+    # Walks the postings of the phrase's rarest token and keeps the stacks
+    # where every other token sits at the matching offset from it. Each
+    # check is a primary key lookup, so the cost follows the rarest token.
+    phrase_occurrences = text(
+        """
+        with wanted(offset, token) as (
+            select key, value from json_each(:tokens)
+        ),
+        anchor(offset, token) as (
+            select offset, token
+            from wanted
+            order by (
+                select count(*) from tokens where tokens.token = wanted.token
+            )
+            limit 1
+        )
+        select distinct stacks.id, stacks.stale, sentences.words
+        from anchor
+        join tokens as hit on hit.token = anchor.token
+        join stacks on stacks.id = hit.stack_id
+        join sentences on sentences.id = stacks.head_sentence_id
+        where not exists (
+            select 1
+            from wanted
+            where not exists (
+                select 1
+                from tokens
+                where tokens.token = wanted.token
+                    and tokens.stack_id = hit.stack_id
+                    and tokens.position
+                        = hit.position - anchor.offset + wanted.offset
+            )
+        )
+        order by stacks.id
+        """
+    )
+
+    # Analyses
+    get_analysis = compiled(
+        Query.from_(Tables.stacks)
+        .left_join(Tables.analyses)
+        .on(Tables.analyses.sentence_id == Tables.stacks.head_sentence_id)
+        .select(
+            Tables.stacks.head_sentence_id.as_("sentence_id"),
+            Tables.analyses.model,
+            Tables.analyses.tokens,
+            Tables.analyses.chunks,
+        )
+        .where(Tables.stacks.id == Parameter(":stack_id"))
+    )
+    save_analysis = compiled(
+        Query.into(Tables.analyses)
+        .columns("sentence_id", "model", "tokens", "chunks")
+        .insert_or_replace(
+            Parameter(":sentence_id"),
+            Parameter(":model"),
+            Parameter(":tokens"),
+            Parameter(":chunks"),
+        )
+    )
+    unanalyzed_sentences = compiled(
+        Query.from_(Tables.sentences)
+        .left_join(Tables.analyses)
+        .on(Tables.analyses.sentence_id == Tables.sentences.id)
+        .select(Tables.sentences.id, Tables.sentences.words)
+        .where(Tables.analyses.sentence_id.isnull())
+        .where(Tables.sentences.words.notnull())
+        .where(Tables.sentences.id > Parameter(":after"))
+        .orderby(Tables.sentences.id)
+        .limit(Parameter(":limit"))
+    )
+
+    # Events
+    new_event = compiled(
+        Query.into(Tables.events)
+        .columns("kind", "stack_id", "phrase_id", "data")
+        .insert(
+            Parameter(":kind"),
+            Parameter(":stack_id"),
+            Parameter(":phrase_id"),
+            Parameter(":data"),
+        )
+    )
+    prune_events = compiled(
+        Query.from_(Tables.events)
+        .delete()
+        .where(Tables.events.id <= Parameter(":before"))
+    )
+    events_after = compiled(
+        Query.from_(Tables.events)
+        .select(
+            Tables.events.id,
+            Tables.events.kind,
+            Tables.events.stack_id,
+            Tables.events.phrase_id,
+            Tables.events.data,
+        )
+        .where(Tables.events.id > Parameter(":after"))
+        .orderby(Tables.events.id)
+        .limit(Parameter(":limit"))
+    )
+    event_bounds = compiled(
+        Query.from_(Tables.events).select(
+            fn.Min(Tables.events.id).as_("oldest"),
+            fn.Max(Tables.events.id).as_("latest"),
+        )
+    )
+
+    # Search, highlighting matches between \x02 and \x03 so they survive
+    # html escaping of the rest of the snippet.
+    search = text(
+        """
+        with hits as (
+            select
+                kind,
+                ref_id,
+                snippet(search, 0, char(2), char(3), '…', 12) as snippet,
+                rank
+            from search
+            where search match :query
+            order by rank
+            limit :limit
+        )
+        select
+            hits.kind,
+            hits.ref_id,
+            hits.snippet,
+            definitions.phrase_id as defines
+        from hits
+        left join definitions
+            on hits.kind = 'sentence' and definitions.stack_id = hits.ref_id
+        order by hits.rank
+        """
+    )
+
+    # Graph
+    graph_sentences = compiled(
+        Query.from_(Tables.stacks)
+        .select(Tables.stacks.id, Tables.sentences.words)
+        .join(Tables.sentences)
+        .on(Tables.sentences.id == Tables.stacks.head_sentence_id)
+    )
+    graph_phrases = compiled(
+        Query.from_(Tables.phrases).select(
+            Tables.phrases.id,
+            Tables.phrases.words,
+            Tables.phrases.stale,
+            Tables.phrases.stack_id,
+        )
+    )
+    graph_edges = compiled(
+        Query.select(
+            Tables.definitions.phrase_id,
+            Tables.definitions.stack_id,
+        )
+        .from_(Tables.definitions)
+        .join(Tables.phrases)
+        .on(Tables.phrases.id == Tables.definitions.phrase_id)
+        .join(Tables.stacks)
+        .on(Tables.stacks.id == Tables.definitions.stack_id)
+    )
+    # Only the ids, for graph_layout's arrays. Phrases found in no stack
+    # read stack 0, which no stack has.
+    graph_stack_ids = compiled(
+        Query.from_(Tables.stacks)
+        .select(Tables.stacks.id)
+        .join(Tables.sentences)
+        .on(Tables.sentences.id == Tables.stacks.head_sentence_id)
+        .orderby(Tables.stacks.id)
+    )
+    graph_phrase_ids = compiled(
+        Query.from_(Tables.phrases)
+        .select(Tables.phrases.id, fn.Coalesce(Tables.phrases.stack_id, 0))
+        .orderby(Tables.phrases.id)
+    )
+    # PyPika can't write recursive CTEs. The walk steps along both
+    # directions of phrases.stack_id and of definitions, one hop per level.
+    graph_neighborhood = text(
+        """
+        with recursive walk(kind, id, depth) as (
+            select :kind, :id, 0
+            union
+            select 'p', phrases.id, walk.depth + 1
+            from walk
+            join phrases on walk.kind = 's' and phrases.stack_id = walk.id
+            where walk.depth < :depth
+            union
+            select 's', phrases.stack_id, walk.depth + 1
+            from walk
+            join phrases on walk.kind = 'p' and phrases.id = walk.id
+            where walk.depth < :depth and phrases.stack_id is not null
+            union
+            select 's', definitions.stack_id, walk.depth + 1
+            from walk
+            join definitions
+                on walk.kind = 'p' and definitions.phrase_id = walk.id
+            where walk.depth < :depth
+            union
+            select 'p', definitions.phrase_id, walk.depth + 1
+            from walk
+            join definitions
+                on walk.kind = 's' and definitions.stack_id = walk.id
+            where walk.depth < :depth
+        ),
+        nearest as (
+            select kind, id, min(depth) as depth
+            from walk
+            group by kind, id
+            order by depth
+            limit :max_nodes
+        )
+        select
+            nearest.kind,
+            nearest.id,
+            coalesce(sentences.words, phrases.words) as words,
+            phrases.stale,
+            phrases.stack_id
+        from nearest
+        left join stacks on nearest.kind = 's' and stacks.id = nearest.id
+        left join sentences on sentences.id = stacks.head_sentence_id
+        left join phrases on nearest.kind = 'p' and phrases.id = nearest.id
+        where coalesce(sentences.words, phrases.words) is not null
+        order by nearest.kind desc, nearest.depth
+        """
+    )
+    graph_definitions_for = text(
+        """
+        select phrase_id, stack_id
+        from definitions
+        where phrase_id in :phrase_ids
+        """
+    ).bindparams(bindparam("phrase_ids", expanding=True))
+
+
+class Version:
+    """
+    The project's change counter. Every model method that writes bumps
+    it, in the same transaction as the write.
+    """
+
+    @classmethod
+    def current(cls, db: Connection) -> int:
+        return db.execute(Statements.current_version).scalar()
+
+    @classmethod
+    def bump(cls, db: Connection):
+        db.execute(Statements.bump_version)
+
+
+class Event:
+    """
+    What changed, row by row, for the /events feed. Model methods that
+    write emit these alongside their version bump, so an event commits or
+    rolls back with the change it describes.
+    """
+
+    # Events kept for readers that fell behind. One past these has to
+    # reload rather than catch up.
+    KEPT = 10_000
+    PAGE_SIZE = 500
+
+    @classmethod
+    def emit(
+        cls, kind: str, db: Connection, stack_id=None, phrase_id=None, **data
+    ):
+        result = db.execute(
+            Statements.new_event,
+            {
+                "kind": kind,
+                "stack_id": stack_id,
+                "phrase_id": phrase_id,
+                "data": json.dumps(data) if data else None,
+            },
         )
+        db.execute(
+            Statements.prune_events, {"before": result.lastrowid - cls.KEPT}
+        )
+
+    @classmethod
+    def emit_many(cls, kind: str, events: list[dict], db: Connection):
+        """Events given as dicts of stack_id, phrase_id and any data."""
+        db.execute(
+            Statements.new_event,
+            [
+                {
+                    "kind": kind,
+                    "stack_id": event.pop("stack_id", None),
+                    "phrase_id": event.pop("phrase_id", None),
+                    "data": json.dumps(event) if event else None,
+                }
+                for event in map(dict, events)
+            ],
+        )
+
+    @classmethod
+    def bounds(cls, db: Connection) -> tuple[int, int]:
+        """The ids of the oldest and newest events kept, 0 when none."""
+        row = db.execute(Statements.event_bounds).fetchone()
+        return row.oldest or 0, row.latest or 0
+
+    @classmethod
+    def since(
+        cls, after: int, db: Connection, limit: int = PAGE_SIZE
+    ) -> list[dict]:
+        return [
+            {
+                "id": row.id,
+                "kind": row.kind,
+                "stack_id": row.stack_id,
+                "phrase_id": row.phrase_id,
+                **json.loads(row.data or "{}"),
+            }
+            for row in db.execute(
+                Statements.events_after, {"after": after, "limit": limit}
+            )
+        ]
+
 
+class Sentence:
     def new(self, words, db: Connection):
-        result = db.execute(text("insert into stacks default values;"))
+        result = db.execute(Statements.new_stack)
         stack_id = result.lastrowid
-        db.commit()
 
-        stmt = (
-            Query.into(Tables.sentences)
-            .columns("stack_id", "words")
-            .insert(stack_id, Parameter(":words"))
+        db.execute(
+            Statements.new_sentence, {"stack_id": stack_id, "words": words}
         )
-        db.execute(text(str(stmt)), {"words": words})
-        db.commit()
+        if rows := postings(stack_id, words):
+            db.execute(Statements.new_postings, rows)
+        Event.emit("sentence_added", db, stack_id=stack_id, words=words)
+        Version.bump(db)
 
         return stack_id
 
-    def get(self, stack_id, db: Connection):
-        stmt = self.q_for_latest.where(
-            Tables.stacks.id == Parameter(":stack_id")
+    def get(self, stack_id, db: Connection, as_of: datetime | str | None = None):
+        """
+        The top of the stack, or with `as_of`, the revision that was on
+        top then. None if the stack didn't exist yet.
+        """
+        if as_of is None:
+            result = db.execute(
+                Statements.get_sentence, {"stack_id": stack_id}
+            )
+            return result.fetchone()
+
+        row = db.execute(
+            Statements.get_sentence_as_of,
+            {"stack_id": stack_id, "as_of": as_of_timestamp(as_of)},
+        ).fetchone()
+
+        return row and self.restored(row, db)
+
+    def all(self, db: Connection, as_of: datetime | str | None = None):
+        """
+        Every stack's top sentence, or with `as_of`, every stack that
+        existed then as it read then. Stale flags are always current.
+        """
+        if as_of is None:
+            result = db.execute(Statements.all_sentences)
+            return result.fetchall()
+
+        rows = db.execute(
+            Statements.all_sentences_as_of, {"as_of": as_of_timestamp(as_of)}
         )
-        result = db.execute(text(str(stmt)), {"stack_id": stack_id})
 
-        return result.fetchone()
+        return [self.restored(row, db) for row in rows]
+
+    def restored(self, row, db: Connection, column: str = "words"):
+        """
+        A row from an as of read with its text rebuilt if that revision
+        was compacted. The revision's id is read from 'sentence_id' or,
+        for a definition, 'definition_id'.
+        """
+        if row._mapping[column] is not None:
+            return row
 
-    def all(self, db: Connection):
-        stmt = self.q_for_latest
-        result = db.execute(text(str(stmt)))
+        if column == "words":
+            stack_id, sentence_id = row.id, row.sentence_id
+        else:
+            stack_id, sentence_id = row.def_stack_id, row.definition_id
+        if sentence_id is None:
+            return row
 
-        return result.fetchall()
+        for revision in self.revisions(stack_id, db):
+            if revision.id == sentence_id:
+                return with_words(row, revision.words, column)
 
-    def history(self, stack_id, db: Connection):
-        stmt = (
-            Query.select("*")
-            .from_(Tables.sentences)
-            .where(Tables.sentences.stack_id == Parameter(":stack_id"))
+    def page(
+        self,
+        db: Connection,
+        after: int = 0,
+        limit: int = PAGE_SIZE,
+        stale: bool | None = None,
+    ):
+        """
+        The next `limit` stacks with an id above `after`. Pass the last id
+        of one page as `after` to get the next.
+        """
+        result = db.execute(
+            Statements.sentence_page,
+            {
+                "after": after,
+                "limit": page_size(limit),
+                "stale": stale,
+            },
         )
-        result = db.execute(text(str(stmt)), {"stack_id": stack_id})
+
         return result.fetchall()
 
-    def goes_stale(self, stack_id, db: Connection):
-        stmt = (
-            Query.update(Tables.stacks)
-            .set(Tables.stacks.stale, True)
-            .where(Tables.stacks.id == stack_id)
+    def last_page(self, db: Connection, limit: int = PAGE_SIZE):
+        """The `limit` newest stacks, in the same order as page."""
+        result = db.execute(
+            Statements.sentence_last_page, {"limit": page_size(limit)}
         )
 
-        result = db.execute(text(str(stmt)))
-        db.commit()
+        return result.fetchall()[::-1]
+
+    def revisions(self, stack_id, db: Connection) -> Iterator[Revision]:
+        """
+        The stack's revisions newest first, each rebuilt only when the
+        iteration reaches it, so reading the last few of a long history
+        doesn't decompress the rest.
+        """
+        rows = db.execute(Statements.sentence_history, {"stack_id": stack_id})
+        rows, copies = tee(rows)
+        for row, words in zip(rows, restore_words(copies)):
+            yield Revision(row.id, row.stack_id, words, row.timestamp)
+
+    def history(self, stack_id, db: Connection, limit: int | None = None):
+        """The stack's revisions oldest first, or only the newest `limit`."""
+        return list(islice(self.revisions(stack_id, db), limit))[::-1]
+
+    def diff(
+        self,
+        stack_id,
+        db: Connection,
+        old: int | None = None,
+        new: int | None = None,
+    ) -> dict | None:
+        """
+        What changed in the stack's words between the revisions with ids
+        `old` and `new`, as runs from diff_words. `new` defaults to the
+        newest revision and `old` to the one before `new`, or nothing if
+        `new` is the first. None if either isn't a revision of the stack.
+        Only the history down to the older of the two is rebuilt.
+        """
+        newer = older = None
+        for revision in self.revisions(stack_id, db):
+            if older is None and (
+                old == revision.id or (old is None and newer is not None)
+            ):
+                older = revision
+            if newer is None and new in (None, revision.id):
+                newer = revision
+            if newer is not None and older is not None:
+                break
+
+        if newer is None or (older is None and old is not None):
+            return None
+
+        return {
+            "stack_id": stack_id,
+            "old": older and older.id,
+            "new": newer.id,
+            "changes": diff_words(older.words if older else "", newer.words),
+        }
+
+    def compact(self, stack_id, db: Connection) -> int:
+        """
+        Stores every revision but the newest as a delta against the one
+        after it. What the stack reads as doesn't change, so the project
+        version isn't bumped. Returns how many revisions were compacted.
+        """
+        changes = []
+        rows = db.execute(
+            Statements.sentence_history, {"stack_id": stack_id}
+        ).fetchall()
+        words = list(restore_words(rows))
+        for row, older, newer in zip(rows[1:], words[1:], words):
+            if row.words is not None:
+                changes.append(
+                    {
+                        "sentence_id": row.id,
+                        "delta": compress_revision(older, newer),
+                    }
+                )
+
+        if changes:
+            db.execute(Statements.compact_revision, changes)
+
+        return len(changes)
+
+    def goes_stale(self, stack_id, db: Connection):
+        result = db.execute(
+            Statements.set_stack_stale, {"stale": True, "stack_id": stack_id}
+        )
+        Event.emit("sentence_stale", db, stack_id=stack_id, stale=True)
+        Version.bump(db)
 
         return result.lastrowid
 
     def refresh(self, stack_id, db: Connection):
-        stmt = (
-            Query.update(Tables.stacks)
-            .set(Tables.stacks.stale, False)
-            .where(Tables.stacks.id == stack_id)
+        result = db.execute(
+            Statements.set_stack_stale, {"stale": False, "stack_id": stack_id}
         )
-
-        result = db.execute(text(str(stmt)))
-        db.commit()
+        Event.emit("sentence_stale", db, stack_id=stack_id, stale=False)
+        Version.bump(db)
 
         return result.lastrowid
 
     def update(self, stack_id, words, db: Connection):
-        stmt = (
-            Query.into(Tables.sentences)
-            .columns("stack_id", "words")
-            .insert(
-                Parameter(":stack_id"),
-                Parameter(":words"),
-            )
+        db.execute(
+            Statements.new_sentence, {"stack_id": stack_id, "words": words}
         )
+        db.execute(Statements.clear_postings, {"stack_id": stack_id})
+        if rows := postings(stack_id, words):
+            db.execute(Statements.new_postings, rows)
 
-        db.execute(text(str(stmt)), {"stack_id": stack_id, "words": words})
+        # A phrase is still current if its tokens appear, in order and
+        # next to each other, in the revised sentence. Padding with spaces
+        # keeps 'cat' from matching inside 'concatenate'.
+        sentence = f" {' '.join(tokenize(words))} "
+        changes = []
+        for phrase in db.execute(
+            Statements.phrases_in_stack, {"stack_id": stack_id}
+        ):
+            stale = f" {' '.join(tokenize(phrase.words))} " not in sentence
+            if stale != bool(phrase.stale):
+                changes.append({"stale": stale, "phrase_id": phrase.id})
 
-        phrases = Phrase().get_for_sentence(stack_id, db)
-        stale_ids = tuple(
-            phrase.id for phrase in phrases if phrase.words not in words.lower()
-        )
+        Event.emit("sentence_revised", db, stack_id=stack_id, words=words)
+        if changes:
+            db.execute(Statements.set_phrase_stale, changes)
+            Event.emit_many(
+                "phrase_stale",
+                [
+                    {
+                        "stack_id": stack_id,
+                        "phrase_id": change["phrase_id"],
+                        "stale": change["stale"],
+                    }
+                    for change in changes
+                ],
+                db,
+            )
 
-        stmt = Query.update(Tables.phrases).set(Tables.phrases.stale, False)
-        db.execute(text(str(stmt)))
-        stmt = (
-            Query.update(Tables.phrases)
-            .set(Tables.phrases.stale, True)
-            .where(Tables.phrases.id.isin(stale_ids))
-        )
-        db.execute(text(str(stmt)))
-        db.commit()
+        Version.bump(db)
 
         return stack_id
 
     def delete(self, stack_id, db: Connection):
         """Deletes the whole stack"""
-        db.execute(text("PRAGMA foreign_keys = ON;"))
-        stmt = (
-            Query.from_(Tables.stacks)
-            .delete()
-            .where(Tables.stacks.id == Parameter(":stack_id"))
-        )
-
-        result = db.execute(text(str(stmt)), {"stack_id": stack_id})
-        db.commit()
+        result = db.execute(Statements.delete_stack, {"stack_id": stack_id})
+        Event.emit("sentence_deleted", db, stack_id=stack_id)
+        Version.bump(db)
 
         return result.lastrowid
 
 
 class Phrase:
-    def __init__(self):
-        """
-        Sort of worse, but we want to query for the top sentence from the
-        stack related to a given phrase.
-        """
-        sub_q = (
-            Query.from_(Tables.sentences)
-            .select("*")
-            .groupby("stack_id")
-            .having(fn.Max(Tables.sentences.id))
-        )
-
-        self.q_for_latest = (
-            Query.with_(sub_q, "top_sentence")
-            .from_(Tables.stacks)
-            .select(Tables.stacks.id, AliasedQuery("top_sentence").words)
-            .join(AliasedQuery("top_sentence"))
-            .on(AliasedQuery("top_sentence").stack_id == Tables.stacks.id)
-        )
-
-        self.base_query = (
-            Query.with_(self.q_for_latest, "latest_sentences")
-            .from_(Tables.phrases)
-            .select(
-                Tables.phrases.id,
-                Tables.phrases.words,
-                Tables.phrases.stack_id,
-                Tables.phrases.stale,
-                Tables.notes.words.as_("notes"),
-                AliasedQuery("latest_sentences").id.as_("def_stack_id"),
-                AliasedQuery("latest_sentences").words.as_("definition"),
-                Tables.notes.definition_status,
-            )
-            .join(Tables.notes)
-            .on(Tables.notes.phrase_id == Tables.phrases.id)
-            .left_join(Tables.definitions)
-            .on(Tables.definitions.phrase_id == Tables.phrases.id)
-            .left_join(AliasedQuery("latest_sentences"))
-            .on(
-                AliasedQuery("latest_sentences").id
-                == Tables.definitions.stack_id
-            )
-        )
-
     def new(self, stack_id: int | None, words: str, db: Connection):
-        stmt = (
-            Query.into(Tables.phrases)
-            .columns(
-                Tables.phrases.stack_id,
-                Tables.phrases.words,
-            )
-            .insert(
-                Parameter(":stack_id"),
-                Parameter(":words"),
-            )
-        )
-
         result = db.execute(
-            text(str(stmt)), {"stack_id": stack_id, "words": words}
+            Statements.new_phrase, {"stack_id": stack_id, "words": words}
         )
         phrase_id = result.lastrowid
 
-        stmt = (
-            Query.into(Tables.notes)
-            .columns(Tables.notes.phrase_id)
-            .insert(phrase_id)
+        result = db.execute(Statements.new_notes, {"phrase_id": phrase_id})
+        Event.emit(
+            "phrase_added",
+            db,
+            stack_id=stack_id,
+            phrase_id=phrase_id,
+            words=words,
         )
-
-        result = db.execute(text(str(stmt)))
-        db.commit()
+        Version.bump(db)
 
         return phrase_id
 
     def get(self, phrase_id, db: Connection):
-        stmt = self.base_query.where(
-            Tables.phrases.id == Parameter(":phrase_id")
+        result = db.execute(Statements.get_phrase, {"phrase_id": phrase_id})
+        return result.fetchone()
+
+    def all(self, db: Connection, as_of: datetime | str | None = None):
+        """
+        Every phrase, or with `as_of`, every phrase with its definition as
+        it read then. Phrases and notes aren't versioned, so those are the
+        current ones, and a definition made later reads as None.
+        """
+        if as_of is None:
+            result = db.execute(Statements.all_phrases)
+            return result.fetchall()
+
+        rows = db.execute(
+            Statements.all_phrases_as_of, {"as_of": as_of_timestamp(as_of)}
         )
 
-        result = db.execute(text(str(stmt)), {"phrase_id": phrase_id})
-        return result.fetchone()
+        return [Sentence().restored(row, db, "definition") for row in rows]
 
-    def all(self, db: Connection):
-        result = db.execute(text(str(self.base_query)))
+    def page(
+        self,
+        db: Connection,
+        after: int = 0,
+        limit: int = PAGE_SIZE,
+        stale: bool | None = None,
+        status: str | None = None,
+    ):
+        """Same as Sentence.page, optionally filtered to one status."""
+        result = db.execute(
+            Statements.phrase_page,
+            {
+                "after": after,
+                "limit": page_size(limit),
+                "stale": stale,
+                "status": status,
+            },
+        )
         return result.fetchall()
 
+    def last_page(self, db: Connection, limit: int = PAGE_SIZE):
+        """Same as Sentence.last_page."""
+        result = db.execute(
+            Statements.phrase_last_page, {"limit": page_size(limit)}
+        )
+        return result.fetchall()[::-1]
+
     def get_for_sentence(self, stack_id, db: Connection):
-        stmt = self.base_query.where(
-            Tables.phrases.stack_id == Parameter(":stack_id")
+        result = db.execute(
+            Statements.phrases_for_sentence, {"stack_id": stack_id}
         )
-        result = db.execute(text(str(stmt)), {"stack_id": stack_id})
         return result.fetchall()
 
     def revise_definition(self, phrase_id, new_words, db: Connection):
@@ -245,89 +1133,176 @@ class Phrase:
         # This is an upsert, because the phrase may not yet be defined.
 
         if phrase.definition is None:
-            print("new_def_created")
             stack_id = Sentence().new(new_words, db)
-            stmt = (
-                Query.into(Tables.definitions)
-                .columns(
-                    Tables.definitions.phrase_id,
-                    Tables.definitions.stack_id,
-                )
-                .insert(
-                    Parameter(":phrase_id"),
-                    Parameter(":stack_id"),
-                )
-            )
             db.execute(
-                text(str(stmt)), {"phrase_id": phrase_id, "stack_id": stack_id}
+                Statements.new_definition,
+                {"phrase_id": phrase_id, "stack_id": stack_id},
             )
-            db.commit()
         else:
             stack_id = Sentence().update(phrase.def_stack_id, new_words, db)
-            db.commit()
+
+        Event.emit(
+            "definition_set",
+            db,
+            stack_id=stack_id,
+            phrase_id=phrase_id,
+            words=new_words,
+        )
+        Version.bump(db)
 
         return phrase_id
 
     def set_status(self, phrase_id, new_status, db: Connection):
-        stmt = (
-            Query.update(Tables.notes)
-            .set(Tables.notes.definition_status, Parameter(":status"))
-            .where(Tables.notes.phrase_id == Parameter(":phrase_id"))
-        )
-
         result = db.execute(
-            text(str(stmt)), {"status": new_status, "phrase_id": phrase_id}
+            Statements.set_status,
+            {"status": new_status, "phrase_id": phrase_id},
         )
-        db.commit()
+        Event.emit("phrase_status", db, phrase_id=phrase_id, status=new_status)
+        Version.bump(db)
 
         # change to 'inserted_primary_key'
         return result.lastrowid
 
     def revise_notes(self, phrase_id, note_text, db: Connection):
-        stmt = (
-            Query.update(Tables.notes)
-            .set(Tables.notes.words, Parameter(":note_text"))
-            .where(Tables.notes.phrase_id == Parameter(":phrase_id"))
-        )
-
         result = db.execute(
-            text(str(stmt)), {"note_text": note_text, "phrase_id": phrase_id}
+            Statements.revise_notes,
+            {"note_text": note_text, "phrase_id": phrase_id},
         )
-        db.commit()
+        Event.emit("phrase_notes", db, phrase_id=phrase_id)
+        Version.bump(db)
 
         return result.lastrowid
 
     def delete(self, phrase_id, db: Connection):
         """Deletes the whole phrase"""
-        db.execute(text("PRAGMA foreign_keys = ON;"))
         phrase = self.get(phrase_id, db)
         Sentence().goes_stale(phrase.def_stack_id, db)
 
-        stmt = (
-            Query.from_(Tables.phrases)
-            .delete()
-            .where(Tables.phrases.id == Parameter(":phrase_id"))
-        )
-
-        result = db.execute(text(str(stmt)), {"phrase_id": phrase_id})
-        db.commit()
+        result = db.execute(Statements.delete_phrase, {"phrase_id": phrase_id})
+        Event.emit("phrase_deleted", db, phrase_id=phrase_id)
+        Version.bump(db)
 
         return result.lastrowid
 
     def rephrase(self, phrase_id, words, db: Connection):
-        stmt = (
-            Query.update(Tables.phrases)
-            .set(Tables.phrases.words, Parameter(":words"))
-            .set(Tables.phrases.stale, False)
-            .where(Tables.phrases.id == Parameter(":phrase_id"))
+        result = db.execute(
+            Statements.rephrase, {"words": words, "phrase_id": phrase_id}
         )
+        Event.emit("phrase_rephrased", db, phrase_id=phrase_id, words=words)
+        Version.bump(db)
+
+        return result.lastrowid
+
+    def occurrences(self, phrase_id, db: Connection):
+        """
+        Every stack whose latest sentence contains the phrase's tokens in
+        order and next to each other, answered from the token index.
+        """
+        phrase = self.get(phrase_id, db)
+        if phrase is None or not (tokens := tokenize(phrase.words or "")):
+            return []
 
         result = db.execute(
-            text(str(stmt)), {"words": words, "phrase_id": phrase_id}
+            Statements.phrase_occurrences, {"tokens": json.dumps(tokens)}
         )
-        db.commit()
 
-        return result.lastrowid
+        return result.fetchall()
+
+
+class Analysis:
+    """
+    Stored spaCy analyses of sentence revisions. Producing them is up to
+    nlp.py; this only reads and writes the rows. Analyses aren't the
+    project's content, so saving them leaves the version alone.
+    """
+
+    @classmethod
+    def get(cls, stack_id, db: Connection) -> dict | None:
+        """
+        The analysis of a stack's latest sentence. None if there's no such
+        stack, and a dict with only the sentence_id if it isn't analyzed.
+        """
+        row = db.execute(
+            Statements.get_analysis, {"stack_id": stack_id}
+        ).fetchone()
+        if row is None:
+            return None
+        if row.tokens is None:
+            return {"sentence_id": row.sentence_id}
+
+        return {
+            "sentence_id": row.sentence_id,
+            "model": row.model,
+            "tokens": json.loads(row.tokens),
+            "chunks": json.loads(row.chunks),
+        }
+
+    @classmethod
+    def save(cls, analyses: list[dict], db: Connection):
+        db.execute(
+            Statements.save_analysis,
+            [
+                {
+                    "sentence_id": analysis["sentence_id"],
+                    "model": analysis["model"],
+                    "tokens": json.dumps(analysis["tokens"]),
+                    "chunks": json.dumps(analysis["chunks"]),
+                }
+                for analysis in analyses
+            ],
+        )
+
+    @classmethod
+    def pending(cls, db: Connection, after: int = 0, limit: int = PAGE_SIZE):
+        """Sentence revisions with no analysis yet, oldest first."""
+        result = db.execute(
+            Statements.unanalyzed_sentences, {"after": after, "limit": limit}
+        )
+
+        return result.fetchall()
+
+
+class Search:
+    """
+    Ranked full text search over the latest sentences, phrases and notes,
+    kept current by the triggers from the search migration.
+    """
+
+    @classmethod
+    def match_query(cls, terms: str) -> str:
+        """
+        Quote each term so user input can't be read as FTS5 syntax, and
+        let each one match as a prefix for search as you type.
+        """
+        tokens = (token.replace('"', "") for token in terms.split())
+        return " ".join(f'"{token}"*' for token in tokens if token)
+
+    @classmethod
+    def highlight(cls, snippet: str) -> Markup:
+        return Markup(
+            str(escape(snippet))
+            .replace("\x02", "<mark>")
+            .replace("\x03", "</mark>")
+        )
+
+    @classmethod
+    def query(cls, terms: str, db: Connection, limit: int = SEARCH_LIMIT):
+        if not (query := cls.match_query(terms)):
+            return []
+
+        return [
+            {
+                "kind": "definition" if hit.defines else hit.kind,
+                "id": hit.ref_id,
+                "phrase_id": (
+                    hit.ref_id if hit.kind != "sentence" else hit.defines
+                ),
+                "snippet": cls.highlight(hit.snippet),
+            }
+            for hit in db.execute(
+                Statements.search, {"query": query, "limit": limit}
+            )
+        ]
 
 
 def stamp_id(node_type: str, id: int | None):
@@ -343,63 +1318,137 @@ class Graph:
 
     Research: sqlite graph database
     """
-    
-    edges_stmt = (
-        Query.select(
-            Tables.definitions.phrase_id,
-            Tables.definitions.stack_id,
-        ).from_(Tables.definitions)
-        .join(Tables.phrases)
-        .on(Tables.phrases.id == Tables.definitions.phrase_id)
-        .join(Tables.stacks)
-        .on(Tables.stacks.id == Tables.definitions.stack_id)
-    )
-    
+
     @classmethod
-    def assemble_graph(cls, db):
-        sentences = Sentence().all(db)
-        phrases = Phrase().all(db)
-        edges = db.execute(text(str(cls.edges_stmt)))
+    def stream_graph(cls, db) -> Iterator[dict]:
+        """
+        Yields every node and then every edge of the graph one at a time,
+        straight off the cursors, so nothing is held in memory. Sentences
+        come first, then each phrase followed by the edge from the sentence
+        it was found in, then the edges to the sentences defining phrases.
+        So no edge is yielded before both of its nodes.
+        """
+        edge_ids = count()
 
-        return {
-            "nodes": [
-                *[
-                    {
-                    "id": f"s{sentence.id}",
-                    "words": sentence.words,
+        for sentence in db.execute(Statements.graph_sentences):
+            yield {
+                "id": stamp_id("s", sentence.id),
+                "words": sentence.words,
+                "type": "sentence",
+            }
+
+        for phrase in db.execute(Statements.graph_phrases):
+            yield {
+                "id": stamp_id("p", phrase.id),
+                "words": phrase.words,
+                "stale": phrase.stale,
+                "type": "phrase",
+            }
+            if phrase.stack_id:
+                yield {
+                    "id": stamp_id("e", next(edge_ids)),
+                    "source": stamp_id("s", phrase.stack_id),
+                    "target": stamp_id("p", phrase.id),
+                    "type": "edge",
+                }
+
+        for edge in db.execute(Statements.graph_edges):
+            if edge.stack_id and edge.phrase_id:
+                yield {
+                    "id": stamp_id("e", next(edge_ids)),
+                    "source": stamp_id("p", edge.phrase_id),
+                    "target": stamp_id("s", edge.stack_id),
+                    "type": "edge",
+                }
+
+    @classmethod
+    def parse_node_id(cls, node_id: str) -> tuple[str, int]:
+        """Split a stamped node id like 's12' into ('s', 12)."""
+        kind, id = node_id[:1], node_id[1:]
+        if kind not in ("s", "p") or not id.isdigit():
+            raise ValueError(f"{node_id} is not a sentence or phrase node id.")
+
+        return kind, int(id)
+
+    @classmethod
+    def stream_neighborhood(
+        cls,
+        center: tuple[str, int],
+        db,
+        depth: int = 2,
+        max_nodes: int = MAX_NODES,
+        max_edges: int = MAX_EDGES,
+    ) -> Iterator[dict]:
+        """
+        Yields the subgraph within `depth` hops of `center`, a parsed node
+        id like ('s', 12), in the same order as stream_graph. The walk
+        runs in SQLite and visits everything within `depth`; of that, at
+        most `max_nodes` of the nearest nodes and `max_edges` of the edges
+        between them are returned. Sentences come
+        before phrases and nearer nodes before farther ones.
+        """
+        kind, id = center
+        nodes = db.execute(
+            Statements.graph_neighborhood,
+            {
+                "kind": kind,
+                "id": id,
+                "depth": min(max(depth, 0), MAX_DEPTH),
+                # A negative LIMIT is no limit to SQLite.
+                "max_nodes": min(max(max_nodes, 0), MAX_NODES),
+            },
+        ).fetchall()
+        max_edges = min(max(max_edges, 0), MAX_EDGES)
+
+        sentence_ids = {node.id for node in nodes if node.kind == "s"}
+        phrases = [node for node in nodes if node.kind == "p"]
+
+        for node in nodes:
+            if node.kind == "s":
+                yield {
+                    "id": stamp_id("s", node.id),
+                    "words": node.words,
                     "type": "sentence",
-                    }
-                    for sentence in sentences
-                ],
-                *[
-                    {
-                        "id": f"p{phrase.id}",
-                        "words": phrase.words,
-                        "stale": phrase.stale,
-                        "type": "phrase",
-                    } for phrase in phrases
-                ],
-            ],
-            "edges": [
-                *[
-                    {
-                        "id": stamp_id("e", id),
-                        "source": stamp_id("s", phrase.stack_id),
-                        "target": stamp_id("p", phrase.id),
-                    }
-                    for id, phrase in enumerate(phrases)
-                    if (phrase.stack_id and phrase.id)
-                ],
-                *[
-                    {
-                        "id": stamp_id("e", id),
-                        "source": stamp_id("p", edge.phrase_id),
-                        "target": stamp_id("s", edge.stack_id),
-                    }
-                    for id, edge in enumerate(edges, len(phrases))
-                    if (edge.stack_id and edge.phrase_id)
-                ],
-            ],
-        }
+                }
+            else:
+                yield {
+                    "id": stamp_id("p", node.id),
+                    "words": node.words,
+                    "stale": node.stale,
+                    "type": "phrase",
+                }
+
+        edges = [
+            (stamp_id("s", phrase.stack_id), stamp_id("p", phrase.id))
+            for phrase in phrases
+            if phrase.stack_id in sentence_ids
+        ]
+        if phrases:
+            edges += [
+                (stamp_id("p", edge.phrase_id), stamp_id("s", edge.stack_id))
+                for edge in db.execute(
+                    Statements.graph_definitions_for,
+                    {"phrase_ids": [phrase.id for phrase in phrases]},
+                )
+                if edge.stack_id in sentence_ids
+            ]
 
+        for n, (source, target) in enumerate(edges[:max_edges]):
+            yield {
+                "id": stamp_id("e", n),
+                "source": source,
+                "target": target,
+                "type": "edge",
+            }
 
+    @classmethod
+    def collect(cls, items: Iterator[dict]):
+        graph = {"nodes": [], "edges": []}
+        for item in items:
+            graph["edges" if item["type"] == "edge" else "nodes"].append(item)
+
+        return graph
+
+    @classmethod
+    def assemble_graph(cls, db):
+        return cls.collect(cls.stream_graph(db))
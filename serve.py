@@ -0,0 +1,116 @@
+"""
+Runs Ferdinand under gunicorn, for anything past trying it out locally.
+
+    python serve.py --workers 4 --threads 8 --bind 0.0.0.0:8000
+
+Settings come from the flags, then the "server" section of
+project_conf.json, then the defaults below. Each worker is a separate
+process with its own engines, and its threads share them. SQLite allows
+one writer at a time, so writes queue behind each other (see
+unit_of_work) and extra workers mostly buy more concurrent reads.
+
+Every open page also keeps a change feed (see change_feed), and a feed
+holds a thread while it waits. Each worker gives at most half of its
+threads to feeds, so with the defaults up to 8 pages get live updates
+and the rest are turned away until a feed comes free. Raise --threads
+to follow more pages live.
+"""
+
+from multiprocessing import cpu_count
+import argparse
+import json
+
+from gunicorn.app.base import BaseApplication
+
+from database import CONF_PATH
+
+
+DEFAULTS = {
+    "bind": "127.0.0.1:8000",
+    "workers": min(cpu_count(), 4),
+    "threads": 4,
+    "timeout": 60,
+}
+
+
+def load_settings(conf: dict | None = None, **overrides) -> dict:
+    if conf is None:
+        try:
+            with open(CONF_PATH, "r") as f:
+                conf = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            conf = {}
+
+    settings = {**DEFAULTS, **conf.get("server", {})}
+    settings.update(
+        {name: value for name, value in overrides.items() if value is not None}
+    )
+
+    for name in ("workers", "threads", "timeout"):
+        if int(settings[name]) < 1:
+            raise ValueError(f"'{name}' must be at least 1.")
+
+    return settings
+
+
+def post_fork(server, worker):
+    import ferdinand
+
+    ferdinand.after_fork()
+
+
+class Server(BaseApplication):
+    def __init__(self, settings: dict):
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set("bind", self.settings["bind"])
+        self.cfg.set("workers", int(self.settings["workers"]))
+        self.cfg.set("threads", int(self.settings["threads"]))
+        self.cfg.set("timeout", int(self.settings["timeout"]))
+        self.cfg.set("worker_class", "gthread")
+        # The app is imported once and forked. It opens nothing at import,
+        # and post_fork drops anything that was opened anyway.
+        self.cfg.set("preload_app", True)
+        self.cfg.set("post_fork", post_fork)
+
+    def load(self):
+        import change_feed
+        import ferdinand
+
+        threads = int(self.settings["threads"])
+        # One connection per thread, so no thread waits on the pool, and
+        # no more than half the threads held by change feeds.
+        ferdinand.engines.connections = threads
+        change_feed.slots.limit = threads // 2
+        return ferdinand.app
+
+
+parser = argparse.ArgumentParser(
+    prog="Ferdinand server",
+    description="Serve Ferdinand with gunicorn.",
+)
+parser.add_argument("-b", "--bind", help="host:port to listen on.")
+parser.add_argument("-w", "--workers", type=int, help="Worker processes.")
+parser.add_argument("-t", "--threads", type=int, help="Threads per worker.")
+parser.add_argument(
+    "--timeout",
+    type=int,
+    help="Seconds a worker can go silent before it's restarted.",
+)
+
+
+def main(argv=None):
+    namespace = parser.parse_args(argv)
+    settings = load_settings(
+        bind=namespace.bind,
+        workers=namespace.workers,
+        threads=namespace.threads,
+        timeout=namespace.timeout,
+    )
+    Server(settings).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+-- Keep a pointer from each stack to its newest sentence so reads don't
+-- have to group the whole sentences table to find the top of a stack.
+alter table stacks add column head_sentence_id integer;
+
+update stacks set head_sentence_id = (
+	select max(sentences.id)
+	from sentences
+	where sentences.stack_id = stacks.id
+);
+
+create trigger stack_head_on_new_sentence
+after insert on sentences
+begin
+	update stacks set head_sentence_id = new.id where id = new.stack_id;
+end;
@@ -0,0 +1,7 @@
+-- Every join between phrases, notes, definitions and stacks goes through
+-- these columns, as do the cascading deletes from stacks and phrases.
+create index if not exists sentences_stack_id on sentences(stack_id);
+create index if not exists phrases_stack_id on phrases(stack_id);
+create index if not exists notes_phrase_id on notes(phrase_id);
+create index if not exists definitions_phrase_id on definitions(phrase_id);
+create index if not exists definitions_stack_id on definitions(stack_id);
@@ -0,0 +1,8 @@
+-- A single counter bumped by every write, so readers can tell cheaply
+-- whether anything in the project changed since they last looked.
+create table project_version (
+	id integer primary key check (id = 1),
+	version integer not null default 0
+);
+
+insert into project_version (id) values (1);
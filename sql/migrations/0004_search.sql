@@ -0,0 +1,79 @@
+-- Full text search over the latest sentence in each stack (which covers
+-- definitions, since they are stacks too), phrase words and notes.
+--
+-- Rows are keyed by rowid = id * 4 + kind, so triggers can replace a
+-- row with a primary key lookup instead of scanning the index:
+--   0 sentence (stack id), 1 phrase (phrase id), 2 notes (phrase id)
+create virtual table search using fts5(
+	body,
+	kind unindexed,
+	ref_id unindexed,
+	tokenize = 'porter unicode61',
+	prefix = '2 3'
+);
+
+insert into search (rowid, body, kind, ref_id)
+select stacks.id * 4, sentences.words, 'sentence', stacks.id
+from stacks
+join sentences on sentences.id = stacks.head_sentence_id;
+
+insert into search (rowid, body, kind, ref_id)
+select id * 4 + 1, words, 'phrase', id
+from phrases;
+
+insert into search (rowid, body, kind, ref_id)
+select phrase_id * 4 + 2, words, 'notes', phrase_id
+from notes
+where words != '';
+
+create trigger search_on_new_sentence
+after insert on sentences
+begin
+	delete from search where rowid = new.stack_id * 4;
+	insert into search (rowid, body, kind, ref_id)
+	values (new.stack_id * 4, new.words, 'sentence', new.stack_id);
+end;
+
+create trigger search_on_delete_stack
+after delete on stacks
+begin
+	delete from search where rowid = old.id * 4;
+end;
+
+create trigger search_on_new_phrase
+after insert on phrases
+begin
+	insert into search (rowid, body, kind, ref_id)
+	values (new.id * 4 + 1, new.words, 'phrase', new.id);
+end;
+
+create trigger search_on_rephrase
+after update of words on phrases
+begin
+	delete from search where rowid = old.id * 4 + 1;
+	insert into search (rowid, body, kind, ref_id)
+	values (new.id * 4 + 1, new.words, 'phrase', new.id);
+end;
+
+create trigger search_on_delete_phrase
+after delete on phrases
+begin
+	delete from search where rowid in (old.id * 4 + 1, old.id * 4 + 2);
+end;
+
+create trigger search_on_new_notes
+after insert on notes
+when new.words != ''
+begin
+	insert into search (rowid, body, kind, ref_id)
+	values (new.phrase_id * 4 + 2, new.words, 'notes', new.phrase_id);
+end;
+
+create trigger search_on_revise_notes
+after update of words on notes
+begin
+	delete from search where rowid = old.phrase_id * 4 + 2;
+	insert into search (rowid, body, kind, ref_id)
+	select new.phrase_id * 4 + 2, new.words, 'notes', new.phrase_id
+	where new.words != '';
+end;
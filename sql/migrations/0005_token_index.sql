@@ -0,0 +1,16 @@
+-- An inverted index over the latest sentence in each stack: one row per
+-- token and the position it sits at. The models keep it current, since
+-- tokens are normalized in python the same way phrases are. The rows for
+-- existing stacks are filled in by ferdinand_admin after this runs.
+create table tokens (
+	token text not null,
+	stack_id integer not null,
+	position integer not null,
+	primary key (token, stack_id, position),
+	constraint fk_token_stack
+	  foreign key(stack_id)
+	  references stacks(id)
+		on delete cascade
+) without rowid;
+
+create index tokens_stack_id on tokens(stack_id);
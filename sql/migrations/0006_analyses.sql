@@ -0,0 +1,14 @@
+-- spaCy's reading of each sentence revision: its tokens with their
+-- lemmas and parts of speech, and the noun chunks worth suggesting as
+-- phrases. Both are json, written by nlp.py, and tied to the model that
+-- produced them so a new model can be rerun over old analyses.
+create table analyses (
+	sentence_id integer primary key,
+	model text not null,
+	tokens text not null,
+	chunks text not null,
+	constraint fk_analysis_sentence
+	  foreign key(sentence_id)
+	  references sentences(id)
+		on delete cascade
+);
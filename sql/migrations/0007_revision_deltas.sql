@@ -0,0 +1,5 @@
+-- Older revisions can be compacted into a deflate stream primed with the
+-- next revision's text, leaving 'words' null. The newest sentence in each
+-- stack always keeps its words, so everything that reads the top of a
+-- stack is unaffected. See Sentence.revisions for reading them back.
+alter table sentences add column delta blob;
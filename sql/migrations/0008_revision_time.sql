@@ -0,0 +1,7 @@
+-- Reading a stack as of a point in time looks for its last revision at or
+-- before then. With the timestamp in the index that's one seek backwards
+-- from the time instead of a scan of the stack's whole history. The old
+-- index is a prefix of this one, so it goes.
+create index if not exists sentences_stack_timestamp
+	on sentences(stack_id, timestamp);
+drop index if exists sentences_stack_id;
@@ -0,0 +1,12 @@
+-- Row level changes, written by the model methods in the same transaction
+-- as the change, for the /events feed to read forward from by id. There
+-- are no foreign keys, so the news of a deletion outlives the row. Only
+-- the newest Event.KEPT are kept.
+create table events (
+	id integer primary key autoincrement,
+	kind text not null,
+	stack_id integer,
+	phrase_id integer,
+	data text,
+	timestamp timestamp default current_timestamp
+);
@@ -2,5 +2,5 @@ create table users (
 	id integer primary key autoincrement,
 	username varchar(25),
 	email varchar(100),
-	password varchar(500),
+	password varchar(500)
 );
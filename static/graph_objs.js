@@ -226,14 +226,23 @@ function makeConnections(edge, comsNodes, comsLinks) {
 };
 
 
-function buildComsSystem(graph) {
-    let comsNodes = {};
-    let comsLinks = {};
-    graph.nodes.forEach((node) => comsNodes[node.id] = buildNode(node));
-    graph.edges.forEach((edge) => {
-        comsLinks[`ln-${edge.source}-${edge.target}`] = buildLink(edge)
+function createComsSystem() {
+    return {nodes: {}, links: {}};
+}
+
+// Edges have to be added after (or with) both of their nodes, and before
+// d3 swaps their source and target ids for the node objects.
+function extendComsSystem(coms, batch) {
+    batch.nodes.forEach((node) => coms.nodes[node.id] = buildNode(node));
+    batch.edges.forEach((edge) => {
+        coms.links[`ln-${edge.source}-${edge.target}`] = buildLink(edge)
     });
-    graph.edges.forEach((edge) => makeConnections(edge, comsNodes, comsLinks));
+    batch.edges.forEach((edge) => makeConnections(edge, coms.nodes, coms.links));
+}
+
+function buildComsSystem(graph) {
+    const coms = createComsSystem();
+    extendComsSystem(coms, graph);
     
-    return comsNodes;
+    return coms.nodes;
 }
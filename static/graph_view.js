@@ -1,96 +1,327 @@
-fetch(endpoint)
-    .then(response => response.json())
-    .then(data => {
-        const coms = buildComsSystem(data);
-        drawGraph(data, coms);
-    })
-    .catch(error => console.error("error fetching data:", error));
+const graph = {nodes: [], edges: []};
+const coms = createComsSystem();
+
+const changes = followChanges(eventsEndpoint);
+
+// The feed is connected before the graph is read, so nothing changed
+// during a long load is missed.
+changes.opened.then(() => fetchLayout(layoutEndpoint)).then(layout => {
+    const view = drawGraph(graph, coms.nodes, layout);
+
+    return streamGraph(endpoint, (batch) => {
+        extendComsSystem(coms, batch);
+        if (layout) placeNodes(batch.nodes, layout);
+        graph.nodes.push(...batch.nodes);
+        graph.edges.push(...batch.edges);
+        view.update();
+    }).then(() => changes.follow(view));
+}).catch(error => console.error("error fetching data:", error));
+
+// Changes anyone makes to the project, applied to the graph in place. A
+// part of the graph only takes new nodes next to its own. Changes that
+// come in while the graph is still loading wait until it's done, and
+// may repeat what the load read, so applying one twice changes nothing.
+function followChanges(url) {
+    const whole = Boolean(layoutEndpoint);
+    const waiting = [];
+    let view = null;
+
+    const source = new EventSource(url);
+    const opened = new Promise(resolve => {
+        source.addEventListener("open", resolve, {once: true});
+        source.addEventListener("error", resolve, {once: true});
+    });
+    source.onmessage = (message) => {
+        const change = JSON.parse(message.data);
+        if (!view) waiting.push(change);
+        else if (applyChange(change, whole)) view.update();
+    };
+
+    return {
+        opened,
+        follow(drawn) {
+            view = drawn;
+            const changed = waiting.map(change => applyChange(change, whole));
+            if (changed.some(Boolean)) view.update();
+        },
+    };
+}
+
+const nodeId = (end) => typeof end === "object" ? end.id : end;
+const findNode = (id) => graph.nodes.find(node => node.id === id);
+
+// Returns whether the graph changed.
+function applyChange(change, whole) {
+    const sentence = change.stack_id && `s${change.stack_id}`;
+    const phrase = change.phrase_id && `p${change.phrase_id}`;
+
+    switch (change.kind) {
+        case "sentence_added":
+            return whole && addNode({id: sentence, words: change.words, type: "sentence"});
+        case "sentence_revised":
+            return setWords(sentence, change.words);
+        case "phrase_rephrased":
+            return setWords(phrase, change.words);
+        case "phrase_added": {
+            if (!whole && !findNode(sentence)) return false;
+            const added = addNode(
+                {id: phrase, words: change.words, stale: false, type: "phrase"}
+            );
+            return addEdge(sentence, phrase) || added;
+        }
+        case "phrase_stale": {
+            const node = findNode(phrase);
+            if (node) node.stale = change.stale;
+            return Boolean(node);
+        }
+        case "definition_set":
+            return addEdge(phrase, sentence);
+        case "sentence_deleted":
+            // The phrases found in a sentence go with it.
+            graph.edges
+                .filter(edge => nodeId(edge.source) === sentence)
+                .forEach(edge => removeNode(nodeId(edge.target)));
+            return removeNode(sentence);
+        case "phrase_deleted":
+            return removeNode(phrase);
+        case "imported":
+        case "reload":
+            location.reload();
+    }
+    return false;
+}
+
+function addNode(node) {
+    if (findNode(node.id)) return false;
+    extendComsSystem(coms, {nodes: [node], edges: []});
+    graph.nodes.push(node);
+    return true;
+}
+
+function setWords(id, words) {
+    const node = findNode(id);
+    if (!node) return false;
+
+    node.words = words;
+    coms.nodes[id].label.words = words;
+    return true;
+}
+
+// New edges start their new end off at the node it hangs from.
+function addEdge(source, target) {
+    const ends = [findNode(source), findNode(target)];
+    if (!source || !target || ends.includes(undefined)) return false;
+
+    const exists = graph.edges.some(
+        edge => nodeId(edge.source) === source && nodeId(edge.target) === target
+    );
+    if (exists) return false;
+    const id = `live-${source}-${target}`;
+
+    const edge = {id, source, target, type: "edge"};
+    extendComsSystem(coms, {nodes: [], edges: [edge]});
+    ends.forEach(end => {
+        if (end.x === undefined) {
+            const other = ends.find(node => node !== end);
+            end.x = other.x + 10;
+            end.y = other.y + 10;
+        }
+    });
+    graph.edges.push(edge);
+    return true;
+}
+
+function removeNode(id) {
+    const before = graph.nodes.length;
+    graph.nodes = graph.nodes.filter(node => node.id !== id);
+    graph.edges = graph.edges.filter(
+        edge => nodeId(edge.source) !== id && nodeId(edge.target) !== id
+    );
+    return graph.nodes.length !== before;
+}
+
+// Positions the server worked out for the whole graph, as flat arrays:
+// node i is sentences[i], or phrases[i - sentences.length] past those,
+// at (x[i], y[i]). Null when there's no layout to use.
+async function fetchLayout(url) {
+    if (!url) return null;
+
+    const response = await fetch(url);
+    if (!response.ok) return null;
+
+    const layout = await response.json();
+    const index = new Map();
+    layout.sentences.forEach((id, i) => index.set(`s${id}`, i));
+    const offset = layout.sentences.length;
+    layout.phrases.forEach((id, i) => index.set(`p${id}`, offset + i));
+    return {...layout, index};
+}
+
+// Nodes made since the layout get no place here and are put
+// somewhere by d3 when they join the simulation.
+function placeNodes(nodes, layout) {
+    nodes.forEach(node => {
+        const i = layout.index.get(node.id);
+        if (i !== undefined) {
+            node.x = layout.x[i];
+            node.y = layout.y[i];
+        }
+    });
+}
+
+// The endpoint sends one JSON object per line, nodes first. Hand each
+// chunk of complete lines over as it arrives rather than waiting for the
+// whole graph.
+async function streamGraph(url, onBatch) {
+    const response = await fetch(url);
+    const reader = response.body
+        .pipeThrough(new TextDecoderStream())
+        .getReader();
+
+    let buffer = "";
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += value;
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+        onBatch(parseLines(lines));
+    }
+    if (buffer) onBatch(parseLines([buffer]));
+}
+
+function parseLines(lines) {
+    const batch = {nodes: [], edges: []};
+    lines
+        .filter(line => line)
+        .map(line => JSON.parse(line))
+        .forEach(item => {
+            if (item.type === "edge") {
+                batch.edges.push(item);
+            } else {
+                batch.nodes.push(item);
+            }
+        });
+    return batch;
+}
 
 const addClassName = (node) => node.type === "phrase" ? "phrase_node" : "sentence_node";
 
 function buildUrl(node) {
     if (node.id[0] === "p") {
-        return `/phrases/${node.id.slice(1)}`;
+        return `${root}/phrases/${node.id.slice(1)}`;
     } else if (node.id[0] === "s") {
-        return `/sentences/${node.id.slice(1)}`;
+        return `${root}/sentences/${node.id.slice(1)}`;
     } else {
         console.log(`${node.id} is an invalid node id!`);
     }
 }
 
-function drawGraph(graph, coms) {
+function drawGraph(graph, coms, layout) {
     let width = 1200,
         height = 525
 
     const svg = d3.select("#chart")
         .attr("viewBox", `0 0 ${width} ${height}`)
 
-    // Simulation setup with forces
-    let simulation = d3.forceSimulation(graph.nodes)
-        .force("link", d3.forceLink(graph.edges).id(d => d.id))
+    // Simulation setup with forces, nodes and links get added on update
+    let simulation = d3.forceSimulation()
+        .force("link", d3.forceLink().id(d => d.id))
         .force("charge", d3.forceManyBody().strength(-500))
         .force("center", d3.forceCenter(width / 2, height / 2));
-    
-    // Add lines for every link in the graphset
-    const links = svg.append("g")
-        .attr("class", "links")
-        .selectAll("line")
-        .data(graph.edges)
-        .enter().append("line")
-        .attr("id", (d) => `ln-${d.source.id}-${d.target.id}`)
-        .attr("stroke", "#272f3f")
-        .attr("stroke-width", 2);
-    
-    // Add circles for every node in the graphset
-    const nodes = svg.append("g")
-        .attr("class", "nodes")
-        .selectAll("circle")
-        .data(graph.nodes)
-        .enter()
-        .append("a")
-        .attr("href", buildUrl)
-        .append("circle")
-        .attr("id", (d) => d.id)
-        .attr("r", 8)
-        .attr("class", addClassName)
-        .call(d3.drag()
-            .on("start", dragstarted)
-            .on("drag", dragged)
-            .on("end", dragended))
-        .on("mouseover", (_, obj) => coms[obj.id].handle("mouseover"))
-        .on("mouseout", (_, obj) => coms[obj.id].handle("mouseout"))
-
-    const labels = svg.append("g")
-        .attr("class", "labels")
-        .selectAll("text")
-        .data(graph.nodes)
-        .enter().append("text")
-        .attr("x", 8)
-        .attr("y", "0.31em")
-        .attr("display", "none")
-        .attr("id", (d) => `l-${d.id}`)
-        .text(d => shortenSentence(d.words));
-
-    // Define the drag behavior
+
+    // With a layout the simulation only resolves the links to their
+    // nodes, it never runs.
+    if (layout) simulation.stop();
+
+    const linkLayer = svg.append("g").attr("class", "links");
+    const nodeLayer = svg.append("g").attr("class", "nodes");
+    const labelLayer = svg.append("g").attr("class", "labels");
+
+    let links = linkLayer.selectAll("line");
+    let nodes = nodeLayer.selectAll("circle");
+    let labels = labelLayer.selectAll("text");
+
+    // Join whatever is in the graph so far, only new nodes and links get
+    // elements added, existing ones keep their place.
+    function update() {
+        simulation.nodes(graph.nodes);
+        simulation.force("link").links(graph.edges);
+
+        // Add lines for every link in the graphset
+        links = linkLayer.selectAll("line")
+            .data(graph.edges, d => d.id)
+            .join("line")
+            .attr("id", (d) => `ln-${d.source.id}-${d.target.id}`)
+            .attr("stroke", "#272f3f")
+            .attr("stroke-width", 2);
+
+        // Add circles for every node in the graphset
+        nodes = nodeLayer.selectAll("a")
+            .data(graph.nodes, d => d.id)
+            .join(enter => {
+                const anchor = enter.append("a").attr("href", buildUrl);
+                anchor.append("circle")
+                    .attr("id", (d) => d.id)
+                    .attr("r", 8)
+                    .attr("class", addClassName)
+                    .call(d3.drag()
+                        .on("start", dragstarted)
+                        .on("drag", dragged)
+                        .on("end", dragended))
+                    .on("mouseover", (_, obj) => coms[obj.id].handle("mouseover"))
+                    .on("mouseout", (_, obj) => coms[obj.id].handle("mouseout"));
+                return anchor;
+            })
+            .select("circle");
+
+        labels = labelLayer.selectAll("text")
+            .data(graph.nodes, d => d.id)
+            .join(enter => enter.append("text")
+                .attr("x", 8)
+                .attr("y", "0.31em")
+                .attr("display", "none")
+                .attr("id", (d) => `l-${d.id}`))
+            .text(d => shortenSentence(d.words));
+
+        if (layout) {
+            render();
+        } else {
+            simulation.alpha(1).restart();
+        }
+    }
+
+    // Define the drag behavior, which just moves the node when it was
+    // laid out by the server.
     function dragstarted(event) {
+        if (layout) return;
         if (!event.active) simulation.alphaTarget(0.3).restart();
         event.subject.fx = event.subject.x;
         event.subject.fy = event.subject.y;
     }
 
     function dragged(event) {
+        if (layout) {
+            event.subject.x = event.x;
+            event.subject.y = event.y;
+            render();
+            return;
+        }
         event.subject.fx = event.x;
         event.subject.fy = event.y;
     }
 
     function dragended(event) {
+        if (layout) return;
         if (!event.active) simulation.alphaTarget(0);
         event.subject.fx = null;
         event.subject.fy = null;
     }
 
-    // Update positions each tick
-    simulation.on("tick", () => {
+    // Put every element where its node is, on each tick of the
+    // simulation, or straight away when the nodes came laid out.
+    function render() {
         nodes
             .attr("cx", d => d.x)
             .attr("cy", d => d.y);
@@ -104,6 +335,9 @@ function drawGraph(graph, coms) {
             .attr("y1", d => d.source.y)
             .attr("x2", d => d.target.x)
             .attr("y2", d => d.target.y);
-          });
-}
+    }
+
+    simulation.on("tick", render);
 
+    return { update };
+}
@@ -1,10 +1,47 @@
 import json
 import datetime
 from pathlib import Path
-from pytest import fixture
-from sqlalchemy import create_engine
-from models import Sentence, Phrase
-from ferdinand_admin import create_new_project, switch_to_project, PROJECTS_PATH
+from pytest import fixture, importorskip, raises
+from sqlalchemy import text
+from database import (
+    EnginePool,
+    create_project_engine,
+    create_sqlite_engine,
+)
+from notes import RenderCache
+import change_feed
+import metrics
+import nlp
+from bench_models import import_times
+from transfer import (
+    export_records,
+    import_corpus,
+    read_records,
+    snapshot,
+    split_sentences,
+)
+from phrase_models import (
+    Analysis,
+    Event,
+    writer_lock,
+    Sentence,
+    Phrase,
+    Graph,
+    Search,
+    Statements,
+    Version,
+    unit_of_work,
+)
+from user_models import Project
+from ferdinand_admin import (
+    create_new_project,
+    create_schema,
+    switch_to_project,
+    migrate,
+    PROJECTS_PATH,
+    SCHEMA,
+    SQL_INIT,
+)
 
 SAVE_CONFIG = {"current_project": "default"}
 
@@ -25,17 +62,19 @@ def setup_module():
 def teardown_module():
     test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
     switch_to_project(SAVE_CONFIG["current_project"])
-    Path.unlink(PROJECTS_PATH / f"{test_db}.sqlite3")
+    for suffix in ("", "-wal", "-shm"):
+        Path.unlink(
+            PROJECTS_PATH / f"{test_db}.sqlite3{suffix}", missing_ok=True
+        )
 
 
 @fixture
 def db():
     test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
-    db = create_engine(f"sqlite:///projects/{test_db}.sqlite3")
+    db = create_project_engine(test_db)
 
-    con = db.connect()
-    yield con
-    con.close()
+    with unit_of_work(db) as con:
+        yield con
 
 
 # [x] Sentence Interface
@@ -96,6 +135,282 @@ def test_get_sentence_after_updates(db):
     assert sentence.words == new_words
 
 
+# CONNECTION PROFILE
+def test_engine_applies_pragmas(db):
+    assert db.execute(text("PRAGMA journal_mode;")).scalar() == "wal"
+    assert db.execute(text("PRAGMA foreign_keys;")).scalar() == 1
+
+
+# PROJECT VERSION
+def test_writes_bump_version(db):
+    before = Version.current(db)
+    stack_id = Sentence().new("Counting changes.", db)
+    Sentence().get(stack_id, db)
+    after_new = Version.current(db)
+    Phrase().new(stack_id, "changes", db)
+
+    assert after_new > before
+    assert Version.current(db) > after_new
+
+
+def test_writers_queue_behind_one_lock(tmp_path):
+    engine = create_sqlite_engine(f"sqlite:///{tmp_path / 'writes.sqlite3'}")
+
+    with unit_of_work(engine, write=True) as db:
+        assert writer_lock(engine).locked()
+        db.execute(text("create table counts (n integer);"))
+    assert not writer_lock(engine).locked()
+
+    with raises(ZeroDivisionError):
+        with unit_of_work(engine, write=True) as db:
+            db.execute(text("insert into counts values (1);"))
+            1 / 0
+
+    with unit_of_work(engine) as db:
+        assert db.execute(text("select count(*) from counts;")).scalar() == 0
+    engine.dispose()
+
+
+def test_server_settings():
+    from serve import load_settings
+
+    settings = load_settings({"server": {"workers": 2}}, threads=8, bind=None)
+    assert settings["workers"] == 2
+    assert settings["threads"] == 8
+    assert settings["bind"] == "127.0.0.1:8000"
+    with raises(ValueError):
+        load_settings({}, workers=0)
+
+
+def test_conditional_gets_follow_the_version(db):
+    from ferdinand import app, response_cache
+
+    test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
+    url = f"/p/{test_db}/phrases?status=STUCK"
+    client = app.test_client()
+    response_cache.clear()
+
+    first = client.get(url)
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    # Keyed by the request's full path, which is the url itself here.
+    version = Version.current(db)
+    assert response_cache.get(url, version) == (first.data, first.mimetype)
+
+    engine = create_project_engine(test_db)
+    with unit_of_work(engine, write=True) as con:
+        phrase_id = Phrase().new(None, "conditional", con)
+        Phrase().set_status(phrase_id, "STUCK", con)
+
+    second = client.get(url, headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert b"conditional" in second.data
+    assert response_cache.get(url, version) is None
+
+
+# SERVING SEVERAL PROJECTS
+def test_engine_pool_evicts_least_recently_used():
+    test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
+    pool = EnginePool(maxsize=1)
+    engine = pool.get(test_db)
+
+    assert pool.get(test_db) is engine
+    with raises(FileNotFoundError):
+        pool.get("no_such_project")
+    with raises(ValueError):
+        pool.get("../outside")
+
+    pool.idle_seconds = 0
+    pool.get(test_db)
+    assert pool.get(test_db) is not engine
+    assert len(pool) == 1
+
+
+def test_registry_mirrors_projects_folder(tmp_path):
+    registry = create_sqlite_engine("sqlite://")
+    (tmp_path / "first.sqlite3").touch()
+    (tmp_path / "not.a.project.sqlite3").touch()
+
+    with unit_of_work(registry) as db:
+        db.execute(text((SQL_INIT / "users.sql").read_text()))
+        db.execute(text((SQL_INIT / "projects.sql").read_text()))
+        Project.register("gone", db)
+        Project.sync(db, tmp_path)
+        Project.sync(db, tmp_path)
+
+        assert [p.project_name for p in Project.all(db)] == ["first"]
+
+
+def test_definition_redirect_stays_in_its_project():
+    from ferdinand import app
+
+    test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
+    other = f"{test_db}_other"
+    create_new_project(other)
+    switch_to_project(test_db)
+    try:
+        with unit_of_work(create_project_engine(other), write=True) as db:
+            stack_id = Sentence().new("The cat sat.", db)
+            phrase_id = Phrase().new(stack_id, "cat", db)
+
+        response = app.test_client().post(
+            f"/p/{other}/definitions",
+            data={"phrase_id": phrase_id, "definition": "A small pet."},
+        )
+
+        assert response.status_code == 302
+        assert response.location == f"/p/{other}/phrases/{phrase_id}?inline=yes"
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            Path.unlink(
+                PROJECTS_PATH / f"{other}.sqlite3{suffix}", missing_ok=True
+            )
+
+
+# MIGRATING AN EXISTING PROJECT
+def test_migrate_sets_stack_heads():
+    con = create_sqlite_engine("sqlite://").connect()
+    for file in SCHEMA:
+        con.execute(text((SQL_INIT / file).read_text()))
+    con.execute(text("insert into stacks default values;"))
+    con.execute(
+        text("insert into sentences (stack_id, words) values (1, :words);"),
+        [{"words": "The first take."}, {"words": "The second take."}],
+    )
+    con.commit()
+
+    migrate(con)
+    migrate(con)  # running it again is a no-op
+
+    assert Sentence().get(1, con).words == "The second take."
+    assert con.execute(text("select count(*) from tokens;")).scalar() == 3
+    con.close()
+
+
+# SENTENCE PAGES
+def test_sentence_pages(db):
+    stack_ids = [Sentence().new(f"Sentence number {n}.", db) for n in range(5)]
+    Sentence().goes_stale(stack_ids[1], db)
+
+    first = Sentence().page(db, after=stack_ids[0] - 1, limit=3)
+    second = Sentence().page(db, after=first[-1].id, limit=3)
+    stale = Sentence().page(db, after=stack_ids[0] - 1, stale=True)
+
+    assert [s.id for s in first + second] == stack_ids
+    assert [s.id for s in stale] == [stack_ids[1]]
+    assert len(Sentence().page(db, limit=-5)) == 1
+    assert [s.id for s in Sentence().last_page(db, limit=2)] == stack_ids[3:]
+
+
+def test_listing_routes_keep_limits_in_range():
+    from ferdinand import app
+
+    test_db = f"test_{datetime.datetime.now().strftime('%Y%m%d')}"
+    client = app.test_client()
+
+    for listing in ("sentences", "phrases"):
+        for limit in (0, -5):
+            response = client.get(f"/p/{test_db}/{listing}?limit={limit}")
+            assert response.status_code == 200
+
+    response = client.post(
+        f"/p/{test_db}/sentences?limit=1", data={"words": "Newest of all."}
+    )
+    assert "Newest of all." in response.get_data(as_text=True)
+
+
+# SENTENCE HISTORY
+def test_sentence_history(db):
+    words = "This is a sentence with a history."
+    stack_id = Sentence().new(words, db)
+    Sentence().update(stack_id, "This is a sentence with a past.", db)
+
+    history = Sentence().history(stack_id, db)
+
+    assert [revision.words for revision in history] == [
+        words,
+        "This is a sentence with a past.",
+    ]
+
+
+def test_compacted_history_reads_back(db):
+    drafts = [f"Media are extensions of {who}." for who in ("man", "us", "all")]
+    stack_id = Sentence().new(drafts[0], db)
+    for words in drafts[1:]:
+        Sentence().update(stack_id, words, db)
+
+    assert Sentence().compact(stack_id, db) == 2
+    assert Sentence().compact(stack_id, db) == 0
+    Sentence().update(stack_id, "Media are extensions.", db)
+    assert Sentence().compact(stack_id, db) == 1
+
+    history = Sentence().history(stack_id, db)
+    assert [r.words for r in history] == drafts + ["Media are extensions."]
+    assert [r.words for r in Sentence().history(stack_id, db, limit=2)] == [
+        drafts[-1],
+        "Media are extensions.",
+    ]
+    assert Sentence().get(stack_id, db).words == "Media are extensions."
+
+    [stack] = [
+        r
+        for r in export_records(db)
+        if r["type"] == "stack" and r["id"] == stack_id
+    ]
+    assert [r["words"] for r in stack["revisions"]] == [r.words for r in history]
+
+
+def test_reads_as_of_and_diffs(db):
+    stack_id = Sentence().new("The medium is the message.", db)
+    Sentence().update(stack_id, "The medium is the massage.", db)
+    Sentence().update(stack_id, "The medium is a massage.", db)
+    phrase_id = Phrase().new(None, "medium", db)
+    Phrase().revise_definition(phrase_id, "A carrier.", db)
+    def_stack_id = Phrase().get(phrase_id, db).def_stack_id
+    Sentence().update(def_stack_id, "A carrier of content.", db)
+
+    first, second, third = Sentence().history(stack_id, db)
+    for day, revision in enumerate([first, second, third], start=1):
+        db.execute(
+            text("update sentences set timestamp = :t where id = :id;"),
+            {"t": f"1964-01-0{day} 12:00:00", "id": revision.id},
+        )
+    db.execute(
+        text("update sentences set timestamp = :t where stack_id = :id;"),
+        {"t": "1964-01-02 12:00:00", "id": def_stack_id},
+    )
+    Sentence().compact(stack_id, db)
+
+    as_of = datetime.datetime(1964, 1, 2, 13, tzinfo=datetime.timezone.utc)
+    assert Sentence().get(stack_id, db, as_of=as_of).words == second.words
+    assert Sentence().get(stack_id, db, as_of="1964-01-01T12:30").words == (
+        first.words
+    )
+    assert Sentence().get(stack_id, db, as_of="1964-01-01") is None
+    stacks = {row.id: row.words for row in Sentence().all(db, as_of=as_of)}
+    assert stacks[stack_id] == second.words
+    [phrase] = [p for p in Phrase().all(db, as_of=as_of) if p.id == phrase_id]
+    assert phrase.definition == "A carrier of content."
+    with raises(ValueError):
+        Sentence().get(stack_id, db, as_of="last tuesday")
+
+    assert Sentence().diff(stack_id, db)["changes"] == [
+        {"op": "equal", "words": "The medium is"},
+        {"op": "delete", "words": "the"},
+        {"op": "insert", "words": "a"},
+        {"op": "equal", "words": "massage."},
+    ]
+    diff = Sentence().diff(stack_id, db, old=first.id, new=third.id)
+    assert [c["op"] for c in diff["changes"]] == [
+        "equal",
+        "delete",
+        "insert",
+    ]
+    assert Sentence().diff(stack_id, db, old=-1) is None
+
+
 # SENTENCE DELETE
 def test_delete_sentence(db):
     words = "This is the fifth sentence."
@@ -147,6 +462,22 @@ def test_get_for_sentence(db):
     assert phrases[0].definition_status == "NEW"
 
 
+def test_phrase_pages(db):
+    stack_id = Sentence().new("One two three four.", db)
+    phrase_ids = [
+        Phrase().new(stack_id, word, db) for word in ["one", "two", "three"]
+    ]
+    Phrase().set_status(phrase_ids[2], "STUCK", db)
+
+    first = Phrase().page(db, after=phrase_ids[0] - 1, limit=2)
+    second = Phrase().page(db, after=first[-1].id, limit=2)
+    stuck = Phrase().page(db, after=phrase_ids[0] - 1, status="STUCK")
+
+    assert [p.id for p in first + second] == phrase_ids
+    assert [p.id for p in stuck] == [phrase_ids[2]]
+    assert [p.id for p in Phrase().last_page(db, limit=1)] == phrase_ids[2:]
+
+
 # PHRASE UPDATE
 # This is really an alias of a sentence and status update
 # So don't call it an update.
@@ -191,6 +522,37 @@ def test_stale_def(db):
     assert phrase.stale == True
 
 
+def test_stale_only_touches_edited_stack(db):
+    stack_id = Sentence().new("The cat sat on the mat.", db)
+    other_stack_id = Sentence().new("A dog sat on a log.", db)
+    cat_id = Phrase().new(stack_id, "the cat", db)
+    dog_id = Phrase().new(other_stack_id, "a dog", db)
+    Sentence().update(other_stack_id, "A frog sat on a log.", db)
+
+    Sentence().update(stack_id, "The Cat, sat on the concatenated mat.", db)
+
+    assert not Phrase().get(cat_id, db).stale
+    assert Phrase().get(dog_id, db).stale
+
+    Sentence().update(stack_id, "The category sat on the mat.", db)
+
+    assert Phrase().get(cat_id, db).stale
+
+
+def test_unit_of_work_rolls_back_together(db):
+    engine = db.engine
+    try:
+        with unit_of_work(engine) as con:
+            stack_id = Sentence().new("This sentence never lands.", con)
+            Phrase().new(stack_id, "never lands", con)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    with engine.connect() as con:
+        assert Sentence().get(stack_id, con) is None
+
+
 # PHRASE DELETE
 def test_delete_phrase(db):
     words = "This is the best sentence."
@@ -258,6 +620,436 @@ def test_update_notes(db):
     
     test_notes = "Here is a set of notes to save"
     Phrase().revise_notes(phrase_id, test_notes, db)
-    phrase = Phrase().get(phrase_id, db, include_notes=True)
+    phrase = Phrase().get(phrase_id, db)
 
     assert phrase.notes == test_notes
+
+
+def test_phrase_occurrences(db):
+    stack_id = Sentence().new("We live in a Global Village now.", db)
+    other_id = Sentence().new("The global village, McLuhan said.", db)
+    apart_id = Sentence().new("A global and connected village.", db)
+    phrase_id = Phrase().new(stack_id, "global village", db)
+
+    found = [s.id for s in Phrase().occurrences(phrase_id, db)]
+    assert stack_id in found and other_id in found
+    assert apart_id not in found
+
+    Sentence().update(other_id, "The village went global.", db)
+    Sentence().delete(stack_id, db)
+    found = [s.id for s in Phrase().occurrences(phrase_id, db)]
+    assert other_id not in found and stack_id not in found
+
+
+# GRAPH
+def test_stream_graph_yields_nodes_before_their_edges(db):
+    stack_id = Sentence().new("The graph has a shape.", db)
+    phrase_id = Phrase().new(stack_id, "a shape", db)
+    Phrase().revise_definition(phrase_id, "The outline of a thing.", db)
+
+    seen = set()
+    for item in Graph.stream_graph(db):
+        if item["type"] == "edge":
+            assert item["source"] in seen and item["target"] in seen
+        else:
+            seen.add(item["id"])
+
+    assert f"p{phrase_id}" in seen
+
+
+def test_neighborhood(db):
+    stack_id = Sentence().new("Media is the message.", db)
+    media_id = Phrase().new(stack_id, "media", db)
+    Phrase().revise_definition(media_id, "Any extension of ourselves.", db)
+    def_stack_id = Phrase().get(media_id, db).def_stack_id
+    extension_id = Phrase().new(def_stack_id, "extension", db)
+    Phrase().revise_definition(extension_id, "A new scale.", db)
+    far_stack_id = Phrase().get(extension_id, db).def_stack_id
+
+    near = Graph.collect(Graph.stream_neighborhood(("s", stack_id), db, depth=2))
+    far = Graph.collect(Graph.stream_neighborhood(("s", stack_id), db, depth=4))
+    capped = Graph.collect(
+        Graph.stream_neighborhood(("s", stack_id), db, depth=4, max_nodes=2)
+    )
+
+    near_ids = {node["id"] for node in near["nodes"]}
+    assert near_ids == {f"s{stack_id}", f"p{media_id}", f"s{def_stack_id}"}
+    assert len(near["edges"]) == 2
+    assert f"s{far_stack_id}" in {node["id"] for node in far["nodes"]}
+    assert len(capped["nodes"]) == 2
+    negative = Graph.collect(
+        Graph.stream_neighborhood(
+            ("s", stack_id), db, depth=4, max_nodes=-1, max_edges=-1
+        )
+    )
+    assert negative == {"nodes": [], "edges": []}
+
+
+def test_layout_places_every_node_once_per_version(db):
+    graph_layout = importorskip("graph_layout")
+    stack_id = Sentence().new("Hot media extend one sense.", db)
+    phrase_id = Phrase().new(stack_id, "hot media", db)
+    Phrase().revise_definition(phrase_id, "Media high in definition.", db)
+
+    graph = graph_layout.load_arrays(db)
+    nodes = Graph.collect(Graph.stream_graph(db))
+    assert graph.size == len(nodes["nodes"])
+    assert len(graph.sources) == len(nodes["edges"])
+
+    cache = graph_layout.LayoutCache()
+    version = Version.current(db)
+    assert cache.get("test", version) is None
+
+    _, positions = cache.store("test", version, graph)
+    assert cache.get("test", version)[1] is positions
+    assert cache.arrays("test", version) is graph
+    assert positions.shape == (graph.size, 2)
+    assert (positions >= 0).all()
+    assert (positions <= [graph_layout.WIDTH, graph_layout.HEIGHT]).all()
+
+    Sentence().new("Cool media leave much to be filled in.", db)
+    assert cache.get("test", Version.current(db)) is None
+    graph, moved = cache.store(
+        "test", Version.current(db), graph_layout.load_arrays(db)
+    )
+    assert len(moved) == graph.size
+
+
+def test_graph_analytics_finds_depths_and_circular_definitions(db):
+    graph_analytics = importorskip("graph_analytics")
+    from graph_layout import load_arrays
+
+    stack_id = Sentence().new("The medium is the message.", db)
+    medium = Phrase().new(stack_id, "medium", db)
+    Phrase().revise_definition(medium, "Any extension of ourselves.", db)
+    definition_id = Phrase().get(medium, db).def_stack_id
+    extension = Phrase().new(definition_id, "extension", db)
+    Phrase().revise_definition(extension, "An amputation.", db)
+    message = Phrase().new(stack_id, "message", db)
+    # 'message' is defined by the sentence it was found in.
+    db.execute(
+        Statements.new_definition, {"phrase_id": message, "stack_id": stack_id}
+    )
+
+    cache = graph_analytics.AnalyticsCache()
+    version = Version.current(db)
+    assert cache.get("test", version) is None
+    analytics = cache.store("test", version, load_arrays(db))
+    assert cache.get("test", version) is analytics
+    depths = {
+        row["id"]: row["depth"]
+        for row in graph_analytics.depth_report(analytics, 10_000)["phrases"]
+    }
+    assert depths[f"p{extension}"] == 1
+    assert depths[f"p{medium}"] == 2
+    assert depths[f"p{message}"] is None
+    assert {f"p{message}", f"s{stack_id}"} in [
+        set(cycle)
+        for cycle in graph_analytics.cycle_report(analytics, 10_000)["cycles"]
+    ]
+
+    leaves = graph_analytics.leaf_report(analytics, 10_000)
+    assert f"p{extension}" not in leaves["undefined"]
+    assert len(leaves["undefined"]) == leaves["count"]
+    assert graph_analytics.leaf_report(analytics, 1)["undefined"] == (
+        leaves["undefined"][:1]
+    )
+    components = graph_analytics.component_report(analytics, 1)["components"]
+    assert components[0]["size"] >= 5
+
+
+# NOTES
+def test_render_cache_hits_on_unchanged_notes():
+    cache = RenderCache(maxsize=2)
+    renders = []
+
+    def render(markup):
+        renders.append(markup)
+        return markup.upper()
+
+    assert cache.get_or_render("# notes", render) == "# NOTES"
+    assert cache.get_or_render("# notes", render) == "# NOTES"
+    cache.get_or_render("other", render)
+    cache.get_or_render("third", render)
+    cache.get_or_render("# notes", render)
+
+    assert renders == ["# notes", "other", "third", "# notes"]
+    assert cache.info()["hits"] == 1
+    assert cache.info()["size"] == 2
+
+
+# BULK IMPORT
+def test_import_corpus(db, tmp_path):
+    corpus = tmp_path / "corpus.jsonl"
+    corpus.write_text(
+        json.dumps(
+            {
+                "words": "The medium is the message.",
+                "phrases": [
+                    "The Medium,",
+                    {"words": "message", "notes": "Read chapter one."},
+                ],
+            }
+        )
+        + "\n"
+    )
+    before = Version.current(db)
+
+    assert import_corpus(corpus, db.engine, progress=False) == 1
+
+    stack_id = Sentence().all(db)[-1].id
+    phrases = Phrase().get_for_sentence(stack_id, db)
+    assert Sentence().get(stack_id, db).words == "The medium is the message."
+    assert [p.words for p in phrases] == ["the medium", "message"]
+    assert phrases[1].notes == "Read chapter one."
+    assert Version.current(db) > before
+
+
+def test_import_never_reuses_deleted_ids(tmp_path):
+    engine = create_sqlite_engine(f"sqlite:///{tmp_path / 'ids.sqlite3'}")
+    with engine.connect() as db:
+        create_schema(db)
+    with unit_of_work(engine, write=True) as db:
+        Sentence().new("Kept.", db)
+        deleted = Sentence().new("Deleted.", db)
+        Sentence().delete(deleted, db)
+
+    corpus = tmp_path / "corpus.txt"
+    corpus.write_text("Imported.\n")
+    import_corpus(corpus, engine, progress=False)
+
+    with engine.connect() as db:
+        assert Sentence().all(db)[-1].id > deleted
+    engine.dispose()
+
+
+def test_read_csv_with_and_without_a_header(tmp_path):
+    with_header = tmp_path / "with.csv"
+    with_header.write_text("id,words,phrases\n1,The cat sat.,cat;sat\n")
+    without = tmp_path / "without.csv"
+    without.write_text("The cat sat.\nThe dog ran.\n")
+    empty = tmp_path / "empty.csv"
+    empty.write_text("")
+
+    assert list(read_records(with_header)) == [
+        {"words": "The cat sat.", "phrases": ["cat", "sat"]}
+    ]
+    assert [r["words"] for r in read_records(without)] == [
+        "The cat sat.",
+        "The dog ran.",
+    ]
+    with raises(ValueError):
+        list(read_records(empty))
+
+
+def test_split_sentences():
+    assert split_sentences("One thing. Another? Yes!  Done") == [
+        "One thing.",
+        "Another?",
+        "Yes!",
+        "Done",
+    ]
+
+
+# EXPORT
+def test_export_records_include_history(db):
+    stack_id = Sentence().new("A first draft.", db)
+    Sentence().update(stack_id, "A second draft.", db)
+    phrase_id = Phrase().new(stack_id, "second draft", db)
+
+    records = {(r["type"], r["id"]): r for r in export_records(db)}
+    stack = records[("stack", stack_id)]
+    phrase = records[("phrase", phrase_id)]
+
+    assert [r["words"] for r in stack["revisions"]] == [
+        "A first draft.",
+        "A second draft.",
+    ]
+    assert phrase["stack_id"] == stack_id
+    assert phrase["definition_status"] == "NEW"
+
+
+def test_snapshot(db, tmp_path):
+    stack_id = Sentence().new("Worth keeping a copy of.", db)
+    db.commit()
+
+    snapshot(db.engine, tmp_path / "copy.sqlite3")
+
+    copy_engine = create_sqlite_engine(f"sqlite:///{tmp_path / 'copy.sqlite3'}")
+    with copy_engine.connect() as copy:
+        assert Sentence().get(stack_id, copy).words == "Worth keeping a copy of."
+
+
+# SEARCH
+def test_search_follows_edits(db):
+    stack_id = Sentence().new("Xylophones ring out over the village.", db)
+    phrase_id = Phrase().new(stack_id, "xylophones ring", db)
+    Phrase().revise_definition(phrase_id, "Zithers hum under xylophones.", db)
+    Phrase().revise_notes(phrase_id, "Quagga notes.", db)
+
+    hits = {(hit["kind"], hit["id"]) for hit in Search.query("xylo", db)}
+    assert ("sentence", stack_id) in hits
+    assert ("phrase", phrase_id) in hits
+    assert Search.query("zither", db)[0]["kind"] == "definition"
+    assert Search.query("zither", db)[0]["phrase_id"] == phrase_id
+    assert Search.query("quagga", db)[0]["kind"] == "notes"
+    assert "<mark>" in Search.query("quagga", db)[0]["snippet"]
+
+    Sentence().update(stack_id, "Marimbas ring out over the village.", db)
+    Phrase().rephrase(phrase_id, "marimbas ring", db)
+    assert ("sentence", stack_id) not in {
+        (hit["kind"], hit["id"]) for hit in Search.query("xylophones", db)
+    }
+    assert len(Search.query("marimbas", db)) == 2
+    assert Search.query('") OR (', db) == []
+
+    dense = Sentence().new("Ocarina ocarina ocarina.", db)
+    sparse = Sentence().new("An ocarina among many other instruments.", db)
+    ranked = [hit["id"] for hit in Search.query("ocarina", db)]
+    assert ranked.index(dense) < ranked.index(sparse)
+
+
+# NLP
+def test_doc_analysis_numbers_tokens_by_word():
+    spacy = importorskip("spacy")
+    from spacy.tokens import Doc
+
+    doc = Doc(
+        spacy.blank("en").vocab,
+        words=["We", "live", "in", "the", "global", "village", "."],
+        spaces=[True, True, True, True, True, False, False],
+        pos=["PRON", "VERB", "ADP", "DET", "ADJ", "NOUN", "PUNCT"],
+        deps=["nsubj", "ROOT", "prep", "det", "amod", "pobj", "punct"],
+        heads=[1, 1, 1, 5, 5, 2, 1],
+    )
+    analysis = nlp.doc_analysis(doc)
+
+    assert analysis["tokens"][-1] == [".", "", "PUNCT", 5]
+    assert analysis["chunks"] == [[4, 5]]
+
+
+def test_suggestions_come_from_stored_analyses(db, monkeypatch):
+    monkeypatch.setattr(nlp, "pipeline", nlp.Pipeline("no_such_model"))
+    stack_id = Sentence().new("We live in the Global Village.", db)
+    sentence = Sentence().get(stack_id, db)
+
+    assert nlp.suggestions(sentence, [], Analysis.get(stack_id, db)) == []
+    # Unanalyzed sentences go without, rather than being parsed.
+    assert not nlp.pipeline._loaded
+
+    sentence_id = Analysis.get(stack_id, db)["sentence_id"]
+    version = Version.current(db)
+    Analysis.save(
+        [
+            {
+                "sentence_id": sentence_id,
+                "model": "test",
+                "tokens": [],
+                "chunks": [[0, 0], [4, 5]],
+            }
+        ],
+        db,
+    )
+    assert Version.current(db) == version
+    Phrase().new(stack_id, "we", db)
+    phrases = Phrase().get_for_sentence(stack_id, db)
+
+    [suggestion] = nlp.suggestions(
+        sentence, phrases, Analysis.get(stack_id, db)
+    )
+    assert suggestion["words"] == "global village"
+    assert suggestion["form"] == {
+        "sentence": stack_id,
+        "5@@Global": "on",
+        "6@@Village.": "on",
+    }
+
+
+# STARTUP
+def test_cli_imports_stay_light():
+    admin = import_times("ferdinand_admin")
+    app = import_times("ferdinand")
+
+    assert not {"sqlalchemy", "flask", "mistune", "nh3", "spacy"} & set(admin)
+    assert not {"mistune", "nh3", "numpy", "spacy", "tqdm"} & set(app)
+
+
+# CHANGE FEED
+def test_writes_emit_events_the_feed_streams(tmp_path):
+    engine = create_sqlite_engine(f"sqlite:///{tmp_path / 'feed.sqlite3'}")
+    with engine.connect() as db:
+        create_schema(db)
+
+    with unit_of_work(engine, write=True) as db:
+        stack_id = Sentence().new("The cat sat.", db)
+        phrase_id = Phrase().new(stack_id, "cat", db)
+        Sentence().update(stack_id, "The dog sat.", db)
+
+    with engine.connect() as db:
+        events = Event.since(0, db)
+    assert [event["kind"] for event in events] == [
+        "sentence_added",
+        "phrase_added",
+        "sentence_revised",
+        "phrase_stale",
+    ]
+    assert events[-1]["phrase_id"] == phrase_id and events[-1]["stale"]
+
+    with raises(ZeroDivisionError):
+        with unit_of_work(engine, write=True) as db:
+            Phrase().delete(phrase_id, db)
+            1 / 0
+
+    feed = "".join(
+        change_feed.stream(engine, after=events[0]["id"], seconds=0.05, poll=0.01)
+    )
+    assert "phrase_deleted" not in feed
+    assert f"event: sentence-{stack_id}-phrases\n" in feed
+    assert f"event: phrase-{phrase_id}\n" in feed
+    assert f"id: {events[-1]['id']}\n" in feed
+
+    quiet = list(change_feed.stream(engine, seconds=0.05, poll=0.01))
+    assert quiet == [
+        f"retry: {change_feed.RETRY_MILLISECONDS}\nid: {events[-1]['id']}\n\n"
+    ]
+    assert len(change_feed.slots) == 0
+
+    change_feed.slots.limit = 0
+    try:
+        busy = list(change_feed.stream(engine, after=0, seconds=0.05))
+    finally:
+        change_feed.slots.limit = change_feed.MAX_STREAMS
+    assert busy == [f"retry: {change_feed.BUSY_RETRY_MILLISECONDS}\n\n"]
+    engine.dispose()
+
+
+# METRICS
+def test_metrics_count_requests_and_statements():
+    from flask import Flask
+
+    app = Flask("metrics_test")
+    engine = create_sqlite_engine("sqlite://")
+    metrics.install(app)
+    metrics.clear()
+
+    @app.route("/twice")
+    def twice():
+        with engine.connect() as db:
+            db.execute(text("select 1;"))
+            db.execute(text("select 2;"))
+        return "ok"
+
+    app.test_client().get("/twice")
+
+    assert metrics.request_seconds.count("/twice", "GET", "200") == 1
+    assert metrics.query_seconds.count("select 1") == 1
+    assert 'ferdinand_request_queries_sum{route="/twice",method="GET"} 2' in (
+        metrics.render()
+    )
+
+    strict = Flask("strict_metrics_test")
+    metrics.install(strict, slow_query_ms=5)
+    with strict.app_context():
+        assert metrics.slow_query_threshold() == 5
+    with app.app_context():
+        assert metrics.slow_query_threshold() == metrics.SLOW_QUERY_MS
@@ -0,0 +1,287 @@
+"""
+Moving sentences and phrases in and out of a project in bulk.
+"""
+
+from pathlib import Path
+from itertools import chain, groupby, islice
+from typing import Iterator, TextIO
+import csv
+import json
+import re
+import sqlite3
+
+from sqlalchemy import Engine, text
+from tqdm import tqdm
+
+from phrase_models import (
+    Event,
+    Statements,
+    Version,
+    postings,
+    restore_words,
+    tokenize,
+    unit_of_work,
+)
+
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+BATCH_SIZE = 5_000
+
+
+def split_sentences(paragraph: str) -> list[str]:
+    return [s.strip() for s in SENTENCE_END.split(paragraph) if s.strip()]
+
+
+def read_text(path: Path) -> Iterator[dict]:
+    """Plain text, with blank lines between paragraphs."""
+    with open(path, encoding="utf-8") as f:
+        paragraph = []
+        for line in f:
+            if line.strip():
+                paragraph.append(line.strip())
+                continue
+            yield from (
+                {"words": words}
+                for words in split_sentences(" ".join(paragraph))
+            )
+            paragraph = []
+        yield from (
+            {"words": words} for words in split_sentences(" ".join(paragraph))
+        )
+
+
+def read_csv(path: Path) -> Iterator[dict]:
+    """
+    One sentence per row. A first row naming a 'words' column is a header,
+    and an optional 'phrases' column holds phrases separated by ';'.
+    Without one the file has no header, and each row's first column is
+    the sentence.
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = csv.reader(f)
+        header = next(rows, None)
+        if header is None:
+            raise ValueError(f"{path.name} is empty.")
+
+        if "words" in header:
+            words = header.index("words")
+            phrases = header.index("phrases") if "phrases" in header else None
+        else:
+            rows = chain([header], rows)
+            words, phrases = 0, None
+
+        for row in rows:
+            listed = ""
+            if phrases is not None and phrases < len(row):
+                listed = row[phrases]
+            yield {
+                "words": row[words] if words < len(row) else "",
+                "phrases": [
+                    phrase for phrase in listed.split(";") if phrase.strip()
+                ],
+            }
+
+
+def read_jsonl(path: Path) -> Iterator[dict]:
+    """
+    One sentence per line: {"words": ..., "phrases": [...]}, where each
+    phrase is either its words or {"words": ..., "notes": ..., "status": ...}.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+READERS = {
+    ".txt": read_text,
+    ".md": read_text,
+    ".csv": read_csv,
+    ".jsonl": read_jsonl,
+}
+
+
+def read_records(path: Path) -> Iterator[dict]:
+    try:
+        reader = READERS[path.suffix.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Can't import '{path.suffix}' files, use one of "
+            f"{', '.join(READERS)}."
+        )
+
+    return (record for record in reader(path) if record.get("words"))
+
+
+def next_ids(db) -> dict[str, int]:
+    """
+    The ids SQLite would hand out next. The tables are AUTOINCREMENT, so
+    that's past the highest id ever used, as kept in sqlite_sequence, and
+    a deleted row's id is never reused for a different sentence or phrase.
+    """
+    return {
+        table: db.execute(
+            text(
+                "select max(coalesce(("
+                "select seq from sqlite_sequence where name = :table"
+                f"), 0), coalesce((select max(id) from {table}), 0)) + 1;"
+            ),
+            {"table": table},
+        ).scalar()
+        for table in ("stacks", "sentences", "phrases", "notes")
+    }
+
+
+def insert_batch(records: list[dict], db):
+    """
+    Writes a batch of records with one executemany per table. Ids are
+    handed out up front, which is safe because the version bump before
+    them takes the database's write lock for the rest of the transaction.
+    """
+    Version.bump(db)
+    ids = next_ids(db)
+    # One event for the batch; readers of the feed just reload.
+    Event.emit("imported", db, sentences=len(records))
+
+    stacks, sentences, tokens, phrases, notes = [], [], [], [], []
+    for record in records:
+        stack_id = ids["stacks"] + len(stacks)
+        stacks.append({"id": stack_id})
+        sentences.append(
+            {
+                "id": ids["sentences"] + len(sentences),
+                "stack_id": stack_id,
+                "words": record["words"],
+            }
+        )
+        tokens.extend(postings(stack_id, record["words"]))
+        for phrase in record.get("phrases") or []:
+            if isinstance(phrase, str):
+                phrase = {"words": phrase}
+            phrase_id = ids["phrases"] + len(phrases)
+            phrases.append(
+                {
+                    "id": phrase_id,
+                    "stack_id": stack_id,
+                    "words": " ".join(tokenize(phrase["words"])),
+                }
+            )
+            notes.append(
+                {
+                    "id": ids["notes"] + len(notes),
+                    "phrase_id": phrase_id,
+                    "words": phrase.get("notes", ""),
+                    "status": phrase.get("status", "NEW"),
+                }
+            )
+
+    db.execute(text("insert into stacks (id) values (:id);"), stacks)
+    db.execute(
+        text(
+            "insert into sentences (id, stack_id, words) "
+            "values (:id, :stack_id, :words);"
+        ),
+        sentences,
+    )
+    if tokens:
+        db.execute(Statements.new_postings, tokens)
+    if phrases:
+        db.execute(
+            text(
+                "insert into phrases (id, stack_id, words) "
+                "values (:id, :stack_id, :words);"
+            ),
+            phrases,
+        )
+        db.execute(
+            text(
+                "insert into notes (id, phrase_id, words, definition_status) "
+                "values (:id, :phrase_id, :words, :status);"
+            ),
+            notes,
+        )
+
+
+def import_corpus(
+    path: Path,
+    engine: Engine,
+    batch_size: int = BATCH_SIZE,
+    progress: bool = True,
+) -> int:
+    """
+    Streams the file at `path` into the project, committing every
+    `batch_size` sentences. Returns the number of sentences imported.
+    """
+    records = read_records(path)
+    imported = 0
+
+    with tqdm(unit=" sentences", disable=not progress) as bar:
+        while batch := list(islice(records, batch_size)):
+            with unit_of_work(engine, write=True) as db:
+                insert_batch(batch, db)
+            imported += len(batch)
+            bar.update(len(batch))
+
+    return imported
+
+
+def export_records(db) -> Iterator[dict]:
+    """
+    Every stack with its full revision history, then every phrase with its
+    notes and definition. Both come off a single ordered cursor each, and
+    only one stack's history is held at a time.
+    """
+    revisions = db.execute(Statements.export_sentences)
+    for stack_id, rows in groupby(revisions, key=lambda row: row.stack_id):
+        rows = list(rows)
+        yield {
+            "type": "stack",
+            "id": stack_id,
+            "stale": bool(rows[0].stale),
+            "revisions": [
+                {"id": row.id, "words": words, "timestamp": row.timestamp}
+                for row, words in zip(rows, restore_words(rows))
+            ][::-1],
+        }
+
+    for phrase in db.execute(Statements.export_phrases):
+        yield {
+            "type": "phrase",
+            "id": phrase.id,
+            "stack_id": phrase.stack_id,
+            "words": phrase.words,
+            "stale": bool(phrase.stale),
+            "notes": phrase.notes,
+            "definition_status": phrase.definition_status,
+            "definition_stack_id": phrase.def_stack_id,
+        }
+
+
+def export_jsonl(engine: Engine, out: TextIO) -> int:
+    """
+    Writes the project to `out` as JSON lines, reading everything inside
+    one transaction so the export is consistent even while the server is
+    writing. Returns the number of lines written.
+    """
+    written = 0
+    with engine.connect() as db:
+        db.execute(text("begin;"))
+        for record in export_records(db):
+            out.write(json.dumps(record) + "\n")
+            written += 1
+
+    return written
+
+
+def snapshot(engine: Engine, destination: Path, pages: int = 1024):
+    """
+    Copies the project database to `destination` with SQLite's online
+    backup API, `pages` at a time, so a live server doesn't have to stop.
+    """
+    raw = engine.raw_connection()
+    target = sqlite3.connect(destination)
+    try:
+        raw.driver_connection.backup(target, pages=pages)
+    finally:
+        target.close()
+        raw.close()
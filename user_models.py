@@ -1,4 +1,6 @@
-from sqlalchemy import text, Connection
+from pathlib import Path
+
+from sqlalchemy import text, Connection, Engine
 from pypika import (
     Table,
     SQLLiteQuery as Query,
@@ -7,6 +9,9 @@ from pypika import (
     AliasedQuery,
 )
 
+from database import PROJECTS_PATH, PROJECT_NAME, create_registry_engine
+from phrase_models import compiled, unit_of_work
+
 
 class Tables:
     users = Table("users")
@@ -14,6 +19,44 @@ class Tables:
     permissions = Table("permissions")
 
 
+# The tables of the registry database, which sits beside the projects
+# rather than in any one of them.
+REGISTRY_SCHEMA = ["users.sql", "projects.sql"]
+SQL_INIT = Path.cwd() / "sql"
+
+
+class Statements:
+    registry_exists = text(
+        "select count(*) from sqlite_master "
+        "where type = 'table' and name = 'projects';"
+    )
+    get_project_by_name = compiled(
+        Query.from_(Tables.projects)
+        .select("*")
+        .where(Tables.projects.project_name == Parameter(":project_name"))
+    )
+    all_projects = compiled(
+        Query.from_(Tables.projects)
+        .select("*")
+        .orderby(Tables.projects.project_name)
+    )
+    # project_name isn't unique in the schema, so registering checks first.
+    unregister_project = compiled(
+        Query.from_(Tables.projects)
+        .delete()
+        .where(Tables.projects.project_name == Parameter(":project_name"))
+    )
+    register_project = text(
+        """
+        insert into projects (project_name)
+        select :project_name
+        where not exists (
+            select 1 from projects where project_name = :project_name
+        )
+        """
+    )
+
+
 class User:
     @classmethod
     def login(cls, username, password):
@@ -32,3 +75,60 @@ class Project:
     @classmethod
     def get_project(cls, project_id):
         pass
+
+    @classmethod
+    def get_by_name(cls, project_name, db: Connection):
+        result = db.execute(
+            Statements.get_project_by_name, {"project_name": project_name}
+        )
+
+        return result.fetchone()
+
+    @classmethod
+    def all(cls, db: Connection):
+        result = db.execute(Statements.all_projects)
+
+        return result.fetchall()
+
+    @classmethod
+    def register(cls, project_name, db: Connection):
+        db.execute(Statements.register_project, {"project_name": project_name})
+
+    @classmethod
+    def sync(cls, db: Connection, projects_path: Path = PROJECTS_PATH):
+        """
+        Registers every project database in the projects folder, and drops
+        projects whose database is gone.
+        """
+        found = {
+            path.stem
+            for path in projects_path.glob("*.sqlite3")
+            if PROJECT_NAME.fullmatch(path.stem)
+        }
+        registered = {project.project_name for project in cls.all(db)}
+
+        if added := found - registered:
+            db.execute(
+                Statements.register_project,
+                [{"project_name": name} for name in sorted(added)],
+            )
+        if removed := registered - found:
+            db.execute(
+                Statements.unregister_project,
+                [{"project_name": name} for name in sorted(removed)],
+            )
+
+
+def open_registry() -> Engine:
+    """
+    The registry's engine, creating its tables the first time and picking
+    up any projects made before there was a registry.
+    """
+    engine = create_registry_engine()
+    with unit_of_work(engine) as db:
+        if not db.execute(Statements.registry_exists).scalar():
+            for file in REGISTRY_SCHEMA:
+                db.execute(text((SQL_INIT / file).read_text()))
+        Project.sync(db)
+
+    return engine